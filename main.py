@@ -1,32 +1,183 @@
+import time as _time
+_BOOT_T0 = _time.time()  # module import start; see STARTUP_STATS
+
 from datetime import date
+from datetime import date as _date
 from datetime import timedelta
+import datetime as _dt
 from typing import List
-from fastapi import FastAPI, Query, Request, HTTPException
+from fastapi import FastAPI, Query, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from pydantic import BaseModel
 from fastapi import BackgroundTasks
 import uuid
+import uuid as _uuid
 import os
+import gzip
 import urllib.parse
+import urllib.request
 import json
+import threading
+import queue as _queue
+import sys
+import random
+import heapq
+import itertools
+from array import array
+from email.utils import parsedate_to_datetime
 import httpx
 BACKFILL_WAIT_SECS = 3600
 DAILY_WAIT_SECS = 1500
 from fastapi.templating import Jinja2Templates
 from sqlalchemy import create_engine, text
-DB_URL = os.environ.get("DATABASE_URL")
+from sqlalchemy import text as _text
 
 # Force SQLAlchemy to use psycopg3 driver if a plain URL was provided
-if DB_URL:
-    if DB_URL.startswith("postgres://"):
-        DB_URL = DB_URL.replace("postgres://", "postgresql+psycopg://", 1)
-    elif DB_URL.startswith("postgresql://") and "+psycopg" not in DB_URL:
-        DB_URL = DB_URL.replace("postgresql://", "postgresql+psycopg://", 1)
+def _normalize_db_url(url: str | None) -> str | None:
+    if url:
+        if url.startswith("postgres://"):
+            url = url.replace("postgres://", "postgresql+psycopg://", 1)
+        elif url.startswith("postgresql://") and "+psycopg" not in url:
+            url = url.replace("postgresql://", "postgresql+psycopg://", 1)
+    return url
+
+DB_URL = _normalize_db_url(os.environ.get("DATABASE_URL"))
+# Optional streaming replica for the analytical read endpoints
+DB_READ_URL = _normalize_db_url(os.environ.get("DATABASE_READ_URL"))
+
+# ---- DB layer tuning (all env-driven) ----
+# Pre-ping costs a round trip per checkout, so it is opt-in; pool_recycle
+# retires connections before server/proxy idle timeouts instead.
+# DB_PREPARE_THRESHOLD: psycopg3 prepares a statement server-side after it has
+# run this many times on a connection, so the hot upserts and range queries
+# are planned once per connection instead of once per batch.
+# DB_PGBOUNCER=1: transaction-pooling compatible mode; disables server-side
+# prepared statements and the "options" startup parameter (set the statement
+# timeout on the DB role instead).
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE_SECS = int(os.environ.get("DB_POOL_RECYCLE_SECS", "1800"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "0") == "1"
+DB_PREPARE_THRESHOLD = int(os.environ.get("DB_PREPARE_THRESHOLD", "2"))
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "0") == "1"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = server default
+
+def _db_engine_kwargs(pool_size: int, max_overflow: int, pool_timeout: int, statement_timeout_ms: int = 0) -> dict:
+    connect_args = {"prepare_threshold": None if DB_PGBOUNCER else DB_PREPARE_THRESHOLD}
+    if statement_timeout_ms and not DB_PGBOUNCER:
+        connect_args["options"] = f"-c statement_timeout={statement_timeout_ms}"
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": DB_POOL_RECYCLE_SECS,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "connect_args": connect_args,
+    }
+
+engine = create_engine(
+    DB_URL,
+    **_db_engine_kwargs(DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_STATEMENT_TIMEOUT_MS),
+) if DB_URL else None
+
+# Async engine for the read-only dashboard endpoints (psycopg3 async driver).
+# Each request awaits its query instead of pinning a threadpool thread, so
+# concurrency is bounded by the pool below rather than anyio's 40 threads.
+from sqlalchemy.ext.asyncio import create_async_engine
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "10"))
+DB_READ_MAX_OVERFLOW = int(os.environ.get("DB_READ_MAX_OVERFLOW", "20"))
+DB_READ_POOL_TIMEOUT = int(os.environ.get("DB_READ_POOL_TIMEOUT", "10"))
+DB_READ_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_READ_STATEMENT_TIMEOUT_MS", "15000"))
+
+async_engine = create_async_engine(
+    DB_URL,
+    **_db_engine_kwargs(DB_READ_POOL_SIZE, DB_READ_MAX_OVERFLOW, DB_READ_POOL_TIMEOUT, DB_READ_STATEMENT_TIMEOUT_MS),
+) if DB_URL else None
+
+replica_async_engine = create_async_engine(
+    DB_READ_URL,
+    **_db_engine_kwargs(DB_READ_POOL_SIZE, DB_READ_MAX_OVERFLOW, DB_READ_POOL_TIMEOUT, DB_READ_STATEMENT_TIMEOUT_MS),
+) if (DB_URL and DB_READ_URL) else None
+
+# ---- read routing: replica unless it lags too far behind the primary ----
+import asyncio
+READ_REPLICA_MAX_LAG_SECS = float(os.environ.get("READ_REPLICA_MAX_LAG_SECS", "300"))
+READ_REPLICA_PROBE_SECS = float(os.environ.get("READ_REPLICA_PROBE_SECS", "15"))
+REPLICA_STATE = {"use_replica": bool(replica_async_engine), "lag_secs": None, "checked_at": 0.0, "last_error": None}
+_replica_probe_lock = asyncio.Lock()
+
+_REPLICA_LAG_SQL = text("""
+    SELECT CASE
+      WHEN NOT pg_is_in_recovery() THEN 0
+      WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+      ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag_secs
+""")
 
-engine = create_engine(DB_URL, pool_pre_ping=True) if DB_URL else None
+async def _read_engine():
+    """
+    Engine for read-only endpoints. Returns the replica when DATABASE_READ_URL is
+    set and its replay lag (probed at most every READ_REPLICA_PROBE_SECS) is within
+    READ_REPLICA_MAX_LAG_SECS; otherwise falls back to the primary.
+    """
+    if not replica_async_engine:
+        return async_engine
+    if _time.monotonic() - REPLICA_STATE["checked_at"] >= READ_REPLICA_PROBE_SECS:
+        async with _replica_probe_lock:
+            if _time.monotonic() - REPLICA_STATE["checked_at"] >= READ_REPLICA_PROBE_SECS:
+                try:
+                    async with replica_async_engine.connect() as conn:
+                        lag = float((await conn.execute(_REPLICA_LAG_SQL)).scalar() or 0)
+                    REPLICA_STATE.update(lag_secs=lag, use_replica=lag <= READ_REPLICA_MAX_LAG_SECS, last_error=None)
+                except Exception as e:
+                    REPLICA_STATE.update(use_replica=False, last_error=f"{type(e).__name__}: {e}")
+                REPLICA_STATE["checked_at"] = _time.monotonic()
+                if not REPLICA_STATE["use_replica"]:
+                    print(f"[read_routing] replica skipped: lag={REPLICA_STATE['lag_secs']} err={REPLICA_STATE['last_error']}", flush=True)
+    return replica_async_engine if REPLICA_STATE["use_replica"] else async_engine
+
+# ---- pool metrics (exposed at /api/debug/db_pool) ----
+from sqlalchemy import event
+POOL_STATS = {}
+
+def _track_pool(name: str, sync_engine):
+    stats = POOL_STATS.setdefault(name, {"connects": 0, "checkouts": 0, "invalidated": 0})
+
+    @event.listens_for(sync_engine, "connect")
+    def _on_connect(dbapi_conn, conn_record):
+        stats["connects"] += 1
+
+    @event.listens_for(sync_engine, "checkout")
+    def _on_checkout(dbapi_conn, conn_record, conn_proxy):
+        stats["checkouts"] += 1
+
+    @event.listens_for(sync_engine, "invalidate")
+    def _on_invalidate(dbapi_conn, conn_record, exc):
+        stats["invalidated"] += 1
+
+if engine:
+    _track_pool("primary", engine)
+if async_engine:
+    _track_pool("read_async", async_engine.sync_engine)
+if replica_async_engine:
+    _track_pool("replica_async", replica_async_engine.sync_engine)
+
+def _pool_snapshot(name: str, sync_engine) -> dict:
+    pool = sync_engine.pool
+    return {
+        "name": name,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "status": pool.status(),
+        **POOL_STATS.get(name, {}),
+    }
 
 def init_db():
+    """Baseline schema (migration 1). Later changes are versioned migrations, see SCHEMA MIGRATIONS."""
     if not engine:
         return
     ddl = """
@@ -93,10 +244,539 @@ def init_db():
     );
     CREATE INDEX IF NOT EXISTS idx_fact_st_profile_date ON fact_sp_search_term_daily(profile_id, date);
     CREATE INDEX IF NOT EXISTS idx_fact_st_term_date ON fact_sp_search_term_daily(search_term, date);
+
+    -- distinct search terms per profile (small; trigram-indexed by migration 5)
+    CREATE TABLE IF NOT EXISTS dim_sp_search_term (
+      profile_id     text NOT NULL,
+      search_term    text NOT NULL,
+      first_seen     date NOT NULL,
+      last_seen      date NOT NULL,
+      PRIMARY KEY (profile_id, search_term)
+    );
+
+    -- harvesting output: promote / negate candidates per (window, ad group, search term)
+    CREATE TABLE IF NOT EXISTS sp_search_term_candidates (
+      profile_id     text NOT NULL,
+      window_start   date NOT NULL,
+      window_end     date NOT NULL,
+      kind           text NOT NULL,          -- 'promote' | 'negate'
+      campaign_id    text NOT NULL,
+      campaign_name  text NOT NULL,
+      ad_group_id    text NOT NULL,
+      ad_group_name  text NOT NULL,
+      search_term    text NOT NULL,
+
+      impressions    bigint NOT NULL,
+      clicks         bigint NOT NULL,
+      cost           numeric(18,4) NOT NULL,
+      attributed_sales_14d        numeric(18,4) NOT NULL,
+      attributed_conversions_14d  bigint NOT NULL,
+      acos           numeric(18,6),
+
+      run_id         uuid NOT NULL,
+      computed_at    timestamptz NOT NULL DEFAULT now(),
+
+      PRIMARY KEY (profile_id, window_start, window_end, kind, ad_group_id, search_term)
+    );
+    CREATE INDEX IF NOT EXISTS idx_st_cand_window ON sp_search_term_candidates(profile_id, window_end DESC, kind);
+
+    -- report request cache: one row per (profile, report type, columns, date range)
+    CREATE TABLE IF NOT EXISTS ads_report_requests (
+      cache_key      text PRIMARY KEY,
+      profile_id     text NOT NULL,
+      report_type    text NOT NULL,
+      start_date     date NOT NULL,
+      end_date       date NOT NULL,
+      columns        text NOT NULL,
+      report_id      text NOT NULL,
+      status         text NOT NULL,
+      url            text,
+      url_expires_at timestamptz,
+      created_at     timestamptz NOT NULL DEFAULT now(),
+      completed_at   timestamptz,
+      updated_at     timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS idx_report_req_report_id ON ads_report_requests(report_id);
+
+    -- anomaly detection output (spend spikes / CTR collapses on the latest day)
+    CREATE TABLE IF NOT EXISTS sp_metric_anomalies (
+      profile_id     text NOT NULL,
+      source         text NOT NULL,          -- 'kw' | 'st'
+      entity_key     text NOT NULL,          -- keyword_id | ad_group_id|search_term|match_type
+      entity_label   text NOT NULL,
+      date           date NOT NULL,
+      metric         text NOT NULL,          -- 'spend' | 'ctr'
+      value          double precision NOT NULL,
+      baseline       double precision NOT NULL,
+      mad            double precision NOT NULL,
+      score          double precision NOT NULL,
+      run_id         uuid NOT NULL,
+      detected_at    timestamptz NOT NULL DEFAULT now(),
+      PRIMARY KEY (profile_id, source, date, metric, entity_key)
+    );
+
+    -- keyword-mapping changes of search-term rows, written by the loaders' set-based diff
+    CREATE TABLE IF NOT EXISTS fact_sp_search_term_map_history (
+      id               bigserial PRIMARY KEY,
+      profile_id       text NOT NULL,
+      date             date NOT NULL,                  -- date of the NEW fact row
+      campaign_id      text NOT NULL,
+      ad_group_id      text NOT NULL,
+      search_term      text NOT NULL,
+      match_type       text NOT NULL,                  -- NEW match_type
+      old_keyword_id   text,
+      old_keyword_text text,
+      new_keyword_id   text,
+      new_keyword_text text,
+      run_id           uuid,
+      changed_at       timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS idx_st_map_hist_when
+      ON fact_sp_search_term_map_history (changed_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_st_map_hist_lookup
+      ON fact_sp_search_term_map_history (profile_id, search_term, ad_group_id, date);
+    -- superseded by the diff above; left installed it would log every change twice
+    DROP TRIGGER IF EXISTS trg_after_update_st_map_change ON fact_sp_search_term_daily;
+
+    -- coverage ledger: one row per ingested (profile, report type, day), kept by the loaders
+    CREATE TABLE IF NOT EXISTS ingest_coverage (
+      profile_id     text NOT NULL,
+      report_type    text NOT NULL,          -- 'kw' | 'st'
+      date           date NOT NULL,
+      row_count      integer NOT NULL,
+      impressions    bigint NOT NULL,
+      clicks         bigint NOT NULL,
+      cost           numeric(18,4) NOT NULL,
+      attributed_sales_14d        numeric(18,4) NOT NULL,
+      attributed_conversions_14d  bigint NOT NULL,
+      last_run_id    uuid,
+      updated_at     timestamptz NOT NULL DEFAULT now(),
+      PRIMARY KEY (profile_id, report_type, date)
+    );
+
+    -- parquet export manifest: one row per exported (profile, report type, month)
+    CREATE TABLE IF NOT EXISTS analytics_exports (
+      profile_id     text NOT NULL,
+      report_type    text NOT NULL,
+      month          date NOT NULL,
+      row_count      bigint NOT NULL,
+      bytes          bigint NOT NULL,
+      path           text NOT NULL,
+      exported_at    timestamptz NOT NULL,
+      PRIMARY KEY (profile_id, report_type, month)
+    );
     """
     with engine.begin() as conn:
         conn.exec_driver_sql(ddl)
 
+# ======================================================
+# SCHEMA MIGRATIONS
+# ======================================================
+# Versioned, run out-of-band (worker JOB_MODE=migrate) under a session advisory
+# lock so only one runner applies them. Every DDL statement gets a short
+# lock_timeout and is retried instead of queueing behind long transactions
+# (which would block ingest and reads behind it). Heavy steps on the fact tables
+# use CREATE/DROP INDEX CONCURRENTLY, NOT VALID + VALIDATE constraints and
+# month-sized batches for data fixes. Applied versions live in schema_migrations.
+MIGRATION_LOCK_KEY = 7_305_221_001
+MIGRATION_LOCK_TIMEOUT_MS = int(os.environ.get("MIGRATION_LOCK_TIMEOUT_MS", "5000"))
+MIGRATION_LOCK_RETRIES = int(os.environ.get("MIGRATION_LOCK_RETRIES", "10"))
+MIGRATIONS = []  # (version, name, fn), ascending
+
+def _migration(version: int, name: str):
+    def register(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "migrations must be registered in order"
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+class _MigrationCtx:
+    """Helpers for a migration: `auto` is an autocommit connection (holds the advisory lock)."""
+
+    def __init__(self, auto):
+        self.auto = auto
+
+    def _retry(self, fn):
+        from sqlalchemy.exc import OperationalError
+        for attempt in range(MIGRATION_LOCK_RETRIES + 1):
+            try:
+                return fn()
+            except OperationalError as e:
+                if getattr(e.orig, "sqlstate", None) != "55P03" or attempt == MIGRATION_LOCK_RETRIES:
+                    raise
+                print(f"[migrate] lock_timeout, retry {attempt + 1}/{MIGRATION_LOCK_RETRIES}", flush=True)
+                _time.sleep(min(30, 2 ** attempt))
+
+    def tx(self, sql: str, params: dict | None = None):
+        """Run statements in one short transaction with lock_timeout."""
+        def run():
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT_MS}ms'")
+                if params is None:
+                    conn.exec_driver_sql(sql)
+                    return None
+                return conn.execute(text(sql), params)
+        return self._retry(run)
+
+    def online(self, sql: str):
+        """
+        One non-transactional statement (CREATE/DROP INDEX CONCURRENTLY, VALIDATE ...).
+        These only take SHARE UPDATE EXCLUSIVE, which never blocks reads or writes,
+        so they wait as long as they need instead of using lock_timeout.
+        """
+        self.auto.exec_driver_sql(sql)
+
+    def scalar(self, sql: str, params: dict | None = None):
+        return self.auto.execute(text(sql), params or {}).scalar()
+
+    def create_index(self, name: str, ddl: str):
+        """CREATE INDEX CONCURRENTLY; drops an INVALID leftover of an interrupted earlier attempt first."""
+        invalid = self.scalar("""
+            SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name
+        """, {"name": name})
+        if invalid:
+            self.online(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        self.online(ddl)
+
+    def has_table(self, name: str) -> bool:
+        return bool(self.scalar("SELECT to_regclass(:n) IS NOT NULL", {"n": f"public.{name}"}))
+
+    def has_constraint(self, table: str, name: str) -> bool:
+        return bool(self.scalar("""
+            SELECT 1 FROM pg_constraint WHERE conname = :name AND conrelid = to_regclass(:t)
+        """, {"name": name, "t": f"public.{table}"}))
+
+    def add_check(self, table: str, name: str, expr: str):
+        """ADD CONSTRAINT ... NOT VALID (instant), then VALIDATE (scans without blocking writes)."""
+        if not self.has_constraint(table, name):
+            self.tx(f"ALTER TABLE {table} ADD CONSTRAINT {name} CHECK ({expr}) NOT VALID")
+        self.online(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+    def by_month(self, table: str, sql: str, params: dict | None = None) -> int:
+        """Run `sql` (with :lo / :hi date bounds) once per month of `table`'s data, each in its own transaction."""
+        lo, hi = self.auto.execute(text(f"SELECT min(date), max(date) FROM {table}")).one()
+        total = 0
+        if lo is None:
+            return total
+        for m in _months_between(lo, hi):
+            nxt = (m.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+            res = self.tx(sql, {**(params or {}), "lo": m, "hi": nxt})
+            total += max(0, res.rowcount or 0)
+        return total
+
+def _run_migrations(target: int | None = None) -> dict:
+    """Apply pending migrations up to `target` (default: all). Safe to run concurrently; losers return locked."""
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    applied_now = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as auto:
+        if not auto.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY}).scalar():
+            return {"ok": False, "locked": True, "applied": []}
+        try:
+            auto.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                  version     integer PRIMARY KEY,
+                  name        text NOT NULL,
+                  applied_at  timestamptz NOT NULL DEFAULT now(),
+                  duration_ms integer
+                );
+                ALTER TABLE schema_migrations ADD COLUMN IF NOT EXISTS duration_ms integer;
+            """)
+            done = {r[0] for r in auto.execute(text("SELECT version FROM schema_migrations"))}
+            ctx = _MigrationCtx(auto)
+            for version, name, fn in MIGRATIONS:
+                if version in done or (target is not None and version > target):
+                    continue
+                t0 = _time.time()
+                print(f"[migrate] {version} {name} ...", flush=True)
+                fn(ctx)
+                ms = int((_time.time() - t0) * 1000)
+                auto.execute(text("""
+                    INSERT INTO schema_migrations (version, name, duration_ms) VALUES (:v, :n, :ms)
+                """), {"v": version, "n": name, "ms": ms})
+                print(f"[migrate] {version} {name} done in {ms}ms", flush=True)
+                applied_now.append({"version": version, "name": name, "ms": ms})
+        finally:
+            auto.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+    return {"ok": True, "locked": False, "applied": applied_now, "version": _schema_version()}
+
+@_migration(1, "baseline schema")
+def _m001_baseline(m: _MigrationCtx):
+    init_db()
+
+@_migration(2, "merge legacy fact_sp_keywords_daily into fact_sp_keyword_daily")
+def _m002_kw_legacy(m: _MigrationCtx):
+    # the old ingest merge wrote to the plural table; fold its rows into the canonical one
+    if not m.has_table("fact_sp_keywords_daily"):
+        return
+    n = m.by_month("fact_sp_keywords_daily", """
+        INSERT INTO fact_sp_keyword_daily (
+            profile_id, date, keyword_id, campaign_id, campaign_name, ad_group_id, ad_group_name,
+            keyword_text, match_type, impressions, clicks, cost, attributed_sales_14d,
+            attributed_conversions_14d, cpc, ctr, acos, roas, run_id, pulled_at
+        )
+        SELECT DISTINCT ON (profile_id, date, keyword_id)
+            profile_id, date, keyword_id, campaign_id, campaign_name, ad_group_id, ad_group_name,
+            keyword_text, match_type, impressions, clicks, cost, attributed_sales_14d,
+            attributed_conversions_14d, cpc, ctr, acos, roas, run_id, pulled_at
+        FROM fact_sp_keywords_daily
+        WHERE date >= :lo AND date < :hi
+        ORDER BY profile_id, date, keyword_id, pulled_at DESC
+        ON CONFLICT (profile_id, date, keyword_id) DO UPDATE SET
+            campaign_id = EXCLUDED.campaign_id, campaign_name = EXCLUDED.campaign_name,
+            ad_group_id = EXCLUDED.ad_group_id, ad_group_name = EXCLUDED.ad_group_name,
+            keyword_text = EXCLUDED.keyword_text, match_type = EXCLUDED.match_type,
+            impressions = EXCLUDED.impressions, clicks = EXCLUDED.clicks, cost = EXCLUDED.cost,
+            attributed_sales_14d = EXCLUDED.attributed_sales_14d,
+            attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
+            cpc = EXCLUDED.cpc, ctr = EXCLUDED.ctr, acos = EXCLUDED.acos, roas = EXCLUDED.roas,
+            run_id = EXCLUDED.run_id, pulled_at = EXCLUDED.pulled_at
+        WHERE fact_sp_keyword_daily.pulled_at < EXCLUDED.pulled_at
+    """)
+    spans = m.auto.execute(text("""
+        SELECT profile_id, min(date), max(date) FROM fact_sp_keywords_daily GROUP BY profile_id
+    """)).all()
+    with engine.begin() as conn:
+        for pid, lo, hi in spans:
+            _refresh_coverage(conn, pid, "kw", lo, hi)
+    m.tx("ALTER TABLE fact_sp_keywords_daily RENAME TO fact_sp_keywords_daily_legacy")
+    print(f"[migrate] merged {n} legacy keyword rows; kept fact_sp_keywords_daily_legacy", flush=True)
+
+@_migration(3, "search-term keyword columns and map-history trigger cleanup")
+def _m003_st_columns(m: _MigrationCtx):
+    m.tx("""
+        ALTER TABLE fact_sp_search_term_daily ADD COLUMN IF NOT EXISTS keyword_id text;
+        ALTER TABLE fact_sp_search_term_daily ADD COLUMN IF NOT EXISTS keyword_text text;
+        DROP TRIGGER IF EXISTS trg_after_update_st_map_change ON fact_sp_search_term_daily;
+        DROP FUNCTION IF EXISTS trg_log_st_keyword_mapping_change();
+    """)
+
+@_migration(4, "canonical search-term unique key")
+def _m004_st_unique_key(m: _MigrationCtx):
+    # tables made by the old create_st_table endpoint had uq_st_fact with campaign_id
+    # (and duplicate indexes); every writer now conflicts on uq_fact_st's columns
+    if not m.has_constraint("fact_sp_search_term_daily", "uq_fact_st"):
+        removed = m.by_month("fact_sp_search_term_daily", """
+            DELETE FROM fact_sp_search_term_daily f
+            USING (
+                SELECT ctid, row_number() OVER (
+                    PARTITION BY profile_id, date, ad_group_id, search_term, match_type
+                    ORDER BY pulled_at DESC
+                ) AS rn
+                FROM fact_sp_search_term_daily
+                WHERE date >= :lo AND date < :hi
+            ) d
+            WHERE f.ctid = d.ctid AND d.rn > 1 AND f.date >= :lo AND f.date < :hi
+        """)
+        print(f"[migrate] removed {removed} duplicate search-term rows", flush=True)
+        m.create_index("uq_fact_st", """
+            CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_fact_st
+            ON fact_sp_search_term_daily (profile_id, date, ad_group_id, search_term, match_type)
+        """)
+        m.tx("ALTER TABLE fact_sp_search_term_daily ADD CONSTRAINT uq_fact_st UNIQUE USING INDEX uq_fact_st")
+    m.tx("ALTER TABLE fact_sp_search_term_daily DROP CONSTRAINT IF EXISTS uq_st_fact")
+    m.create_index("idx_fact_st_profile_date", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_st_profile_date
+        ON fact_sp_search_term_daily (profile_id, date)
+    """)
+    m.create_index("idx_fact_st_term_date", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_st_term_date
+        ON fact_sp_search_term_daily (search_term, date)
+    """)
+    m.online("DROP INDEX CONCURRENTLY IF EXISTS idx_st_profile_date")
+    m.online("DROP INDEX CONCURRENTLY IF EXISTS idx_st_term_date")
+
+@_migration(5, "trigram search-term dimension")
+def _m005_st_trigram(m: _MigrationCtx):
+    m.tx("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    m.create_index("idx_dim_st_term_trgm", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dim_st_term_trgm
+        ON dim_sp_search_term USING gin (search_term gin_trgm_ops)
+    """)
+    m.by_month("fact_sp_search_term_daily", """
+        INSERT INTO dim_sp_search_term (profile_id, search_term, first_seen, last_seen)
+        SELECT profile_id, search_term, MIN(date), MAX(date)
+        FROM fact_sp_search_term_daily
+        WHERE date >= :lo AND date < :hi
+        GROUP BY profile_id, search_term
+        ON CONFLICT (profile_id, search_term) DO UPDATE SET
+          first_seen = LEAST(dim_sp_search_term.first_seen, EXCLUDED.first_seen),
+          last_seen  = GREATEST(dim_sp_search_term.last_seen, EXCLUDED.last_seen)
+    """)
+
+@_migration(6, "non-negative metric checks")
+def _m006_metric_checks(m: _MigrationCtx):
+    for table, name in (("fact_sp_keyword_daily", "ck_fact_kw_metrics"),
+                        ("fact_sp_search_term_daily", "ck_fact_st_metrics")):
+        m.add_check(table, name, "impressions >= 0 AND clicks >= 0 AND cost >= 0 "
+                                 "AND attributed_sales_14d >= 0 AND attributed_conversions_14d >= 0")
+
+@_migration(7, "covering range indexes, BRIN on date, visibility-map friendly autovacuum")
+def _m007_range_indexes(m: _MigrationCtx):
+    # Keys follow the default range ORDER BY; INCLUDE carries every column the
+    # range SELECT returns, so pages come from an index-only scan. Counts use the
+    # narrow (profile_id, date) indexes. Both only skip the heap while the
+    # visibility map is current, hence the insert-driven autovacuum settings.
+    m.create_index("idx_fact_kw_range", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_kw_range
+        ON fact_sp_keyword_daily (profile_id, date DESC, campaign_name, ad_group_name, keyword_text)
+        INCLUDE (keyword_id, campaign_id, ad_group_id, match_type,
+                 impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+                 cpc, ctr, acos, roas, run_id, pulled_at)
+    """)
+    m.create_index("idx_fact_st_range", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_st_range
+        ON fact_sp_search_term_daily (profile_id, date DESC, campaign_name, ad_group_name, search_term)
+        INCLUDE (keyword_text, match_type,
+                 impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+                 cpc, ctr, acos, roas)
+    """)
+    # rows arrive roughly in date order, so block ranges correlate with date:
+    # tiny indexes for the whole-table date scans (exports, coverage rebuilds, compaction)
+    for table, name in (("fact_sp_keyword_daily", "brin_fact_kw_date"),
+                        ("fact_sp_search_term_daily", "brin_fact_st_date")):
+        m.create_index(name, f"""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}
+            ON {table} USING brin (date) WITH (pages_per_range = 32)
+        """)
+        m.tx(f"""
+            ALTER TABLE {table} SET (
+              autovacuum_vacuum_insert_scale_factor = 0.02,
+              autovacuum_vacuum_scale_factor = 0.02,
+              autovacuum_analyze_scale_factor = 0.02
+            )
+        """)
+        m.online(f"VACUUM (ANALYZE) {table}")
+
+# cpc / ctr / acos / roas are defined only here, as expressions over the stored
+# base columns (round(x / y, 6), 0 when y is 0: what the loaders used to store).
+# Exposed by the v_sp_* views; aggregates recompute them from SUMs instead.
+_DERIVED_METRICS_SQL = """
+      COALESCE(round(cost / NULLIF(clicks, 0), 6), 0) AS cpc,
+      COALESCE(round(clicks::numeric / NULLIF(impressions, 0), 6), 0) AS ctr,
+      COALESCE(round(cost / NULLIF(attributed_sales_14d, 0), 6), 0) AS acos,
+      COALESCE(round(attributed_sales_14d / NULLIF(cost, 0), 6), 0) AS roas"""
+
+_DERIVED_VIEWS_SQL = """
+    CREATE OR REPLACE VIEW v_sp_keyword_daily AS
+    SELECT profile_id, date, keyword_id,
+           campaign_id, campaign_name, ad_group_id, ad_group_name,
+           keyword_text, match_type,
+           impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+           run_id, pulled_at,""" + _DERIVED_METRICS_SQL + """
+    FROM fact_sp_keyword_daily;
+
+    CREATE OR REPLACE VIEW v_sp_search_term_daily AS
+    SELECT profile_id, date,
+           campaign_id, campaign_name, ad_group_id, ad_group_name,
+           search_term, keyword_id, keyword_text, match_type,
+           impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+           run_id, pulled_at,""" + _DERIVED_METRICS_SQL + """
+    FROM fact_sp_search_term_daily;
+"""
+_DERIVED_COLUMNS = ("cpc", "ctr", "acos", "roas")
+
+# 8 and 9 are an expand / contract pair: code that stops writing the stored
+# ratios needs 8; 9 drops them and must wait until no older instance still
+# writes them (migrate with MIGRATE_TARGET=8 before such a deploy).
+@_migration(8, "derived metrics as view expressions")
+def _m008_derived_views(m: _MigrationCtx):
+    m.create_index("idx_fact_kw_range_v2", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_kw_range_v2
+        ON fact_sp_keyword_daily (profile_id, date DESC, campaign_name, ad_group_name, keyword_text)
+        INCLUDE (keyword_id, campaign_id, ad_group_id, match_type,
+                 impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+                 run_id, pulled_at)
+    """)
+    m.create_index("idx_fact_st_range_v2", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fact_st_range_v2
+        ON fact_sp_search_term_daily (profile_id, date DESC, campaign_name, ad_group_name, search_term)
+        INCLUDE (keyword_text, match_type,
+                 impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d)
+    """)
+    m.tx("".join(
+        f"ALTER TABLE {t} " + ", ".join(f"ALTER COLUMN {c} DROP NOT NULL" for c in _DERIVED_COLUMNS) + ";\n"
+        for t in ("fact_sp_keyword_daily", "fact_sp_search_term_daily")
+    ) + _DERIVED_VIEWS_SQL)
+
+@_migration(9, "drop stored derived metric columns")
+def _m009_drop_derived(m: _MigrationCtx):
+    m.online("DROP INDEX CONCURRENTLY IF EXISTS idx_fact_kw_range")
+    m.online("DROP INDEX CONCURRENTLY IF EXISTS idx_fact_st_range")
+    m.tx("".join(
+        f"ALTER TABLE {t} " + ", ".join(f"DROP COLUMN IF EXISTS {c}" for c in _DERIVED_COLUMNS) + ";\n"
+        for t in ("fact_sp_keyword_daily", "fact_sp_search_term_daily")
+    ))
+
+# Search-term rows older than the retention window live in the compact tier
+# (one row per week or month instead of per day, see _run_compaction).
+# v_sp_search_term_all is what readers query: daily rows carry grain 'day',
+# compacted rows are dated at period_start.
+_COMPACT_VIEW_SQL = """
+    CREATE OR REPLACE VIEW v_sp_search_term_all AS
+    SELECT profile_id, date, 'day'::text AS grain,
+           campaign_id, campaign_name, ad_group_id, ad_group_name,
+           search_term, keyword_id, keyword_text, match_type,
+           impressions::bigint AS impressions, clicks::bigint AS clicks, cost,
+           attributed_sales_14d, attributed_conversions_14d::bigint AS attributed_conversions_14d,
+           run_id, pulled_at,""" + _DERIVED_METRICS_SQL + """
+    FROM fact_sp_search_term_daily
+    UNION ALL
+    SELECT profile_id, period_start, grain,
+           campaign_id, campaign_name, ad_group_id, ad_group_name,
+           search_term, keyword_id, keyword_text, match_type,
+           impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+           NULL::uuid, compacted_at,""" + _DERIVED_METRICS_SQL + """
+    FROM fact_sp_search_term_compact;
+"""
+
+@_migration(10, "search-term compact tier and retention state")
+def _m010_compact_tier(m: _MigrationCtx):
+    m.tx("""
+        CREATE TABLE IF NOT EXISTS fact_sp_search_term_compact (
+          profile_id     text NOT NULL,
+          grain          text NOT NULL CHECK (grain IN ('week', 'month')),
+          period_start   date NOT NULL,
+          period_end     date NOT NULL,
+
+          campaign_id    text NOT NULL,
+          campaign_name  text NOT NULL,
+          ad_group_id    text NOT NULL,
+          ad_group_name  text NOT NULL,
+
+          search_term    text NOT NULL,   -- '(other)' for bucketed low-volume terms
+          keyword_id     text,
+          keyword_text   text,
+          match_type     text NOT NULL,
+
+          impressions    bigint NOT NULL,
+          clicks         bigint NOT NULL,
+          cost           numeric(20,4) NOT NULL,
+          attributed_sales_14d numeric(20,4) NOT NULL,
+          attributed_conversions_14d bigint NOT NULL,
+
+          source_rows    integer NOT NULL,  -- daily rows folded into this one
+          bucketed_terms integer NOT NULL DEFAULT 0,
+          compacted_at   timestamptz NOT NULL DEFAULT now(),
+
+          CONSTRAINT uq_fact_st_compact UNIQUE (profile_id, grain, period_start, ad_group_id, search_term, match_type)
+        );
+        CREATE INDEX IF NOT EXISTS idx_fact_st_compact_range
+          ON fact_sp_search_term_compact (profile_id, period_start DESC, campaign_name, ad_group_name, search_term);
+
+        CREATE TABLE IF NOT EXISTS retention_state (
+          profile_id       text NOT NULL,
+          report_type      text NOT NULL,
+          grain            text NOT NULL,
+          compacted_before date NOT NULL,   -- daily rows before this date have been compacted
+          updated_at       timestamptz NOT NULL DEFAULT now(),
+          PRIMARY KEY (profile_id, report_type)
+        );
+    """ + _COMPACT_VIEW_SQL)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 # ======================================================
 # APP SETUP
 # ======================================================
@@ -111,6 +791,167 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# ======================================================
+# RESPONSE ENCODING
+# ======================================================
+# Negotiated Content-Encoding for every response: zstd / br via the pinned
+# zstandard / brotli packages (gzip alone if they fail to import). Small bodies and
+# already-encoded or binary payloads pass through untouched.
+import zlib
+from decimal import Decimal
+from starlette.datastructures import MutableHeaders
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get("COMPRESS_ZSTD_LEVEL", "6"))
+_COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "text/", "application/javascript")
+
+class _BrotliStream:
+    """brotli.Compressor behind the compress()/flush() interface of zlib and zstandard."""
+    __slots__ = ("_c",)
+
+    def __init__(self, compressor):
+        self._c = compressor
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.process(data)
+
+    def flush(self) -> bytes:
+        return self._c.finish()
+
+# server preference order when the client accepts several with the same q
+_ENCODERS = {}
+try:
+    import zstandard as _zstd
+    _ENCODERS["zstd"] = lambda: _zstd.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+except ImportError:
+    pass
+try:
+    import brotli as _brotli
+    _ENCODERS["br"] = lambda: _BrotliStream(_brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY))
+except ImportError:
+    pass
+_ENCODERS["gzip"] = lambda: zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+def _pick_encoding(accept_encoding: str) -> str | None:
+    """Best supported coding for an Accept-Encoding header (highest q, then our order)."""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for enc in _ENCODERS:
+        q = offered.get(enc, offered.get("*", 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+class _CompressMiddleware:
+    """Pure ASGI so it wraps JSON and HTML responses alike without buffering streams."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = next((v for k, v in scope["headers"] if k == b"accept-encoding"), b"").decode("latin-1")
+        enc = _pick_encoding(accept)
+        if not enc:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "comp": None}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            start = state.pop("start", None)
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                ctype = headers.get("content-type", "")
+                if ("content-encoding" in headers
+                        or start["status"] in (204, 304)
+                        or not ctype.startswith(_COMPRESSIBLE_TYPES)
+                        or (not more and len(body) < COMPRESS_MIN_BYTES)):
+                    await send(start)
+                    await send(message)
+                    return
+                state["comp"] = _ENCODERS[enc]()
+                headers["Content-Encoding"] = enc
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["content-length"]
+                if not more:
+                    body = state["comp"].compress(body) + state["comp"].flush()
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start)
+            comp = state["comp"]
+            if comp is None:
+                await send(message)
+                return
+            out = comp.compress(body)
+            if not more:
+                out += comp.flush()
+            await send({"type": "http.response.body", "body": out, "more_body": more})
+
+        await self.app(scope, receive, _send)
+
+app.add_middleware(_CompressMiddleware)
+
+# Columnar bodies for the bulk endpoints: {"columns": [...], "rows": n, "data": [[...], ...]}
+# with one array per column, so key names are sent once instead of once per row.
+# format=msgpack ships the same structure as MessagePack (msgpack is pinned in requirements.txt).
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+def _plain(v):
+    if v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, date):  # datetime too
+        return v.isoformat()
+    return str(v)
+
+def _columnar_response(rows, columns: tuple[str, ...] | list[str], fmt: str, headers: dict | None = None) -> Response:
+    payload = {
+        "columns": list(columns),
+        "rows": len(rows),
+        "data": [[_plain(r[c]) for r in rows] for c in columns],
+    }
+    headers = {k: v for k, v in (headers or {}).items() if k.lower() != "content-length"}
+    if fmt == "msgpack":
+        if _msgpack is None:
+            raise HTTPException(status_code=400, detail="format=msgpack needs the msgpack package")
+        return Response(_msgpack.packb(payload), media_type="application/msgpack", headers=headers)
+    body = _orjson.dumps(payload) if _orjson else json.dumps(payload, separators=(",", ":")).encode()
+    return Response(body, media_type="application/json", headers=headers)
+
 templates = Jinja2Templates(directory="templates")
 @app.get("/ui/keywords", response_class=HTMLResponse)
 def ui_keywords(request: Request):
@@ -118,11 +959,9 @@ def ui_keywords(request: Request):
 
 # --- ultra-safe debug for Search Term table ---
 
-from fastapi.responses import JSONResponse
-
 @app.get("/api/debug/st_counts_safe")
-def st_counts_safe():
-    if not engine:
+async def st_counts_safe():
+    if not async_engine:
         raise HTTPException(status_code=500, detail="Database not configured")
     pid = _env("AMZN_PROFILE_ID")
     q = text("""
@@ -138,8 +977,8 @@ def st_counts_safe():
         ORDER BY date DESC
         LIMIT 10
     """)
-    with engine.begin() as conn:
-        rows = conn.execute(q, {"pid": pid}).mappings().all()
+    async with (await _read_engine()).connect() as conn:
+        rows = (await conn.execute(q, {"pid": pid})).mappings().all()
     return [{
         "date": r["date"].isoformat(),
         "rows": int(r["rows"]),
@@ -177,23 +1016,6 @@ def st_head(limit: int = 20):
         out.append(d)
     return out
 
-@app.post("/api/debug/migrate_kw_table")
-def migrate_kw_table():
-    if not engine:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    with engine.begin() as conn:
-        conn.exec_driver_sql("""
-        DO $$
-        BEGIN
-          IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema='public' AND table_name='fact_sp_keywords_daily') AND
-             NOT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema='public' AND table_name='fact_sp_keyword_daily')
-          THEN
-            EXECUTE 'ALTER TABLE fact_sp_keywords_daily RENAME TO fact_sp_keyword_daily';
-          END IF;
-        END$$;
-        """)
-    return {"ok": True}
-
 # ======================================================
 # DATA MODELS
 # ======================================================
@@ -225,6 +1047,7 @@ class KeywordRow(BaseModel):
     lookback_days: int
     buffer_days: int
     metrics: Metrics
+    report_date: date | None = None
 
 # ======================================================
 # MOCK DATA FUNCTION (TEMPORARY)
@@ -399,10 +1222,19 @@ def amzn_profiles():
         pr.raise_for_status()
         return pr.json()
 
-import io, gzip, datetime
-from fastapi.responses import JSONResponse
 
-def _get_access_token_from_refresh() -> str:
+# Access tokens live ~1h; reuse one until shortly before expiry instead of
+# exchanging the refresh token on every request.
+ADS_TOKEN_CACHE = {"access_token": None, "expires_at": 0.0, "refreshes": 0}
+_ads_token_lock = threading.Lock()
+
+def _get_access_token_from_refresh(force: bool = False) -> str:
+    with _ads_token_lock:
+        if not force and ADS_TOKEN_CACHE["access_token"] and _time.time() < ADS_TOKEN_CACHE["expires_at"]:
+            return ADS_TOKEN_CACHE["access_token"]
+        return _exchange_refresh_token()
+
+def _exchange_refresh_token() -> str:
     client_id = _env("AMZN_CLIENT_ID")
     client_secret = _env("AMZN_CLIENT_SECRET")
     refresh_token = _env("AMZN_REFRESH_TOKEN")
@@ -419,7 +1251,13 @@ def _get_access_token_from_refresh() -> str:
             r.raise_for_status()
         except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=502, detail={"stage":"refresh_token_exchange","status":e.response.status_code,"body":e.response.text})
-        return r.json()["access_token"]
+        body = r.json()
+    ADS_TOKEN_CACHE.update(
+        access_token=body["access_token"],
+        expires_at=_time.time() + int(body.get("expires_in", 3600)) - 120,
+        refreshes=ADS_TOKEN_CACHE["refreshes"] + 1,
+    )
+    return body["access_token"]
 
 def _ads_headers(access_token: str) -> dict:
     client_id = _env("AMZN_CLIENT_ID")
@@ -432,19 +1270,112 @@ def _ads_headers(access_token: str) -> dict:
         "Accept": "application/json",
     }
 
-def _ymd(d: datetime.date) -> str:
+def _ymd(d: date) -> str:
     return d.strftime("%Y-%m-%d")
 
+# ======================================================
+# REPORT PAYLOAD PARSING
+# ======================================================
+# Reports come back as GZIP_JSON: usually NDJSON, sometimes one JSON array or a
+# wrapper object. Use orjson (or simdjson) when installed; both parse bytes
+# directly so we never build a decoded str copy of the whole report.
+import re as _re
+
+try:
+    import orjson as _fastjson
+    _json_loads = _fastjson.loads
+    REPORT_JSON_PARSER = "orjson"
+except ImportError:
+    try:
+        import simdjson as _fastjson
+        _json_loads = _fastjson.loads
+        REPORT_JSON_PARSER = "simdjson"
+    except ImportError:
+        _json_loads = json.loads
+        REPORT_JSON_PARSER = "json"
+
+_FIRST_NON_WS = _re.compile(rb"\S")
+_RECORD_WRAPPER_KEYS = ("records", "rows", "data", "report", "result", "items")
+
+def _gunzip_report(content: bytes) -> bytes:
+    """Gunzip a downloaded report, or return it unchanged if it isn't gzipped."""
+    try:
+        return gzip.decompress(content)
+    except OSError:
+        return content
+
+def _extract_records(obj):
+    """Yield dict records from a parsed document: a list of dicts, a wrapper
+    dict holding such a list (optionally one level deeper), or a single record."""
+    if isinstance(obj, list):
+        for item in obj:
+            if isinstance(item, dict):
+                yield item
+    elif isinstance(obj, dict):
+        for k in _RECORD_WRAPPER_KEYS:
+            v = obj.get(k)
+            if isinstance(v, list):
+                yield from _extract_records(v)
+                return
+            if isinstance(v, dict):
+                for kk in ("records", "rows", "data", "items"):
+                    vv = v.get(kk)
+                    if isinstance(vv, list):
+                        yield from _extract_records(vv)
+                        return
+        yield obj
+
+def _iter_report_records(raw: bytes | str):
+    """
+    Yield dict records from a (decompressed) report payload in a single pass.
+    The first non-blank byte picks the shape: '[' is parsed as one JSON document,
+    anything else as NDJSON. If the *first* line isn't valid JSON the payload is
+    a pretty-printed document and is parsed whole; later bad lines are skipped.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+    m = _FIRST_NON_WS.search(raw)
+    if not m:
+        return
+    if raw[m.start():m.start() + 1] == b"[":
+        try:
+            obj = _json_loads(raw)
+        except ValueError:
+            return
+        yield from _extract_records(obj)
+        return
+
+    first = True
+    skipped = 0
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        try:
+            obj = _json_loads(line)
+        except ValueError:
+            if first:
+                try:
+                    obj = _json_loads(raw)
+                except ValueError:
+                    return
+                yield from _extract_records(obj)
+                return
+            skipped += 1
+            continue
+        first = False
+        yield from _extract_records(obj)
+    if skipped:
+        print(f"[parse] skipped {skipped} malformed NDJSON lines ({REPORT_JSON_PARSER})", flush=True)
+
 @app.get("/api/sp/keywords_live", response_model=List[KeywordRow])
 def sp_keywords_live(lookback_days: int = 14, buffer_days: int = 1, limit: int = 1000):
     """
     Pull real Sponsored Products Keyword performance via Reports v3 and map to our table shape.
     """
-    import datetime, io, gzip, time, re
 
     # 1) dates with attribution buffer
-    end_date = datetime.date.today() - datetime.timedelta(days=max(0, buffer_days))
-    start_date = end_date - datetime.timedelta(days=max(1, lookback_days) - 1)
+    end_date = _dt.date.today() - _dt.timedelta(days=max(0, buffer_days))
+    start_date = end_date - _dt.timedelta(days=max(1, lookback_days) - 1)
 
     # 2) tokens/headers/region
     region = os.environ.get("AMZN_REGION", "NA").upper()
@@ -453,7 +1384,7 @@ def sp_keywords_live(lookback_days: int = 14, buffer_days: int = 1, limit: int =
     headers = _ads_headers(access)
 
     # helper for dates
-    def _ymd(d: datetime.date) -> str:
+    def _ymd(d: _dt.date) -> str:
         return d.strftime("%Y-%m-%d")
 
     # 3) create report job (Reports v3)
@@ -477,87 +1408,29 @@ def sp_keywords_live(lookback_days: int = 14, buffer_days: int = 1, limit: int =
         }
     }
 
-    with httpx.Client(timeout=60) as client:
-        cr = client.post(f"{ads_base}/reporting/reports", headers=headers, json=create_body)
-
-        # normal: created
-        if 200 <= cr.status_code < 300:
-            report_id = cr.json().get("reportId")
-
-        # duplicate request: reuse existing report id from error detail (HTTP 425)
-        elif cr.status_code == 425:
-            try:
-                err = cr.json()
-                m = re.search(r"([0-9a-fA-F-]{36})", err.get("detail", ""))
-                report_id = m.group(1) if m else None
-            except Exception:
-                report_id = None
-
-        else:
-            return JSONResponse(
-                status_code=502,
-                content={
-                    "stage": "create_report",
-                    "status": cr.status_code,
-                    "body": cr.text,
-                    "endpoint": f"{ads_base}/reporting/reports",
-                    "payload": create_body,
-                },
-            )
-
-    if not report_id:
-        raise HTTPException(
-            status_code=502,
-            detail={"stage": "create_report", "error": "No reportId in response", "body": cr.text},
-        )
+    # reuses an identical in-flight report (cache or HTTP 425 duplicate)
+    report_id, _ = _request_report(ads_base, headers, create_body, priority="debug")
 
     # 4) poll until status=SUCCESS (configurable wait; default 5 min)
-    status_url = f"{ads_base}/reporting/reports/{report_id}"
     wait_seconds = int(os.environ.get("AMZN_REPORT_WAIT_SECONDS", "300"))  # 300s = 5 min
-    deadline = time.time() + wait_seconds
-
-    download_url = None
-    with httpx.Client(timeout=60) as client:
-        while time.time() < deadline:
-            sr = client.get(status_url, headers=headers)
-            if sr.status_code >= 400:
-                return JSONResponse(
-                    status_code=502,
-                    content={"stage": "check_report", "status": sr.status_code, "body": sr.text, "url": status_url},
-                )
-            s = sr.json()
-            if s.get("status") == "SUCCESS" and s.get("url"):
-                download_url = s["url"]
-                break
-            if s.get("status") in {"FAILURE", "CANCELLED"}:
-                return JSONResponse(status_code=502, content={"stage": "check_report", "status": "FAILED", "body": s})
-            time.sleep(3)
-
-    if not download_url:
-        return JSONResponse(status_code=504, content={"stage": "check_report", "status": "TIMEOUT", "url": status_url})
+    try:
+        download_url = _await_report(ads_base, headers, report_id, wait_seconds, priority="debug")["url"]
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content=e.detail)
 
     # 5) download and parse GZIP JSON lines
     with httpx.Client(timeout=120) as client:
         dr = client.get(download_url, headers=headers)
         if dr.status_code >= 400:
             return JSONResponse(status_code=502, content={"stage": "download", "status": dr.status_code, "body": dr.text})
-        buf = io.BytesIO(dr.content)
-        with gzip.GzipFile(fileobj=buf) as gz:
-            raw = gz.read().decode("utf-8")
+        raw = _gunzip_report(dr.content)
 
     # Each line is a JSON object (NDJSON)
     rows_out: List[KeywordRow] = []
     run_id = str(uuid.uuid4())
-    pulled_at = datetime.date.today()
+    pulled_at = _dt.date.today()
     count = 0
-    for line in raw.splitlines():
-        if not line.strip():
-            continue
-        try:
-            rec = json.loads(line)
-        except Exception:
-            continue
-
+    for rec in _iter_report_records(raw):
         campaign_id = str(rec.get("campaignId", ""))
         campaign_name = rec.get("campaignName", "")
         ad_group_id = str(rec.get("adGroupId", ""))
@@ -610,16 +1483,12 @@ def sp_keywords_live(lookback_days: int = 14, buffer_days: int = 1, limit: int =
 
     return rows_out
 
-from datetime import timedelta
-
 @app.post("/api/sp/keywords_start")
 def sp_keywords_start(lookback_days: int = 2):
     """
     Create a Sponsored Products Keywords DAILY report for the last `lookback_days`
     (ending yesterday). Returns a report_id immediately.
     """
-    import re
-
     # 1) date range (ending yesterday, no buffer)
     end_date = date.today() - timedelta(days=1)
     start_date = end_date - timedelta(days=max(1, lookback_days) - 1)
@@ -655,23 +1524,11 @@ def sp_keywords_start(lookback_days: int = 2):
         }
     }
 
-    # 4) call create; handle duplicate (HTTP 425)
-    with httpx.Client(timeout=60) as client:
-        cr = client.post(f"{ads_base}/reporting/reports", headers=headers, json=create_body)
-
-    if 200 <= cr.status_code < 300:
-        return {"report_id": cr.json().get("reportId")}
-
-    if cr.status_code == 425:
-        # detail looks like: "The Request is a duplicate of : <uuid>"
-        try:
-            rid = re.search(r"([0-9a-fA-F-]{36})", cr.json().get("detail","")).group(1)
-            return {"report_id": rid, "duplicate": True}
-        except Exception:
-            pass
-
-    # otherwise bubble up the error
-    raise HTTPException(status_code=cr.status_code, detail=cr.text)
+    # 4) create, or reuse an identical in-flight report (cache / HTTP 425 duplicate)
+    rid, source = _request_report(ads_base, headers, create_body, priority="debug")
+    if source == "created":
+        return {"report_id": rid}
+    return {"report_id": rid, "duplicate": True, "source": source}
 
 @app.get("/api/sp/report_status")
 def sp_report_status(report_id: str):
@@ -681,19 +1538,18 @@ def sp_report_status(report_id: str):
     ads_base = _ads_base(region)
     url = f"{ads_base}/reporting/reports/{report_id}"
 
-    with httpx.Client(timeout=60) as client:
-        r = client.get(url, headers=headers)
-        try:
-            r.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
-        return r.json()
+    r = _ads_request_with_refresh("GET", url, headers=headers, priority="debug")
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    meta = r.json()
+    _report_cache_update(report_id, meta)
+    return meta
 
 # ================================
 # SP SEARCH TERMS (Reports v3)
 # ================================
-from fastapi import Query
-import io, gzip, json as _json, uuid as _uuid, urllib.request
 
 @app.post("/api/sp/keywords_run")
 def sp_keywords_run(lookback_days: int = 2, background_tasks: BackgroundTasks = None):
@@ -736,20 +1592,8 @@ def sp_keywords_run(lookback_days: int = 2, background_tasks: BackgroundTasks =
         }
     }
 
-    with httpx.Client(timeout=60) as client:
-        cr = client.post(f"{ads_base}/reporting/reports", headers=headers, json=body)
-
-    # handle create + duplicate(425)
-    if 200 <= cr.status_code < 300:
-        rid = cr.json().get("reportId")
-    elif cr.status_code == 425:
-        import re
-        try:
-            rid = re.search(r"([0-9a-fA-F-]{36})", cr.json().get("detail","")).group(1)
-        except Exception:
-            raise HTTPException(status_code=425, detail=cr.text)
-    else:
-        raise HTTPException(status_code=cr.status_code, detail=cr.text)
+    # create, or reuse an identical in-flight report (cache / HTTP 425 duplicate)
+    rid, _ = _request_report(ads_base, headers, body, priority="debug")
 
     # kick background processor
     if background_tasks is not None:
@@ -757,22 +1601,127 @@ def sp_keywords_run(lookback_days: int = 2, background_tasks: BackgroundTasks =
 
     return {"report_id": rid, "status": "PROCESSING", "start": str(start_date), "end": str(end_date)}
 
-from datetime import date as _date
-from fastapi import Query
+
+# ---- server-side sort / filter shared by the range grids (keywords_range, st_range) ----
+_RANGE_SORT_COLUMNS = {
+    "date": "date", "campaign": "campaign_name", "ad_group": "ad_group_name",
+    "keyword": "keyword_text", "match_type": "match_type",
+    "impressions": "impressions", "clicks": "clicks", "spend": "cost",
+    "sales": "attributed_sales_14d", "orders": "attributed_conversions_14d",
+    "cpc": "cpc", "ctr": "ctr", "acos": "acos", "roas": "roas",
+}
+# appended to every ORDER BY so offset paging is stable (unique key of each table)
+_RANGE_TIEBREAK = {
+    "kw": "date DESC, keyword_id",
+    "st": "date DESC, ad_group_id, search_term, match_type",
+}
+_RANGE_TEXT_COLUMNS = {
+    "kw": ("campaign_name", "ad_group_name", "keyword_text"),
+    "st": ("campaign_name", "ad_group_name", "keyword_text", "search_term"),
+}
+
+# range page / count statements; {where} and {order} come from the helpers below.
+# Shared with /api/debug/explain_ranges so the plan benchmark runs the real queries.
+_RANGE_SELECT_SQL = {
+    "kw": """
+    SELECT
+      profile_id, date, keyword_id,
+      campaign_id, campaign_name, ad_group_id, ad_group_name,
+      keyword_text, match_type,
+      impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+      cpc, ctr, acos, roas,
+      run_id, pulled_at
+    FROM v_sp_keyword_daily
+    WHERE profile_id = :pid
+      AND date BETWEEN :start_d AND :end_d{where}
+    ORDER BY {order}
+    LIMIT :lim OFFSET :off
+    """,
+    "st": """
+    SELECT
+      date, campaign_name, ad_group_name,
+      search_term, keyword_text, match_type,
+      impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+      cpc, ctr, acos, roas, grain
+    FROM v_sp_search_term_all
+    WHERE profile_id = :pid
+      AND date BETWEEN :start_d AND :end_d{where}
+    ORDER BY {order}
+    LIMIT :lim OFFSET :off
+    """,
+}
+_RANGE_COUNT_SQL = {
+    kind: f"SELECT COUNT(*) FROM {fact} WHERE profile_id = :pid AND date BETWEEN :start_d AND :end_d{{where}}"
+    for kind, fact in (("kw", "fact_sp_keyword_daily"), ("st", "v_sp_search_term_all"))
+}
+_RANGE_DEFAULT_ORDER = {
+    "kw": "date DESC, campaign_name, ad_group_name, keyword_text",
+    "st": "date DESC, campaign_name, ad_group_name, search_term",
+}
+
+def _like_pattern(q: str) -> str:
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _range_order_sql(kind: str, sort: str | None, direction: str) -> str | None:
+    """ORDER BY for a whitelisted sort key, or None to keep the endpoint's default order."""
+    if not sort:
+        return None
+    cols = dict(_RANGE_SORT_COLUMNS, **({"search_term": "search_term"} if kind == "st" else {}))
+    if sort not in cols:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {sorted(cols)}")
+    d = "ASC" if direction == "asc" else "DESC"
+    return f"{cols[sort]} {d} NULLS LAST, {_RANGE_TIEBREAK[kind]}"
+
+def _range_filter_sql(kind: str, q: str | None, campaign_id: str | None, match_type: str | None) -> tuple[str, dict]:
+    """Extra AND-clauses (and their params) for the optional grid filters."""
+    clauses, params = [], {}
+    if q:
+        params["pattern"] = _like_pattern(q)
+        ors = " OR ".join(f"{c} ILIKE :pattern ESCAPE '\\'" for c in _RANGE_TEXT_COLUMNS[kind])
+        clauses.append(f"({ors})")
+    if campaign_id:
+        clauses.append("campaign_id = :campaign_id")
+        params["campaign_id"] = campaign_id
+    if match_type:
+        clauses.append("match_type = :match_type")
+        params["match_type"] = match_type.upper()
+    return "".join(f"\n      AND {c}" for c in clauses), params
+
+_KW_RANGE_COLUMNS = (
+    "date", "keyword_id", "campaign_id", "campaign_name", "ad_group_id", "ad_group_name",
+    "keyword_text", "match_type", "impressions", "clicks", "cost",
+    "attributed_sales_14d", "attributed_conversions_14d", "cpc", "ctr", "acos", "roas",
+)
+_ST_RANGE_COLUMNS = (
+    "date", "campaign_name", "ad_group_name", "search_term", "keyword_text", "match_type",
+    "impressions", "clicks", "cost", "attributed_sales_14d", "attributed_conversions_14d",
+    "cpc", "ctr", "acos", "roas", "grain",
+)
 
 @app.get("/api/sp/keywords_range", response_model=List[KeywordRow])
-def sp_keywords_range(
+async def sp_keywords_range(
+    response: Response,
     start: str,
     end: str,
     limit: int = Query(100, ge=1, le=1000),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    sort: str | None = None,
+    dir: str = Query("desc", pattern="^(asc|desc)$"),
+    q: str | None = Query(None, max_length=200),
+    campaign_id: str | None = None,
+    match_type: str | None = None,
+    with_total: bool = False,
+    format: str = Query("json", pattern="^(json|columnar|msgpack)$"),
 ):
     """
     Returns stored keyword-day rows between [start, end] (inclusive).
     Dates must be YYYY-MM-DD.
-    Supports pagination via limit & offset.
+    Supports pagination via limit & offset, sorting via sort/dir and filtering
+    via q (text match) / campaign_id / match_type. with_total=true adds the
+    matching row count as an X-Total-Count header. format=columnar|msgpack
+    returns flat table columns (see _columnar_response) instead of KeywordRow objects.
     """
-    if not engine:
+    if not async_engine:
         raise HTTPException(status_code=500, detail="Database not configured")
     profile_id = _env("AMZN_PROFILE_ID")
 
@@ -782,26 +1731,18 @@ def sp_keywords_range(
     except ValueError:
         raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
 
-    q = """
-    SELECT
-      profile_id, date, keyword_id,
-      campaign_id, campaign_name, ad_group_id, ad_group_name,
-      keyword_text, match_type,
-      impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-      cpc, ctr, acos, roas,
-      run_id, pulled_at
-    FROM fact_sp_keyword_daily
-    WHERE profile_id = :pid
-      AND date >= :start_d
-      AND date <= :end_d
-    ORDER BY date DESC, campaign_name, ad_group_name, keyword_text
-    LIMIT :lim OFFSET :off
-    """
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text(q),
-            {"pid": profile_id, "start_d": start_d, "end_d": end_d, "lim": limit, "off": offset},
-        ).mappings().all()
+    where, fparams = _range_filter_sql("kw", q, campaign_id, match_type)
+    order = _range_order_sql("kw", sort, dir) or _RANGE_DEFAULT_ORDER["kw"]
+    sql = _RANGE_SELECT_SQL["kw"].format(where=where, order=order)
+    params = {"pid": profile_id, "start_d": start_d, "end_d": end_d, "lim": limit, "off": offset, **fparams}
+    async with (await _read_engine()).connect() as conn:
+        rows = (await conn.execute(text(sql), params)).mappings().all()
+        if with_total:
+            total = (await conn.execute(text(_RANGE_COUNT_SQL["kw"].format(where=where)), params)).scalar()
+            response.headers["X-Total-Count"] = str(int(total or 0))
+
+    if format != "json":
+        return _columnar_response(rows, _KW_RANGE_COLUMNS, format, dict(response.headers))
 
     out: List[KeywordRow] = []
     for r in rows:
@@ -814,6 +1755,7 @@ def sp_keywords_range(
         out.append(KeywordRow(
             run_id=str(r["run_id"]),
             pulled_at=pulled_at_date,
+            report_date=r["date"],
             marketplace="",
             campaign_id=str(r["campaign_id"]),
             campaign_name=r["campaign_name"],
@@ -841,19 +1783,19 @@ def sp_keywords_range(
     return out
 
 @app.get("/api/debug/sp_counts")
-def sp_counts():
-    if not engine:
+async def sp_counts():
+    if not async_engine:
         raise HTTPException(status_code=500, detail="Database not configured")
     pid = _env("AMZN_PROFILE_ID")
-    with engine.begin() as conn:
-        rows = conn.execute(text("""
+    async with (await _read_engine()).connect() as conn:
+        rows = (await conn.execute(text("""
             SELECT date, COUNT(*) AS rows, SUM(clicks) AS clicks, SUM(cost) AS cost
             FROM fact_sp_keyword_daily
             WHERE profile_id = :pid
             GROUP BY date
             ORDER BY date DESC
             LIMIT 10
-        """), {"pid": pid}).mappings().all()
+        """), {"pid": pid})).mappings().all()
     out = []
     for r in rows:
         out.append({
@@ -864,53 +1806,23 @@ def sp_counts():
         })
     return out
 
-@app.post("/api/debug/create_st_table")
-def create_st_table():
-    """
-    Create the Sponsored Products Search Term daily fact table if it doesn't exist.
-    """
+@app.get("/api/debug/db_pool")
+def db_pool():
     if not engine:
         raise HTTPException(status_code=500, detail="Database not configured")
-
-    ddl = """
-    CREATE TABLE IF NOT EXISTS fact_sp_search_term_daily (
-      profile_id     text NOT NULL,
-      date           date NOT NULL,
-      -- grain: a search term performance row is scoped by campaign/ad_group/day
-      search_term    text NOT NULL,
-      keyword_id     text,
-      keyword_text   text,
-      match_type     text NOT NULL,
-
-      campaign_id    text NOT NULL,
-      campaign_name  text NOT NULL,
-      ad_group_id    text NOT NULL,
-      ad_group_name  text NOT NULL,
-
-      impressions    integer NOT NULL,
-      clicks         integer NOT NULL,
-      cost           numeric(18,4) NOT NULL,
-      attributed_sales_14d        numeric(18,4) NOT NULL,
-      attributed_conversions_14d  integer NOT NULL,
-
-      -- derived
-      cpc            numeric(18,6) NOT NULL,
-      ctr            numeric(18,6) NOT NULL,
-      acos           numeric(18,6) NOT NULL,
-      roas           numeric(18,6) NOT NULL,
-
-      run_id         uuid NOT NULL,
-      pulled_at      timestamptz NOT NULL DEFAULT now(),
-
-      CONSTRAINT uq_st_fact UNIQUE (profile_id, date, campaign_id, ad_group_id, search_term, match_type)
-    );
-    CREATE INDEX IF NOT EXISTS idx_st_profile_date ON fact_sp_search_term_daily(profile_id, date);
-    CREATE INDEX IF NOT EXISTS idx_st_term_date ON fact_sp_search_term_daily(search_term, date);
-    """
-    with engine.begin() as conn:
-        conn.exec_driver_sql(ddl)
-
-    return {"ok": True, "table": "fact_sp_search_term_daily"}
+    pools = [_pool_snapshot("primary", engine)]
+    if async_engine:
+        pools.append(_pool_snapshot("read_async", async_engine.sync_engine))
+    if replica_async_engine:
+        pools.append(_pool_snapshot("replica_async", replica_async_engine.sync_engine))
+    return {
+        "pgbouncer_mode": DB_PGBOUNCER,
+        "prepare_threshold": None if DB_PGBOUNCER else DB_PREPARE_THRESHOLD,
+        "pre_ping": DB_POOL_PRE_PING,
+        "recycle_secs": DB_POOL_RECYCLE_SECS,
+        "pools": pools,
+        "replica": {**REPLICA_STATE, "configured": bool(replica_async_engine), "max_lag_secs": READ_REPLICA_MAX_LAG_SECS},
+    }
 
 # --- DEBUG: list tables
 @app.get("/api/debug/tables")
@@ -928,8 +1840,6 @@ def list_tables():
 
 # --- DEBUG: safer st_counts (returns error details instead of 500)
 
-from fastapi.responses import JSONResponse
-
 @app.get("/api/debug/report_head")
 def debug_report_head(report_id: str):
     """Quick test: fetch first few rows from Amazon report without DB insert."""
@@ -940,44 +1850,30 @@ def debug_report_head(report_id: str):
 
     # 1) Get report status & presigned URL
     status_url = f"{ads_base}/reporting/reports/{report_id}"
-    with httpx.Client(timeout=60) as client:
-        r = client.get(status_url, headers=headers)
-        r.raise_for_status()
-        meta = r.json()
-        url = meta.get("url")
-        if not url:
-            return {"stage": "check_report", "meta": meta}
+    r = _ads_request_with_refresh("GET", status_url, headers=headers, priority="debug")
+    r.raise_for_status()
+    meta = r.json()
+    url = meta.get("url")
+    if not url:
+        return {"stage": "check_report", "meta": meta}
 
     # 2) Download with no headers
-    import urllib.request, gzip, io, json
     with urllib.request.urlopen(url, timeout=60) as resp:
         raw_bytes = resp.read()
 
     # 3) Gunzip if needed
-    try:
-        buf = io.BytesIO(raw_bytes)
-        with gzip.GzipFile(fileobj=buf) as gz:
-            raw_text = gz.read().decode("utf-8")
-    except OSError:
-        raw_text = raw_bytes.decode("utf-8", errors="ignore")
+    raw = _gunzip_report(raw_bytes)
 
     # 4) Return just first 5 lines/objects
     sample = []
-    for line in raw_text.splitlines():
-        if not line.strip():
-            continue
-        try:
-            sample.append(json.loads(line))
-        except Exception:
-            pass
+    for rec in _iter_report_records(raw):
+        sample.append(rec)
         if len(sample) >= 5:
             break
 
     return {"stage": "ok", "sample": sample}
 
 # PERMANENT INGEST: fetch & upsert (headerless S3 download, robust row mapping)
-from fastapi import Query
-import io, gzip, json as _json, uuid as _uuid, urllib.request
 
 @app.post("/api/sp/keywords_fetch")
 def sp_keywords_fetch(
@@ -994,20 +1890,19 @@ def sp_keywords_fetch(
     ads_base = _ads_base(region)
 
     status_url = f"{ads_base}/reporting/reports/{report_id}"
-    with httpx.Client(timeout=120) as client:
-        sr = client.get(status_url, headers=headers)
-        try:
-            sr.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(
-                status_code=502,
-                detail={"stage": "check_report", "status": e.response.status_code, "body": e.response.text},
-            )
-        meta = sr.json()
-        st = meta.get("status")
-        presigned_url = meta.get("url")
-        if st not in ("SUCCESS", "COMPLETED") or not presigned_url:
-            return JSONResponse(status_code=409, content={"stage": "check_report", "status": st, "meta": meta})
+    sr = _ads_request_with_refresh("GET", status_url, headers=headers, priority="debug")
+    try:
+        sr.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=502,
+            detail={"stage": "check_report", "status": e.response.status_code, "body": e.response.text},
+        )
+    meta = sr.json()
+    st = meta.get("status")
+    presigned_url = meta.get("url")
+    if st not in ("SUCCESS", "COMPLETED") or not presigned_url:
+        return JSONResponse(status_code=409, content={"stage": "check_report", "status": st, "meta": meta})
 
     # 2) download presigned S3 URL with ZERO headers
     try:
@@ -1019,84 +1914,21 @@ def sp_keywords_fetch(
             detail={"stage": "download", "status": 400, "body": f"urllib error: {e!r}"},
         )
 
-        # 3) gunzip (or fallback to plain)
-    try:
-        buf = io.BytesIO(raw_bytes)
-        with gzip.GzipFile(fileobj=buf) as gz:
-            raw_text = gz.read().decode("utf-8")
-    except OSError:
-        raw_text = raw_bytes.decode("utf-8", errors="ignore")
+    # 3) gunzip (or fallback to plain)
+    raw = _gunzip_report(raw_bytes)
 
     # --- DEBUG: log a small prefix so we know the shape ---
     try:
-        print("[fetch_debug] size_bytes=", len(raw_text), "prefix=", raw_text[:600].replace("\n","\\n")[:600])
+        print("[fetch_debug] size_bytes=", len(raw), "prefix=", raw[:600].decode("utf-8", errors="ignore").replace("\n","\\n")[:600])
     except Exception:
         pass
 
     # 4) iterate records from multiple possible shapes
-    import json as _json
-
-    def extract_records(obj):
-        """Yield dict records from a loaded JSON object that might be:
-           - a list of dicts
-           - a dict with a key that holds a list of dicts
-           - a single dict record
-        """
-        if isinstance(obj, list):
-            for item in obj:
-                if isinstance(item, dict):
-                    yield item
-        elif isinstance(obj, dict):
-            # common wrappers
-            for k in ("records", "rows", "data", "report", "result", "items"):
-                v = obj.get(k)
-                if isinstance(v, list):
-                    for item in v:
-                        if isinstance(item, dict):
-                            yield item
-                    return
-                # sometimes nested like {"report": {"records":[...]}}
-                if isinstance(v, dict):
-                    for kk in ("records", "rows", "data", "items"):
-                        vv = v.get(kk)
-                        if isinstance(vv, list):
-                            for item in vv:
-                                if isinstance(item, dict):
-                                    yield item
-                            return
-            # if it's just a single record dict
-            yield obj
-
-    def iter_records(text: str):
-        # Try NDJSON first (fast path)
-        out = []
-        for line in text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = _json.loads(line)
-            except Exception:
-                # if any line is not JSON, bail from NDJSON path
-                out = []
-                break
-            # Expand possible wrappers per line
-            out.extend(list(extract_records(obj)))
-        if out:
-            return out
-
-        # Fallback: whole-text JSON
-        try:
-            obj = _json.loads(text)
-            return list(extract_records(obj))
-        except Exception:
-            return []
-
-    records = iter_records(raw_text)
+    records = list(_iter_report_records(raw))
     if not records:
         raise HTTPException(
             status_code=502,
-            detail={"stage": "parse", "body_prefix": raw_text[:600]}
+            detail={"stage": "parse", "body_prefix": raw[:600].decode("utf-8", errors="ignore")}
         )
 
     # 5) upsert
@@ -1110,7 +1942,6 @@ def sp_keywords_fetch(
             campaign_id, campaign_name, ad_group_id, ad_group_name,
             keyword_text, match_type,
             impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-            cpc, ctr, acos, roas,
             run_id, pulled_at
         )
         VALUES (
@@ -1118,7 +1949,6 @@ def sp_keywords_fetch(
             :campaign_id, :campaign_name, :ad_group_id, :ad_group_name,
             :keyword_text, :match_type,
             :impressions, :clicks, :cost, :sales, :orders,
-            :cpc, :ctr, :acos, :roas,
             :run_id, now()
         )
         ON CONFLICT (profile_id, date, keyword_id) DO UPDATE SET
@@ -1133,15 +1963,12 @@ def sp_keywords_fetch(
             cost = EXCLUDED.cost,
             attributed_sales_14d = EXCLUDED.attributed_sales_14d,
             attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
-            cpc = EXCLUDED.cpc,
-            ctr = EXCLUDED.ctr,
-            acos = EXCLUDED.acos,
-            roas = EXCLUDED.roas,
             run_id = EXCLUDED.run_id,
             pulled_at = now()
         RETURNING xmax = 0 AS inserted_flag
     """)
 
+    loaded_dates = set()
     with engine.begin() as conn:
         for rec in records:
             # map fields
@@ -1165,10 +1992,6 @@ def sp_keywords_fetch(
                 "sales": float(rec.get("attributedSales14d") or 0.0),
                 "orders": int(rec.get("attributedConversions14d") or 0),
             }
-            d["cpc"]  = round(d["cost"] / d["clicks"], 6) if d["clicks"] else 0.0
-            d["ctr"]  = round(d["clicks"] / d["impressions"], 6) if d["impressions"] else 0.0
-            d["acos"] = round(d["cost"] / d["sales"], 6) if d["sales"] else 0.0
-            d["roas"] = round(d["sales"] / d["cost"], 6) if d["cost"] else 0.0
             d["run_id"] = run_id
 
             res = conn.execute(upsert_sql, d).first()
@@ -1176,11 +1999,15 @@ def sp_keywords_fetch(
                 inserted += 1
             else:
                 updated += 1
+            loaded_dates.add(date_str)
 
             processed += 1
             if processed >= limit:
                 break
 
+        if loaded_dates:
+            _refresh_coverage(conn, pid, "kw", min(loaded_dates), max(loaded_dates), run_id)
+
     return {"report_id": report_id, "processed": processed, "inserted": inserted, "updated": updated}
 
 # ===============================
@@ -1193,9 +2020,6 @@ def sp_search_terms_start(lookback_days: int = 2):
     Create a Sponsored Products Search Terms DAILY report (ending yesterday).
     Returns a report_id immediately (or an existing one if it's a duplicate request).
     """
-    import re
-    from datetime import date, timedelta
-    import httpx
 
     # 1) date range (ending yesterday)
     end_date = date.today() - timedelta(days=1)
@@ -1233,21 +2057,11 @@ def sp_search_terms_start(lookback_days: int = 2):
         }
     }
 
-    # 4) create report; handle duplicate (HTTP 425) gracefully
-    with httpx.Client(timeout=60) as client:
-        cr = client.post(f"{ads_base}/reporting/reports", headers=headers, json=create_body)
-
-    if 200 <= cr.status_code < 300:
-        return {"report_id": cr.json().get("reportId")}
-
-    if cr.status_code == 425:
-        try:
-            rid = re.search(r"([0-9a-fA-F-]{36})", cr.json().get("detail", "")).group(1)
-            return {"report_id": rid, "duplicate": True}
-        except Exception:
-            pass
-
-    raise HTTPException(status_code=cr.status_code, detail=cr.text)
+    # 4) create report, or reuse an identical in-flight one (cache / HTTP 425 duplicate)
+    rid, source = _request_report(ads_base, headers, create_body, priority="debug")
+    if source == "created":
+        return {"report_id": rid}
+    return {"report_id": rid, "duplicate": True, "source": source}
 
 @app.post("/api/sp/st_run")
 def sp_search_terms_run(lookback_days: int = 2, background_tasks: BackgroundTasks = None):
@@ -1261,9 +2075,6 @@ def sp_search_terms_run(lookback_days: int = 2, background_tasks: BackgroundTask
     return {"report_id": rid, "status": "PROCESSING"}
 
 def _process_st_report_in_bg(report_id: str):
-    import io, gzip, time, datetime as dt, json as _json
-    import uuid, httpx
-    from sqlalchemy import text as _text
 
     try:
         # --- auth / region / endpoints ---
@@ -1273,28 +2084,11 @@ def _process_st_report_in_bg(report_id: str):
         ads_base = _ads_base(region)
 
         # --- poll for SUCCESS & get presigned URL ---
-        status_url = f"{ads_base}/reporting/reports/{report_id}"
-        deadline = time.time() + int(os.environ.get("AMZN_REPORT_BG_MAX_SECONDS", "900"))  # 15m
-
-        download_url = None
-        with httpx.Client(timeout=60) as client:
-            while time.time() < deadline:
-                sr = client.get(status_url, headers=headers)
-                if sr.status_code >= 400:
-                    print("[st_status_error]", sr.status_code, sr.text)
-                    return
-                meta = sr.json()
-                st = meta.get("status")
-                if st in ("SUCCESS", "COMPLETED") and meta.get("url"):
-                    download_url = meta["url"]
-                    break
-                if st in {"FAILURE", "CANCELLED"}:
-                    print("[st_failed]", meta)
-                    return
-                time.sleep(20)
-
-        if not download_url:
-            print("[st_timeout]", status_url)
+        max_wait = int(os.environ.get("AMZN_REPORT_BG_MAX_SECONDS", "900"))  # 15m
+        try:
+            download_url = _await_report(ads_base, headers, report_id, max_wait, priority="debug")["url"]
+        except HTTPException as e:
+            print("[st_status_error]", e.status_code, e.detail)
             return
 
         # --- download with ZERO headers (presigned S3) ---
@@ -1304,24 +2098,14 @@ def _process_st_report_in_bg(report_id: str):
             return
 
         # --- gunzip (or fallback to plain text) ---
-        try:
-            buf = io.BytesIO(dr.content)
-            with gzip.GzipFile(fileobj=buf) as gz:
-                raw_text = gz.read().decode("utf-8")
-        except OSError:
-            raw_text = dr.content.decode("utf-8", errors="ignore")
+        raw = _gunzip_report(dr.content)
 
-        # --- parse lines ---
+        # --- parse records ---
         pid = _env("AMZN_PROFILE_ID")
         run_id = str(uuid.uuid4())
         rows = []
 
-        for line in raw_text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            rec = _json.loads(line)
-
+        for rec in _iter_report_records(raw):
             ds = (rec.get("date") or rec.get("reportDate") or "")[:10]
             if not ds:
                 continue
@@ -1341,11 +2125,6 @@ def _process_st_report_in_bg(report_id: str):
             sales = float(rec.get("sales14d") or 0.0)
             orders = int(rec.get("purchases14d") or 0)
 
-            cpc  = round(cost / clicks, 6) if clicks else 0.0
-            ctr  = round(clicks / impressions, 6) if impressions else 0.0
-            acos = round(cost / sales, 6) if sales else 0.0
-            roas = round(sales / cost, 6) if cost else 0.0
-
             rows.append({
                 "profile_id": pid,
                 "date": ds,
@@ -1362,16 +2141,15 @@ def _process_st_report_in_bg(report_id: str):
                 "cost": cost,
                 "attributed_sales_14d": sales,
                 "attributed_conversions_14d": orders,
-                "cpc": cpc,
-                "ctr": ctr,
-                "acos": acos,
-                "roas": roas,
                 "run_id": run_id,
             })
 
         if not engine:
             print("[st_no_rows_or_db] no engine")
             return
+        rows, skipped = _drop_compacted_rows(rows)
+        if skipped:
+            print(f"[st_report] {report_id} skipped {skipped} rows of already-compacted days")
         if not rows:
             print("[st_no_rows_or_db] 0 rows")
             return
@@ -1383,14 +2161,14 @@ def _process_st_report_in_bg(report_id: str):
                 campaign_id, campaign_name, ad_group_id, ad_group_name,
                 search_term, keyword_id, keyword_text, match_type,
                 impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-                cpc, ctr, acos, roas, run_id, pulled_at
+                run_id, pulled_at
             )
             VALUES (
                 :profile_id, :date,
                 :campaign_id, :campaign_name, :ad_group_id, :ad_group_name,
                 :search_term, :keyword_id, :keyword_text, :match_type,
                 :impressions, :clicks, :cost, :attributed_sales_14d, :attributed_conversions_14d,
-                :cpc, :ctr, :acos, :roas, :run_id, now()
+                :run_id, now()
             )
             ON CONFLICT (profile_id, date, ad_group_id, search_term, match_type) DO UPDATE SET
                 campaign_id = EXCLUDED.campaign_id,
@@ -1405,16 +2183,15 @@ def _process_st_report_in_bg(report_id: str):
                 cost = EXCLUDED.cost,
                 attributed_sales_14d = EXCLUDED.attributed_sales_14d,
                 attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
-                cpc = EXCLUDED.cpc,
-                ctr = EXCLUDED.ctr,
-                acos = EXCLUDED.acos,
-                roas = EXCLUDED.roas,
                 run_id = EXCLUDED.run_id,
                 pulled_at = now()
         """)
 
         with engine.begin() as conn:
+            _log_st_map_changes(conn, pid, rows, run_id)
             conn.execute(upsert_sql, rows)
+            _touch_st_dim(conn, pid, rows)
+            _refresh_coverage_for_rows(conn, pid, "st", rows, run_id)
 
         print(f"[st_report_done] {report_id} rows={len(rows)}")
 
@@ -1423,9 +2200,216 @@ def _process_st_report_in_bg(report_id: str):
         print("[st_bg_error]", e)
         traceback.print_exc()
         
+# ---- search-term dimension + search ----
+_ST_DIM_UPSERT_SQL = text("""
+    INSERT INTO dim_sp_search_term (profile_id, search_term, first_seen, last_seen)
+    SELECT :pid, t.search_term, t.first_seen, t.last_seen
+    FROM unnest(CAST(:terms AS text[]), CAST(:firsts AS date[]), CAST(:lasts AS date[]))
+         AS t(search_term, first_seen, last_seen)
+    ON CONFLICT (profile_id, search_term) DO UPDATE SET
+      first_seen = LEAST(dim_sp_search_term.first_seen, EXCLUDED.first_seen),
+      last_seen  = GREATEST(dim_sp_search_term.last_seen, EXCLUDED.last_seen)
+""")
+
+# Keyword-mapping history: same rows the old AFTER UPDATE trigger logged (an existing
+# fact row whose keyword_id/keyword_text changes), but one INSERT ... SELECT per load.
+# Must run before the upsert, while the old mapping is still in place.
+_ST_MAP_HISTORY_SQL = """
+    INSERT INTO fact_sp_search_term_map_history (
+      profile_id, date, campaign_id, ad_group_id, search_term, match_type,
+      old_keyword_id, old_keyword_text, new_keyword_id, new_keyword_text,
+      run_id
+    )
+    SELECT
+      f.profile_id, s.date, s.campaign_id, s.ad_group_id, s.search_term, s.match_type,
+      f.keyword_id, f.keyword_text, s.keyword_id, s.keyword_text,
+      CAST(:run_id AS uuid)
+    FROM ({source}) s
+    JOIN fact_sp_search_term_daily f
+      ON f.profile_id = :pid
+     AND f.date = s.date
+     AND f.ad_group_id = s.ad_group_id
+     AND f.search_term = s.search_term
+     AND f.match_type = s.match_type
+    WHERE COALESCE(f.keyword_id,   '') IS DISTINCT FROM COALESCE(s.keyword_id,   '')
+       OR COALESCE(f.keyword_text, '') IS DISTINCT FROM COALESCE(s.keyword_text, '')
+"""
+
+_ST_MAP_HISTORY_FROM_ROWS_SQL = text(_ST_MAP_HISTORY_SQL.format(source="""
+    SELECT * FROM unnest(
+      CAST(:dates AS date[]), CAST(:campaign_ids AS text[]), CAST(:ad_group_ids AS text[]),
+      CAST(:terms AS text[]), CAST(:match_types AS text[]),
+      CAST(:keyword_ids AS text[]), CAST(:keyword_texts AS text[])
+    ) AS t(date, campaign_id, ad_group_id, search_term, match_type, keyword_id, keyword_text)
+"""))
+
+def _log_st_map_changes(conn, pid: str, rows, run_id: str) -> None:
+    """Record keyword-mapping changes that upserting `rows` is about to make (last row per key wins)."""
+    latest = {}
+    for r in rows:
+        if r.get("date"):
+            latest[(r["date"], r["ad_group_id"], r["search_term"], r["match_type"])] = r
+    if not latest:
+        return
+    rs = list(latest.values())
+    conn.execute(_ST_MAP_HISTORY_FROM_ROWS_SQL, {
+        "pid": pid, "run_id": run_id,
+        "dates": [r["date"] for r in rs],
+        "campaign_ids": [r["campaign_id"] for r in rs],
+        "ad_group_ids": [r["ad_group_id"] for r in rs],
+        "terms": [r["search_term"] for r in rs],
+        "match_types": [r["match_type"] for r in rs],
+        "keyword_ids": [r.get("keyword_id") for r in rs],
+        "keyword_texts": [r.get("keyword_text") for r in rs],
+    })
+
+def _touch_st_dim(conn, pid: str, rows) -> None:
+    """Record the search terms of freshly upserted rows (with their date span) in dim_sp_search_term."""
+    spans = {}
+    for r in rows:
+        term, ds = r["search_term"], r["date"]
+        if not term or not ds:
+            continue
+        span = spans.get(term)
+        if span is None:
+            spans[term] = [ds, ds]
+        elif ds < span[0]:
+            span[0] = ds
+        elif ds > span[1]:
+            span[1] = ds
+    if not spans:
+        return
+    terms = list(spans)
+    conn.execute(_ST_DIM_UPSERT_SQL, {
+        "pid": pid,
+        "terms": terms,
+        "firsts": [spans[t][0] for t in terms],
+        "lasts": [spans[t][1] for t in terms],
+    })
+
+ST_SEARCH_FUZZY_CAP = int(os.environ.get("ST_SEARCH_FUZZY_CAP", "5000"))
+
+_ST_SEARCH_ORDER = {
+    "spend": "cost DESC",
+    "sales": "sales_14d DESC",
+    "orders": "orders_14d DESC",
+    "clicks": "clicks DESC",
+    "acos": "acos DESC NULLS LAST, cost DESC",
+    "acos_asc": "acos ASC NULLS LAST, sales_14d DESC",
+    "relevance": "score DESC, cost DESC",
+}
+
+@app.get("/api/sp/st_search")
+async def sp_search_terms_search(
+    q: str = Query(..., min_length=2, max_length=200),
+    start: str = Query(...),
+    end: str = Query(...),
+    mode: str = Query("substring", pattern="^(substring|fuzzy)$"),
+    sort: str = Query("spend"),
+    min_similarity: float = Query(0.4, ge=0.05, le=1.0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Find search terms containing (mode=substring) or resembling (mode=fuzzy) `q`,
+    aggregated over [start, end] and ranked by `sort`
+    (spend | sales | orders | clicks | acos | acos_asc | relevance).
+    Matching runs against the trigram-indexed dim_sp_search_term; only the
+    matched terms are then aggregated from v_sp_search_term_all (daily + compact tier).
+    """
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    if sort not in _ST_SEARCH_ORDER:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {sorted(_ST_SEARCH_ORDER)}")
+    pid = _env("AMZN_PROFILE_ID")
+    try:
+        start_d = _dt.date.fromisoformat(start)
+        end_d = _dt.date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+
+    # substring matches all score 1.0, so every match is aggregated and ranked by `sort`;
+    # fuzzy mode keeps only the ST_SEARCH_FUZZY_CAP most similar terms (ties broken by term)
+    if mode == "substring":
+        pattern = _like_pattern(q)
+        match_sql = "d.search_term ILIKE :pattern ESCAPE '\\'"
+        score_sql = "1.0"
+        cap_sql = ""
+    else:
+        pattern = None
+        match_sql = ":q <% d.search_term"
+        score_sql = "word_similarity(:q, d.search_term)"
+        cap_sql = f"ORDER BY score DESC, d.search_term LIMIT {ST_SEARCH_FUZZY_CAP}"
+
+    sql = text(f"""
+        WITH terms AS (
+            SELECT d.search_term, {score_sql} AS score
+            FROM dim_sp_search_term d
+            WHERE d.profile_id = :pid
+              AND d.last_seen >= :start_d
+              AND d.first_seen <= :end_d
+              AND {match_sql}
+            {cap_sql}
+        )
+        SELECT f.search_term,
+               MAX(t.score) AS score,
+               SUM(f.impressions) AS impressions,
+               SUM(f.clicks) AS clicks,
+               SUM(f.cost) AS cost,
+               SUM(f.attributed_sales_14d) AS sales_14d,
+               SUM(f.attributed_conversions_14d) AS orders_14d,
+               SUM(f.cost) / NULLIF(SUM(f.attributed_sales_14d), 0) AS acos,
+               COUNT(DISTINCT f.ad_group_id) AS ad_groups
+        FROM terms t
+        JOIN v_sp_search_term_all f
+          ON f.search_term = t.search_term
+         AND f.profile_id = :pid
+         AND f.date BETWEEN :start_d AND :end_d
+        GROUP BY f.search_term
+        ORDER BY {_ST_SEARCH_ORDER[sort]}, f.search_term
+        LIMIT :lim
+    """)
+    params = {"pid": pid, "q": q, "pattern": pattern, "start_d": start_d, "end_d": end_d, "lim": limit}
+    async with (await _read_engine()).connect() as conn:
+        if mode == "fuzzy":
+            await conn.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :th, true)"),
+                               {"th": str(min_similarity)})
+        rows = (await conn.execute(sql, params)).mappings().all()
+
+    return [{
+        "search_term": r["search_term"],
+        "score": float(r["score"]),
+        "impressions": int(r["impressions"] or 0),
+        "clicks": int(r["clicks"] or 0),
+        "cost": float(r["cost"] or 0),
+        "sales_14d": float(r["sales_14d"] or 0),
+        "orders_14d": int(r["orders_14d"] or 0),
+        "acos": float(r["acos"]) if r["acos"] is not None else None,
+        "ad_groups": int(r["ad_groups"]),
+    } for r in rows]
+
 @app.get("/api/sp/st_range")
-def sp_search_terms_range(start: str, end: str, limit: int = 1000):
-    if not engine:
+async def sp_search_terms_range(
+    response: Response,
+    start: str,
+    end: str,
+    limit: int = Query(1000, ge=1, le=5000),
+    offset: int = Query(0, ge=0),
+    sort: str | None = None,
+    dir: str = Query("desc", pattern="^(asc|desc)$"),
+    q: str | None = Query(None, max_length=200),
+    campaign_id: str | None = None,
+    match_type: str | None = None,
+    with_total: bool = False,
+    format: str = Query("json", pattern="^(json|columnar|msgpack)$"),
+):
+    """
+    Search-term rows for [start, end]; same paging / sort / filter / format params as keywords_range.
+    Dates older than the retention window come back as compacted rows (grain week / month, dated at
+    the period start); everywhere else grain is 'day'. A range reaching into the compacted tier is
+    widened to whole periods; the range actually served is in X-Range-Start / X-Range-End, with
+    X-Compacted-Periods: 1.
+    """
+    if not async_engine:
         raise HTTPException(status_code=500, detail="Database not configured")
 
     pid = _env("AMZN_PROFILE_ID")
@@ -1437,30 +2421,94 @@ def sp_search_terms_range(start: str, end: str, limit: int = 1000):
     except ValueError:
         raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
 
-    q = text("""
-        SELECT
-            date, campaign_name, ad_group_name,
-            search_term, keyword_text, match_type,
-            impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-            cpc, ctr, acos, roas
-        FROM fact_sp_search_term_daily
-        WHERE profile_id = :pid
-          AND date BETWEEN :start_d AND :end_d
-        ORDER BY date DESC, campaign_name, ad_group_name, search_term
-        LIMIT :lim
-    """)
+    where, fparams = _range_filter_sql("st", q, campaign_id, match_type)
+    order = _range_order_sql("st", sort, dir) or _RANGE_DEFAULT_ORDER["st"]
+    sql = text(_RANGE_SELECT_SQL["st"].format(where=where, order=order))
+
+    async with (await _read_engine()).connect() as conn:
+        start_d, end_d, snapped = _snap_to_compact_periods(start_d, end_d, *await _retention_window(conn))
+        if snapped:
+            response.headers["X-Range-Start"] = start_d.isoformat()
+            response.headers["X-Range-End"] = end_d.isoformat()
+            response.headers["X-Compacted-Periods"] = "1"
+        params = {"pid": pid, "start_d": start_d, "end_d": end_d, "lim": limit, "off": offset, **fparams}
+        rows = (await conn.execute(sql, params)).mappings().all()
+        if with_total:
+            total = (await conn.execute(text(_RANGE_COUNT_SQL["st"].format(where=where)), params)).scalar()
+            response.headers["X-Total-Count"] = str(int(total or 0))
+
+    if format != "json":
+        return _columnar_response(rows, _ST_RANGE_COLUMNS, format, dict(response.headers))
+    return [dict(r) for r in rows]  # ← inside function now
 
-    with engine.begin() as conn:  # ← inside function now
-        rows = conn.execute(
-            q, {"pid": pid, "start_d": start_d, "end_d": end_d, "lim": limit}
-        ).mappings().all()
+def _plan_summary(plan: dict) -> dict:
+    """Flatten an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) result into the numbers that matter."""
+    nodes, heap_fetches = [], 0
 
-    return [dict(r) for r in rows]  # ← inside function now
+    def walk(n):
+        nonlocal heap_fetches
+        nodes.append(n["Node Type"] + (f" using {n['Index Name']}" if n.get("Index Name") else ""))
+        heap_fetches += int(n.get("Heap Fetches", 0))
+        for child in n.get("Plans", []):
+            walk(child)
+
+    root = plan["Plan"]
+    walk(root)
+    return {
+        "execution_ms": plan.get("Execution Time"),
+        "planning_ms": plan.get("Planning Time"),
+        "nodes": nodes,
+        "heap_fetches": heap_fetches,
+        "shared_hit_blocks": root.get("Shared Hit Blocks"),
+        "shared_read_blocks": root.get("Shared Read Blocks"),
+    }
+
+@app.get("/api/debug/explain_ranges")
+def debug_explain_ranges(
+    start: str,
+    end: str,
+    sort: str | None = None,
+    dir: str = Query("desc", pattern="^(asc|desc)$"),
+    q: str | None = Query(None, max_length=200),
+    limit: int = Query(200, ge=1, le=5000),
+):
+    """
+    Plan benchmark for the range grid: EXPLAIN ANALYZE of the page and count
+    queries of keywords_range / st_range exactly as the endpoints build them.
+    "heap" repeats each with index-only scans disabled, i.e. the plan shape
+    before the covering indexes (migrations 7 and 8), for a before/after comparison.
+    """
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    try:
+        start_d = _date.fromisoformat(start)
+        end_d = _date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+    pid = _env("AMZN_PROFILE_ID")
+    out = {}
+    for kind in ("kw", "st"):
+        where, fparams = _range_filter_sql(kind, q, None, None)
+        order = _range_order_sql(kind, sort, dir) or _RANGE_DEFAULT_ORDER[kind]
+        params = {"pid": pid, "start_d": start_d, "end_d": end_d, "lim": limit, "off": 0, **fparams}
+        queries = {
+            "page": _RANGE_SELECT_SQL[kind].format(where=where, order=order),
+            "count": _RANGE_COUNT_SQL[kind].format(where=where),
+        }
+        out[kind] = {}
+        for name, sql in queries.items():
+            out[kind][name] = {}
+            for variant in ("covering", "heap"):
+                with engine.begin() as conn:
+                    if variant == "heap":
+                        conn.exec_driver_sql("SET LOCAL enable_indexonlyscan = off")
+                    plan = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql), params).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                out[kind][name][variant] = _plan_summary(plan[0])
+    return {"start": start, "end": end, "sort": sort or "default", "q": q, "plans": out}
 
 # ---- SP SEARCH TERMS: fetch & upsert (sync) ----
-from fastapi import Query
-import io, gzip, json as _json, uuid as _uuid, urllib.request
-from sqlalchemy import text as _text
 
 @app.post("/api/sp/st_fetch")
 def sp_search_terms_fetch(
@@ -1477,24 +2525,23 @@ def sp_search_terms_fetch(
     ads_base = _ads_base(region)
 
     status_url = f"{ads_base}/reporting/reports/{report_id}"
-    with httpx.Client(timeout=120) as client:
-        r = client.get(status_url, headers=headers)
-        try:
-            r.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=502, detail={
-                "stage": "check_report",
-                "status": e.response.status_code,
-                "body": e.response.text
-            })
-        meta = r.json()
-        st = meta.get("status")
-        url = meta.get("url")
-        if st not in ("SUCCESS", "COMPLETED") or not url:
-            return JSONResponse(
-                status_code=409,
-                content={"stage": "check_report", "status": st, "meta": meta}
-            )
+    r = _ads_request_with_refresh("GET", status_url, headers=headers, priority="debug")
+    try:
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail={
+            "stage": "check_report",
+            "status": e.response.status_code,
+            "body": e.response.text
+        })
+    meta = r.json()
+    st = meta.get("status")
+    url = meta.get("url")
+    if st not in ("SUCCESS", "COMPLETED") or not url:
+        return JSONResponse(
+            status_code=409,
+            content={"stage": "check_report", "status": st, "meta": meta}
+        )
 
     # 2) download file
     try:
@@ -1508,30 +2555,7 @@ def sp_search_terms_fetch(
         })
 
     # 3) gunzip fallback
-    try:
-        buf = io.BytesIO(raw_bytes)
-        with gzip.GzipFile(fileobj=buf) as gz:
-            raw_text = gz.read().decode("utf-8")
-    except OSError:
-        raw_text = raw_bytes.decode("utf-8", errors="ignore")
-
-    # 4) iterator
-    def iter_records(text: str):
-        any_yield = False
-        for line in text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            any_yield = True
-            yield _json.loads(line)
-        if not any_yield:
-            try:
-                arr = _json.loads(text)
-                if isinstance(arr, list):
-                    for obj in arr:
-                        yield obj
-            except Exception:
-                pass
+    raw = _gunzip_report(raw_bytes)
 
     # 5) upsert
     pid = _env("AMZN_PROFILE_ID")
@@ -1544,7 +2568,6 @@ def sp_search_terms_fetch(
         campaign_id, campaign_name, ad_group_id, ad_group_name,
         search_term, keyword_id, keyword_text, match_type,
         impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-        cpc, ctr, acos, roas,
         run_id, pulled_at
     )
     VALUES (
@@ -1552,10 +2575,9 @@ def sp_search_terms_fetch(
         :campaign_id, :campaign_name, :ad_group_id, :ad_group_name,
         :search_term, :keyword_id, :keyword_text, :match_type,
         :impressions, :clicks, :cost, :attributed_sales_14d, :attributed_conversions_14d,
-        :cpc, :ctr, :acos, :roas,
         :run_id, now()
     )
-    ON CONFLICT (profile_id, date, campaign_id,  ad_group_id, search_term, match_type) DO UPDATE SET
+    ON CONFLICT (profile_id, date, ad_group_id, search_term, match_type) DO UPDATE SET
         campaign_id = EXCLUDED.campaign_id,
         campaign_name = EXCLUDED.campaign_name,
         ad_group_id = EXCLUDED.ad_group_id,
@@ -1568,170 +2590,214 @@ def sp_search_terms_fetch(
         cost = EXCLUDED.cost,
         attributed_sales_14d = EXCLUDED.attributed_sales_14d,
         attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
-        cpc = EXCLUDED.cpc,
-        ctr = EXCLUDED.ctr,
-        acos = EXCLUDED.acos,
-        roas = EXCLUDED.roas,
         run_id = EXCLUDED.run_id,
         pulled_at = now()
     RETURNING xmax = 0 AS inserted_flag
 """)
 
+    loaded = []
     with engine.begin() as conn:  # ← inside function now
-        for rec in iter_records(raw_text):
-            items = rec if isinstance(rec, list) else [rec]
-            for obj in items:
-                if not isinstance(obj, dict):
-                    continue
-                d = {
-                    "profile_id": pid,
-                    "date": (obj.get("date") or "")[:10],
-                    "campaign_id": str(obj.get("campaignId") or ""),
-                    "campaign_name": obj.get("campaignName") or "",
-                    "ad_group_id": str(obj.get("adGroupId") or ""),
-                    "ad_group_name": obj.get("adGroupName") or "",
-                    "search_term": obj.get("searchTerm") or "",
-                    "keyword_id": (str(obj.get("keywordId") or "") or None),
-                    "keyword_text": obj.get("keywordText") or None,
-                    "match_type": obj.get("matchType") or "",
-                    "impressions": int(obj.get("impressions") or 0),
-                    "clicks": int(obj.get("clicks") or 0),
-                    "cost": float(obj.get("cost") or 0.0),
-                    "attributed_sales_14d": float(obj.get("sales14d") or 0.0),
-                    "attributed_conversions_14d": int(obj.get("purchases14d") or 0),
-                    "run_id": run_id,
-                }
-                d["cpc"]  = round(d["cost"] / d["clicks"], 6) if d["clicks"] else 0.0
-                d["ctr"]  = round(d["clicks"] / d["impressions"], 6) if d["impressions"] else 0.0
-                d["acos"] = round(d["cost"] / d["attributed_sales_14d"], 6) if d["attributed_sales_14d"] else 0.0
-                d["roas"] = round(d["attributed_sales_14d"] / d["cost"], 6) if d["cost"] else 0.0
-
-                res = conn.execute(upsert_sql, d).first()
-                if res and res[0] is True:
-                    inserted += 1
-                else:
-                    updated += 1
+        for obj in _iter_report_records(raw):
+            d = {
+                "profile_id": pid,
+                "date": (obj.get("date") or "")[:10],
+                "campaign_id": str(obj.get("campaignId") or ""),
+                "campaign_name": obj.get("campaignName") or "",
+                "ad_group_id": str(obj.get("adGroupId") or ""),
+                "ad_group_name": obj.get("adGroupName") or "",
+                "search_term": obj.get("searchTerm") or "",
+                "keyword_id": (str(obj.get("keywordId") or "") or None),
+                "keyword_text": obj.get("keywordText") or None,
+                "match_type": obj.get("matchType") or "",
+                "impressions": int(obj.get("impressions") or 0),
+                "clicks": int(obj.get("clicks") or 0),
+                "cost": float(obj.get("cost") or 0.0),
+                "attributed_sales_14d": float(obj.get("sales14d") or 0.0),
+                "attributed_conversions_14d": int(obj.get("purchases14d") or 0),
+                "run_id": run_id,
+            }
 
-                processed += 1
-                if processed >= limit:
-                    break
+            loaded.append(d)
+            if len(loaded) >= limit:
+                break
+        loaded, skipped = _drop_compacted_rows(loaded)
 
-    return {"report_id": report_id, "processed": processed, "inserted": inserted, "updated": updated}
+        # mapping changes vs. the stored rows, logged in one statement before the upsert
+        _log_st_map_changes(conn, pid, loaded, run_id)
+        for d in loaded:
+            res = conn.execute(upsert_sql, d).first()
+            if res and res[0] is True:
+                inserted += 1
+            else:
+                updated += 1
+            processed += 1
 
-@app.on_event("startup")
-def _startup():
-    init_db()
+        _touch_st_dim(conn, pid, loaded)
+        _refresh_coverage_for_rows(conn, pid, "st", loaded, run_id)
+
+    return {"report_id": report_id, "processed": processed, "inserted": inserted, "updated": updated,
+            "skipped_compacted": skipped}
+
+# ---- startup: schema check, optional warmup, boot timing ----
+# STARTUP_MODE=check (default): one schema_migrations lookup. Only a truly empty
+#   database (no schema_migrations and no fact tables) is migrated on the spot;
+#   an unversioned legacy schema or pending migrations are only reported, they
+#   run out-of-band (worker JOB_MODE=migrate).
+# STARTUP_MODE=migrate (or ddl): run pending migrations before serving.
+# STARTUP_MODE=skip: touch nothing.
+# STARTUP_WARMUP=1 opens DB connections and fetches an Ads access token in the
+# background so the first real request does not pay for them.
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "check").lower()
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "1") == "1"
+
+def _process_start_time() -> float:
+    """Wall-clock process start from /proc (1s resolution); falls back to main's import start."""
+    try:
+        with open("/proc/self/stat") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _BOOT_T0
+
+STARTUP_STATS = {
+    "mode": STARTUP_MODE,
+    "process_started_at": _process_start_time(),
+    "import_secs": None,
+    "startup_secs": None,
+    "schema_version": None,
+    "ran_ddl": False,
+    "warmup": {},
+    "first_request_secs": None,
+}
 
-@app.post("/api/debug/migrate_st_add_keyword_cols")
-def migrate_st_add_keyword_cols():
-    if not engine:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    sql = """
-    DO $$
-    BEGIN
-      IF NOT EXISTS (
-        SELECT 1 FROM information_schema.columns
-        WHERE table_name='fact_sp_search_term_daily' AND column_name='keyword_id'
-      ) THEN
-        ALTER TABLE fact_sp_search_term_daily ADD COLUMN keyword_id text;
-      END IF;
-
-      IF NOT EXISTS (
-        SELECT 1 FROM information_schema.columns
-        WHERE table_name='fact_sp_search_term_daily' AND column_name='keyword_text'
-      ) THEN
-        ALTER TABLE fact_sp_search_term_daily ADD COLUMN keyword_text text;
-      END IF;
-    END$$;
-    """
-    with engine.begin() as conn:
-        conn.exec_driver_sql(sql)
-    return {"ok": True, "changed": ["keyword_id", "keyword_text"]}
+def _schema_version() -> int | None:
+    from sqlalchemy.exc import ProgrammingError
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT max(version) FROM schema_migrations")).scalar()
+    except ProgrammingError:
+        return None
+
+def _database_is_empty() -> bool:
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT to_regclass('public.fact_sp_keyword_daily') IS NULL")).scalar()
+
+def _warmup_sync():
+    t0 = _time.time()
+    done = STARTUP_STATS["warmup"]
+    try:
+        if engine:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            done["db_primary"] = True
+            _load_report_history()
+            done["report_history"] = True
+        if os.environ.get("AMZN_REFRESH_TOKEN"):
+            _get_access_token_from_refresh()
+            done["ads_token"] = True
+    except Exception as e:
+        done["error"] = f"{type(e).__name__}: {e}"
+    done["sync_secs"] = round(_time.time() - t0, 3)
+    print(f"[startup] warmup {done}", flush=True)
+
+async def _warmup_async():
+    # async pools are bound to the server's event loop, so they are warmed on it
+    for name, eng in (("db_read", async_engine), ("db_replica", replica_async_engine)):
+        if not eng:
+            continue
+        try:
+            async with eng.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            STARTUP_STATS["warmup"][name] = True
+        except Exception as e:
+            STARTUP_STATS["warmup"][name] = f"{type(e).__name__}: {e}"
 
-@app.post("/api/debug/migrate_st_mapping_history")
-def migrate_st_mapping_history():
-    if not engine:
-        raise HTTPException(status_code=500, detail="Database not configured")
+@app.on_event("startup")
+async def _startup():
+    t0 = _time.time()
+    STARTUP_STATS["import_secs"] = round(t0 - _BOOT_T0, 3)
+    if engine and STARTUP_MODE != "skip":
+        version = await asyncio.to_thread(_schema_version)
+        migrate = STARTUP_MODE in ("migrate", "ddl")
+        if not migrate and version is None:
+            # an unversioned schema with data in it may predate the runner; baselining
+            # it rewrites large tables, which must not happen inside a boot
+            migrate = await asyncio.to_thread(_database_is_empty)
+            if not migrate:
+                print("[startup] schema unversioned, run JOB_MODE=migrate", flush=True)
+        if migrate:
+            result = await asyncio.to_thread(_run_migrations)
+            STARTUP_STATS["ran_ddl"] = bool(result["applied"])
+            version = result.get("version", version)
+        elif version is not None and version < SCHEMA_VERSION:
+            print(f"[startup] schema at {version}, code expects {SCHEMA_VERSION}: run JOB_MODE=migrate", flush=True)
+        STARTUP_STATS["schema_version"] = version
+    if STARTUP_WARMUP:
+        threading.Thread(target=_warmup_sync, name="warmup", daemon=True).start()
+        asyncio.get_running_loop().create_task(_warmup_async())
+    STARTUP_STATS["startup_secs"] = round(_time.time() - t0, 3)
+    print(f"[startup] mode={STARTUP_MODE} import={STARTUP_STATS['import_secs']}s "
+          f"startup={STARTUP_STATS['startup_secs']}s ddl={STARTUP_STATS['ran_ddl']}", flush=True)
+
+class _FirstRequestTimer:
+    """Records seconds from process start to the first response (cold-start latency)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or STARTUP_STATS["first_request_secs"] is not None:
+            await self.app(scope, receive, send)
+            return
 
-    ddl = """
-    -- 1) History table for mapping changes
-    CREATE TABLE IF NOT EXISTS fact_sp_search_term_map_history (
-      id               bigserial PRIMARY KEY,
-      profile_id       text NOT NULL,
-      date             date NOT NULL,                  -- date of the NEW fact row
-      campaign_id      text NOT NULL,
-      ad_group_id      text NOT NULL,
-      search_term      text NOT NULL,
-      match_type       text NOT NULL,                  -- NEW match_type
-      old_keyword_id   text,
-      old_keyword_text text,
-      new_keyword_id   text,
-      new_keyword_text text,
-      run_id           uuid,
-      changed_at       timestamptz NOT NULL DEFAULT now()
-    );
+        async def _send(message):
+            if message["type"] == "http.response.start" and STARTUP_STATS["first_request_secs"] is None:
+                STARTUP_STATS["first_request_secs"] = round(_time.time() - STARTUP_STATS["process_started_at"], 3)
+                STARTUP_STATS["first_request_path"] = scope.get("path")
+            await send(message)
 
-    CREATE INDEX IF NOT EXISTS idx_st_map_hist_when
-      ON fact_sp_search_term_map_history (changed_at DESC);
-    CREATE INDEX IF NOT EXISTS idx_st_map_hist_lookup
-      ON fact_sp_search_term_map_history (profile_id, search_term, ad_group_id, date);
+        await self.app(scope, receive, _send)
 
-    -- 2) Trigger function: log when keyword mapping or match_type changes
-    CREATE OR REPLACE FUNCTION trg_log_st_keyword_mapping_change()
-    RETURNS trigger AS $$
-    BEGIN
-      IF
-        COALESCE(OLD.keyword_id,  '') IS DISTINCT FROM COALESCE(NEW.keyword_id,  '') OR
-        COALESCE(OLD.keyword_text,'') IS DISTINCT FROM COALESCE(NEW.keyword_text,'') OR
-        COALESCE(OLD.match_type,  '') IS DISTINCT FROM COALESCE(NEW.match_type,  '')
-      THEN
-        INSERT INTO fact_sp_search_term_map_history (
-          profile_id, date, campaign_id, ad_group_id, search_term, match_type,
-          old_keyword_id, old_keyword_text, new_keyword_id, new_keyword_text,
-          run_id
-        )
-        VALUES (
-          OLD.profile_id, NEW.date, NEW.campaign_id, NEW.ad_group_id, NEW.search_term, NEW.match_type,
-          OLD.keyword_id, OLD.keyword_text, NEW.keyword_id, NEW.keyword_text,
-          NEW.run_id
-        );
-      END IF;
-      RETURN NEW;
-    END;
-    $$ LANGUAGE plpgsql;
-
-    -- 3) Attach trigger to the fact table (idempotent)
-    DO $$
-    BEGIN
-      IF EXISTS (
-        SELECT 1 FROM information_schema.tables
-        WHERE table_schema='public' AND table_name='fact_sp_search_term_daily'
-      ) THEN
-        -- drop if exists to be idempotent
-        IF EXISTS (
-          SELECT 1 FROM pg_trigger WHERE tgname = 'trg_after_update_st_map_change'
-        ) THEN
-          EXECUTE 'DROP TRIGGER trg_after_update_st_map_change ON fact_sp_search_term_daily';
-        END IF;
-        EXECUTE '
-          CREATE TRIGGER trg_after_update_st_map_change
-          AFTER UPDATE OF keyword_id, keyword_text, match_type
-          ON fact_sp_search_term_daily
-          FOR EACH ROW
-          EXECUTE FUNCTION trg_log_st_keyword_mapping_change()
-        ';
-      END IF;
-    END$$;
-    """
+app.add_middleware(_FirstRequestTimer)
 
-    with engine.begin() as conn:
-        conn.exec_driver_sql(ddl)
+@app.get("/api/debug/migrations")
+def debug_migrations():
+    """Applied vs pending schema migrations (they are applied by worker JOB_MODE=migrate)."""
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    applied = {}
+    if _schema_version() is not None:
+        with engine.connect() as conn:
+            applied = {r["version"]: dict(r) for r in conn.execute(text(
+                "SELECT * FROM schema_migrations ORDER BY version"
+            )).mappings()}
+    return {
+        "code_version": SCHEMA_VERSION,
+        "db_version": max(applied) if applied else None,
+        "applied": [{**r, "applied_at": r["applied_at"].isoformat()} for r in applied.values()],
+        "pending": [{"version": v, "name": n} for v, n, _ in MIGRATIONS if v not in applied],
+    }
 
-    return {"ok": True, "objects": ["fact_sp_search_term_map_history", "trg_log_st_keyword_mapping_change", "trg_after_update_st_map_change"]}
+@app.get("/api/debug/startup")
+def debug_startup():
+    return {**STARTUP_STATS, "token_cache": {
+        "cached": bool(ADS_TOKEN_CACHE["access_token"]),
+        "expires_in_secs": max(0, round(ADS_TOKEN_CACHE["expires_at"] - _time.time())),
+        "refreshes": ADS_TOKEN_CACHE["refreshes"],
+    }}
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if async_engine:
+        await async_engine.dispose()
+    if replica_async_engine:
+        await replica_async_engine.dispose()
+    if _PARSE_POOL is not None:
+        _PARSE_POOL.shutdown(cancel_futures=True)
 
 # ====== BACKFILL / DAILY HELPERS ======
-import datetime as _dt
-import time as _time
 
 def _ymd(d: _dt.date) -> str:
     return d.strftime("%Y-%m-%d")
@@ -1744,284 +2810,353 @@ def _chunk_ranges(start: _dt.date, end: _dt.date, chunk_days: int):
         yield cur, chunk_end
         cur = chunk_end + _dt.timedelta(days=1)
 
-def _create_report(ads_base: str, headers: dict, body: dict) -> str:
-    with httpx.Client(timeout=60) as client:
-        r = client.post(f"{ads_base}/reporting/reports", headers=headers, json=body)
-        if 200 <= r.status_code < 300:
-            return r.json().get("reportId")
-        if r.status_code == 425:
-            # duplicate request: extract reportId from detail
-            import re
-            try:
-                return re.search(r"([0-9a-fA-F-]{36})", r.json().get("detail","")).group(1)
-            except Exception:
-                pass
-        raise HTTPException(status_code=502, detail={"stage":"create_report","status":r.status_code,"body":r.text})
+# ---- report request cache (dedupe report creation across UI, cron, backfills) ----
+import hashlib
+REPORT_CACHE_MAX_AGE_SECS = int(os.environ.get("REPORT_CACHE_MAX_AGE_SECS", "21600"))  # in-flight reuse: 6h
+_REPORT_ID_RE = _re.compile(r"([0-9a-fA-F-]{36})")
+
+def _report_type(body: dict) -> str:
+    cfg = body.get("configuration") or {}
+    return cfg.get("reportTypeId") or cfg.get("entity") or "unknown"
+
+def _report_cache_key(profile_id: str, body: dict) -> str:
+    cfg = body.get("configuration") or {}
+    ident = [
+        profile_id,
+        _report_type(body),
+        sorted(cfg.get("columns") or []),
+        sorted(cfg.get("groupBy") or []),
+        cfg.get("timeUnit"),
+        body.get("startDate"),
+        body.get("endDate"),
+    ]
+    return hashlib.sha1(json.dumps(ident, separators=(",", ":")).encode()).hexdigest()
 
-def _wait_and_download(ads_base: str, headers: dict, report_id: str, max_wait_seconds: int = 600) -> str:
-    status_url = f"{ads_base}/reporting/reports/{report_id}"
-    deadline = _time.time() + max_wait_seconds
-    with httpx.Client(timeout=60) as client:
-        while _time.time() < deadline:
-            s = client.get(status_url, headers=headers)
-            if s.status_code >= 400:
-                raise HTTPException(status_code=502, detail={"stage":"check_report","status":s.status_code,"body":s.text})
-            meta = s.json()
-            if meta.get("status") in ("SUCCESS","COMPLETED") and meta.get("url"):
-                # download with ZERO headers
-                dr = httpx.get(meta["url"], headers={}, timeout=120)
-                if dr.status_code >= 400:
-                    raise HTTPException(status_code=502, detail={"stage":"download","status":dr.status_code,"body":dr.text})
-                # gunzip if needed
-                try:
-                    buf = io.BytesIO(dr.content)
-                    with gzip.GzipFile(fileobj=buf) as gz:
-                        return gz.read().decode("utf-8")
-                except OSError:
-                    return dr.content.decode("utf-8", errors="ignore")
-            if meta.get("status") in {"FAILURE","CANCELLED"}:
-                raise HTTPException(status_code=502, detail={"stage":"check_report","status":meta.get("status"),"meta":meta})
-            _time.sleep(3)
-    raise HTTPException(status_code=504, detail={"stage":"check_report","status":"TIMEOUT","report_id":report_id})
+def _duplicate_report_id(resp) -> str | None:
+    """Amazon answers a duplicate create with HTTP 425 and 'The Request is a duplicate of : <uuid>'."""
+    try:
+        m = _REPORT_ID_RE.search(resp.json().get("detail", ""))
+    except Exception:
+        return None
+    return m.group(1) if m else None
 
-# ====== SEARCH TERMS BACKFILL ======
-@app.post("/api/tasks/backfill_search_terms")
-def backfill_search_terms(days: int = 65, chunk_days: int = 14, background_tasks: BackgroundTasks = None):
-    """
-    Backfill SP Search Terms for the last `days` days in chunks of `chunk_days`.
-    Returns immediately; ingestion runs in background.
-    """
-    start = _dt.date.today() - _dt.timedelta(days=max(1, days))
-    end   = _dt.date.today() - _dt.timedelta(days=1)  # up to yesterday
-    if background_tasks is not None:
-        background_tasks.add_task(_run_st_backfill, start, end, chunk_days)
-    return {"status":"QUEUED","type":"search_terms","start":_ymd(start),"end":_ymd(end),"chunk_days":chunk_days}
+def _report_cache_lookup(cache_key: str) -> str | None:
+    """Return a reusable report_id: in flight and recent, or completed with an unexpired URL."""
+    if not engine:
+        return None
+    with engine.begin() as conn:
+        row = conn.execute(text("""
+            SELECT report_id
+            FROM ads_report_requests
+            WHERE cache_key = :k
+              AND status NOT IN ('FAILURE', 'FAILED', 'CANCELLED')
+              AND (
+                (status NOT IN ('SUCCESS', 'COMPLETED')
+                  AND created_at > now() - make_interval(secs => :max_age))
+                OR (url_expires_at IS NOT NULL AND url_expires_at > now() + interval '2 minutes')
+              )
+        """), {"k": cache_key, "max_age": REPORT_CACHE_MAX_AGE_SECS}).first()
+    return row[0] if row else None
+
+def _report_cache_store(cache_key: str, profile_id: str, body: dict, report_id: str, status: str = "PENDING"):
+    if not engine:
+        return
+    cfg = body.get("configuration") or {}
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO ads_report_requests (
+                cache_key, profile_id, report_type, start_date, end_date, columns,
+                report_id, status
+            ) VALUES (
+                :k, :pid, :rtype, :start_d, :end_d, :cols, :rid, :status
+            )
+            ON CONFLICT (cache_key) DO UPDATE SET
+                report_id = EXCLUDED.report_id,
+                status = EXCLUDED.status,
+                url = NULL,
+                url_expires_at = NULL,
+                completed_at = NULL,
+                created_at = CASE WHEN ads_report_requests.report_id = EXCLUDED.report_id
+                                  THEN ads_report_requests.created_at ELSE now() END,
+                updated_at = now()
+        """), {
+            "k": cache_key,
+            "pid": profile_id,
+            "rtype": _report_type(body),
+            "start_d": body.get("startDate"),
+            "end_d": body.get("endDate"),
+            "cols": ",".join(cfg.get("columns") or []),
+            "rid": report_id,
+            "status": status,
+        })
 
-from datetime import datetime, timedelta, timezone
-import time, io, gzip, uuid, json as _json
-import httpx
-from sqlalchemy import text as _text
+def _report_cache_update(report_id: str, meta: dict):
+    """Record the latest status / download URL seen for a report (best effort)."""
+    if not engine or not report_id:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                UPDATE ads_report_requests SET
+                    status = COALESCE(CAST(:status AS text), status),
+                    url = COALESCE(CAST(:url AS text), url),
+                    url_expires_at = COALESCE(CAST(:expires AS timestamptz), url_expires_at),
+                    completed_at = CASE WHEN CAST(:status AS text) IN ('SUCCESS', 'COMPLETED')
+                                        THEN COALESCE(completed_at, now()) ELSE completed_at END,
+                    updated_at = now()
+                WHERE report_id = :rid
+            """), {
+                "rid": report_id,
+                "status": meta.get("status"),
+                "url": meta.get("url"),
+                "expires": meta.get("urlExpiresAt"),
+            })
+    except Exception as e:
+        print(f"[report_cache] update failed for {report_id}: {e}", flush=True)
 
-def _run_st_backfill(start: _dt.date, end: _dt.date, chunk_days: int, wait_seconds: int | None = None):
-    """Backfill Sponsored Products SEARCH TERM data for [start, end] in chunks."""
-    if wait_seconds is None:
-        wait_seconds = BACKFILL_WAIT_SECS
-
-    _bf_set(last_event="ST backfill starting")
-    access = _get_access_token_from_refresh()
-    headers = _ads_headers(access)
-    region  = os.environ.get("AMZN_REGION", "NA").upper()
-    ads_base = _ads_base(region)
+def _request_report(ads_base: str, headers: dict, body: dict, priority: str = "backfill") -> tuple[str, str]:
+    """
+    Get a report_id for `body`, reusing an identical in-flight/fresh report when
+    one is cached. Returns (report_id, source) with source in
+    {"cache", "created", "duplicate"}.
+    """
     pid = _env("AMZN_PROFILE_ID")
-
-    st_columns = [
-        "date",
-        "campaignId","campaignName",
-        "adGroupId","adGroupName",
-        "searchTerm","keywordId","keyword","matchType",
-        "impressions","clicks","spend",
-        "sales14d","purchases14d",
-        "clickThroughRate","costPerClick",
-        "acosClicks14d","roasClicks14d",
-    ]
-
-    def _iter_records(text: str):
-        """Yield JSON records whether NDJSON or a JSON array/object."""
-        got = []
-        for line in text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                got.append(_json.loads(line))
-            except Exception:
-                got = []
-                break
-        if got:
-            for r in got:
-                yield r
-            return
-        try:
-            obj = _json.loads(text)
-        except Exception:
-            return
-        if isinstance(obj, list):
-            for item in obj:
-                yield item
-        elif isinstance(obj, dict):
-            yield obj
-
-    cur = start
-    while cur <= end:
-        chunk_end = min(cur + _dt.timedelta(days=chunk_days - 1), end)
-        BACKFILL_STATUS["current_chunk"] = f"{cur.isoformat()} -> {chunk_end.isoformat()}"
-
-        # 1) create report
-        create_body = {
-            "name": f"ST {cur}..{chunk_end}",
-            "startDate": cur.isoformat(),
-            "endDate": chunk_end.isoformat(),
-            "configuration": {
-                "entity": "SEARCH_TERM",
-                "groupBy": ["DAY"],
-                "columns": st_columns,
-                "timeUnit": "DAILY"
-            }
-        }
-        _bf_set(last_event="creating ST report")
-        r = _ads_request_with_refresh(
-            "POST",
-            f"{ads_base}/reporting/reports",
-            headers=headers,
-            json=create_body,
-        )
-        if r.status_code >= 400:
-            BACKFILL_STATUS["st"]["errors"] += 1
-            _bf_set(last_error=f"ST create {r.status_code}: {r.text[:300]}")
-            raise HTTPException(status_code=502, detail={"stage":"st_create","status":r.status_code,"body":r.text})
-        report_id = r.json().get("reportId")
-        _bf_set(last_event=f"ST report created: {report_id}")
-
-        # 2) poll
-        status_url = f"{ads_base}/reporting/reports/{report_id}"
-        deadline = time.time() + wait_seconds
-        download_url = None
-        while time.time() < deadline:
-            sr = _ads_request_with_refresh("GET", status_url, headers=headers)
-            if sr.status_code >= 400:
-                BACKFILL_STATUS["st"]["errors"] += 1
-                _bf_set(last_error=f"ST status {sr.status_code}: {sr.text[:300]}")
-                raise HTTPException(status_code=502, detail={"stage":"st_status","status":sr.status_code,"body":sr.text})
-            meta = sr.json()
-            st = meta.get("status")
-            if st in ("SUCCESS", "COMPLETED") and meta.get("url"):
-                download_url = meta["url"]
-                break
-            time.sleep(5)
-
-        if not download_url:
-            BACKFILL_STATUS["st"]["errors"] += 1
-            _bf_set(last_error="ST timeout waiting for report")
-            raise HTTPException(status_code=504, detail="ST timeout waiting for report")
-
-        _bf_set(last_event=f"ST report ready: {report_id}, downloading")
-
-        # 3) download
-        with httpx.Client(timeout=120) as client:
-            dr = client.get(download_url, headers={})
-            if dr.status_code >= 400:
-                BACKFILL_STATUS["st"]["errors"] += 1
-                _bf_set(last_error=f"ST download {dr.status_code}: {dr.text[:300]}")
-                raise HTTPException(status_code=502, detail={"stage":"st_download","status":dr.status_code,"body":dr.text})
-
-        # 4) gunzip / parse
+    cache_key = _report_cache_key(pid, body)
+    rid = _report_cache_lookup(cache_key)
+    if rid:
+        print(f"[report_cache] reuse {_report_type(body)} {body.get('startDate')}..{body.get('endDate')} -> {rid}", flush=True)
+        return rid, "cache"
+
+    r = _ads_request_with_refresh("POST", f"{ads_base}/reporting/reports", headers=headers, json=body,
+                                  priority=priority)
+    if 200 <= r.status_code < 300 and r.json().get("reportId"):
+        rid, source = r.json()["reportId"], "created"
+    elif r.status_code == 425 and _duplicate_report_id(r):
+        rid, source = _duplicate_report_id(r), "duplicate"
+    else:
+        raise HTTPException(status_code=502, detail={"stage": "create_report", "status": r.status_code, "body": r.text})
+
+    _report_cache_store(cache_key, pid, body, rid)
+    return rid, source
+
+def _create_report(ads_base: str, headers: dict, body: dict, priority: str = "backfill") -> str:
+    return _request_report(ads_base, headers, body, priority)[0]
+
+# ---- adaptive report-status polling (shared by every path that waits on a report) ----
+# Generation time is learned from ads_report_requests (completed_at - created_at) per
+# report type and date-span bucket: the first check lands shortly before the expected
+# completion, then checks back off exponentially up to a cap.
+REPORT_POLL_MIN_SECS = float(os.environ.get("REPORT_POLL_MIN_SECS", "2"))
+REPORT_POLL_MAX_SECS = float(os.environ.get("REPORT_POLL_MAX_SECS", "60"))
+REPORT_POLL_GROWTH = float(os.environ.get("REPORT_POLL_GROWTH", "1.6"))
+REPORT_POLL_FIRST_FRACTION = float(os.environ.get("REPORT_POLL_FIRST_FRACTION", "0.7"))
+REPORT_POLL_HISTORY_TTL_SECS = 600
+_REPORT_HISTORY = {"loaded_at": 0.0, "by_bucket": {}, "by_type": {}}
+REPORT_POLL_STATS = {}  # report_type -> {"reports", "polls", "wait_secs"}
+
+def _span_bucket(span_days: int | None) -> str:
+    if not span_days or span_days <= 1:
+        return "1d"
+    if span_days <= 7:
+        return "7d"
+    if span_days <= 31:
+        return "31d"
+    return "long"
+
+def _load_report_history():
+    """Median generation seconds per (report_type, span bucket), refreshed every few minutes."""
+    if not engine or _time.time() - _REPORT_HISTORY["loaded_at"] < REPORT_POLL_HISTORY_TTL_SECS:
+        return
+    _REPORT_HISTORY["loaded_at"] = _time.time()
+    try:
+        with engine.begin() as conn:
+            rows = conn.execute(text("""
+                SELECT report_type, (end_date - start_date + 1) AS span_days,
+                       EXTRACT(EPOCH FROM completed_at - created_at) AS gen_secs
+                FROM ads_report_requests
+                WHERE completed_at IS NOT NULL
+                  AND completed_at > created_at
+                  AND created_at > now() - interval '30 days'
+                ORDER BY created_at DESC
+                LIMIT 2000
+            """)).all()
+    except Exception as e:
+        print(f"[report_poll] history load failed: {e}", flush=True)
+        return
+    by_bucket, by_type = {}, {}
+    for rtype, span, secs in rows:
+        by_bucket.setdefault((rtype, _span_bucket(span)), []).append(float(secs))
+        by_type.setdefault(rtype, []).append(float(secs))
+    median = lambda xs: sorted(xs)[len(xs) // 2]
+    _REPORT_HISTORY["by_bucket"] = {k: median(v) for k, v in by_bucket.items()}
+    _REPORT_HISTORY["by_type"] = {k: median(v) for k, v in by_type.items()}
+
+def _expected_generation_secs(report_type: str, span_days: int | None) -> float | None:
+    _load_report_history()
+    hist = _REPORT_HISTORY["by_bucket"].get((report_type, _span_bucket(span_days)))
+    return hist if hist is not None else _REPORT_HISTORY["by_type"].get(report_type)
+
+def _poll_delays(first_wait: float | None):
+    """Sleep schedule: one long wait up to the expected completion, then MIN * GROWTH^n capped at MAX."""
+    if first_wait and first_wait > REPORT_POLL_MIN_SECS:
+        yield first_wait
+    d = REPORT_POLL_MIN_SECS
+    while True:
+        yield d
+        d = min(REPORT_POLL_MAX_SECS, d * REPORT_POLL_GROWTH)
+
+def _report_poll_profile(report_id: str) -> tuple[str, int | None, float, str | None]:
+    """(report_type, span_days, age_secs, cached_status) from the request cache, if we created it."""
+    if engine:
         try:
-            buf = io.BytesIO(dr.content)
-            with gzip.GzipFile(fileobj=buf) as gz:
-                raw_text = gz.read().decode("utf-8")
-        except OSError:
-            raw_text = dr.content.decode("utf-8", errors="ignore")
-
-        run_id = str(uuid.uuid4())
-        rows = []
-        parsed = 0
-
-        for rec in _iter_records(raw_text):
-            items = rec if isinstance(rec, list) else [rec]
-            for obj in items:
-                if not isinstance(obj, dict):
-                    continue
-                parsed += 1
+            with engine.begin() as conn:
+                row = conn.execute(text("""
+                    SELECT report_type, (end_date - start_date + 1),
+                           EXTRACT(EPOCH FROM now() - created_at), status
+                    FROM ads_report_requests WHERE report_id = :rid
+                    ORDER BY updated_at DESC LIMIT 1
+                """), {"rid": report_id}).first()
+            if row:
+                return row[0], row[1], float(row[2] or 0), row[3]
+        except Exception as e:
+            print(f"[report_poll] profile lookup failed for {report_id}: {e}", flush=True)
+    return "unknown", None, 0.0, None
 
-                ds = (obj.get("date") or obj.get("reportDate") or "")[:10]
-                if not ds:
-                    continue
+def _report_done(meta: dict) -> bool:
+    st = meta.get("status")
+    return (st in ("SUCCESS", "COMPLETED") and bool(meta.get("url"))) or st in ("FAILURE", "FAILED", "CANCELLED")
 
-                impressions = int(obj.get("impressions") or 0)
-                clicks = int(obj.get("clicks") or 0)
-                cost = float(obj.get("spend") or obj.get("cost") or 0.0)
-                sales = float(obj.get("sales14d") or 0.0)
-                orders = int(obj.get("purchases14d") or 0)
-
-                cpc  = round(cost / clicks, 6) if clicks else 0.0
-                ctr  = round(clicks / impressions, 6) if impressions else 0.0
-                acos = round(cost / sales, 6) if sales else 0.0
-                roas = round(sales / cost, 6) if cost else 0.0
-
-                rows.append({
-                    "profile_id": pid,
-                    "date": ds,
-                    "campaign_id": str(obj.get("campaignId") or "") or "",
-                    "campaign_name": obj.get("campaignName") or "",
-                    "ad_group_id": str(obj.get("adGroupId") or "") or "",
-                    "ad_group_name": obj.get("adGroupName") or "",
-                    "search_term": obj.get("searchTerm") or "",
-                    "keyword_id": (str(obj.get("keywordId") or "") or None),
-                    "keyword_text": obj.get("keyword") or None,
-                    "match_type": obj.get("matchType") or "",
-                    "impressions": impressions,
-                    "clicks": clicks,
-                    "cost": cost,
-                    "attributed_sales_14d": sales,
-                    "attributed_conversions_14d": orders,
-                    "cpc": cpc, "ctr": ctr, "acos": acos, "roas": roas,
-                    "run_id": run_id,
-                })
+class _ReportPoller:
+    """
+    Single poll loop for any number of outstanding reports. Each report keeps its
+    own adaptive schedule; the loop sleeps until the earliest one is due.
+    """
 
-        BACKFILL_STATUS["st"]["processed"] += parsed
-        if rows:
-            _bf_set(last_event=f"ST parsed {len(rows)} records")
-
-            upsert_sql = _text("""
-                INSERT INTO fact_sp_search_term_daily (
-                    profile_id, date,
-                    campaign_id, campaign_name,
-                    ad_group_id, ad_group_name,
-                    search_term, keyword_id, keyword_text, match_type,
-                    impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-                    cpc, ctr, acos, roas, run_id, pulled_at
-                ) VALUES (
-                    :profile_id, :date,
-                    :campaign_id, :campaign_name,
-                    :ad_group_id, :ad_group_name,
-                    :search_term, :keyword_id, :keyword_text, :match_type,
-                    :impressions, :clicks, :cost, :attributed_sales_14d, :attributed_conversions_14d,
-                    :cpc, :ctr, :acos, :roas, :run_id, now()
-                )
-                ON CONFLICT (profile_id, date, ad_group_id, search_term, match_type) DO UPDATE SET
-                    campaign_id = EXCLUDED.campaign_id,
-                    campaign_name = EXCLUDED.campaign_name,
-                    ad_group_id = EXCLUDED.ad_group_id,
-                    ad_group_name = EXCLUDED.ad_group_name,
-                    keyword_id = EXCLUDED.keyword_id,
-                    keyword_text = EXCLUDED.keyword_text,
-                    match_type = EXCLUDED.match_type,
-                    impressions = EXCLUDED.impressions,
-                    clicks = EXCLUDED.clicks,
-                    cost = EXCLUDED.cost,
-                    attributed_sales_14d = EXCLUDED.attributed_sales_14d,
-                    attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
-                    cpc = EXCLUDED.cpc,
-                    ctr = EXCLUDED.ctr,
-                    acos = EXCLUDED.acos,
-                    roas = EXCLUDED.roas,
-                    run_id = EXCLUDED.run_id,
-                    pulled_at = now()
-            """)
+    def __init__(self, ads_base: str, headers: dict, priority: str = "backfill"):
+        self.ads_base = ads_base
+        self.headers = headers
+        self.priority = priority
+        self._pending = {}
 
-            with engine.begin() as conn:
-                for i in range(0, len(rows), 1000):
-                    conn.execute(upsert_sql, rows[i:i+1000])
+    def __len__(self):
+        return len(self._pending)
 
-            total_upserted = len(rows)
-            _bf_set(last_event=f"ST upserted {total_upserted} rows (insert/update split not tracked)")
+    def add(self, report_id: str, max_wait_seconds: float | None = None):
+        if report_id in self._pending:
+            return
+        rtype, span, age, cached_status = _report_poll_profile(report_id)
+        first = None
+        if cached_status not in ("SUCCESS", "COMPLETED"):
+            expected = _expected_generation_secs(rtype, span)
+            if expected:
+                first = expected * REPORT_POLL_FIRST_FRACTION - age
+        delays = _poll_delays(first)
+        now = _time.time()
+        # reused reports that may already be done get checked right away
+        if cached_status in ("SUCCESS", "COMPLETED") or (first is None and age > REPORT_POLL_MAX_SECS):
+            next_at = now
         else:
-            _bf_set(last_event="ST parsed 0 records (nothing to upsert)")
+            next_at = now + next(delays)
+        deadline = now + max_wait_seconds if max_wait_seconds else None
+        self._pending[report_id] = {"type": rtype, "delays": delays, "next_at": next_at,
+                                    "added": now, "polls": 0, "deadline": deadline}
+
+    def _poll(self, report_id: str) -> dict:
+        s = _ads_request_with_refresh("GET", f"{self.ads_base}/reporting/reports/{report_id}",
+                                      headers=self.headers, priority=self.priority)
+        if s.status_code >= 400:
+            return {"status": "HTTP_ERROR", "http_status": s.status_code, "body": s.text}
+        meta = s.json()
+        _report_cache_update(report_id, meta)
+        return meta
+
+    def _finish(self, report_id: str):
+        p = self._pending.pop(report_id)
+        st = REPORT_POLL_STATS.setdefault(p["type"], {"reports": 0, "polls": 0, "wait_secs": 0.0})
+        st["reports"] += 1
+        st["polls"] += p["polls"]
+        st["wait_secs"] += round(_time.time() - p["added"], 1)
+
+    def as_completed(self, max_wait_seconds: float | None = None):
+        """
+        Yield (report_id, meta) as each report reaches a terminal state, and TIMEOUT
+        for reports past their own or the overall deadline. Reports may be added
+        while iterating.
+        """
+        deadline = _time.time() + max_wait_seconds if max_wait_seconds else None
+        while self._pending:
+            now = _time.time()
+            if deadline is not None and now >= deadline:
+                break
+            for rid in [r for r, p in self._pending.items() if p["deadline"] and p["deadline"] <= now]:
+                self._finish(rid)
+                yield rid, {"status": "TIMEOUT", "report_id": rid}
+            due = [rid for rid, p in self._pending.items() if p["next_at"] <= now]
+            if not due:
+                if not self._pending:
+                    break
+                wake = min(min(p["next_at"], p["deadline"] or p["next_at"]) for p in self._pending.values())
+                if deadline is not None:
+                    wake = min(wake, deadline)
+                _time.sleep(max(0.0, wake - now))
+                continue
+            for rid in due:
+                p = self._pending[rid]
+                p["polls"] += 1
+                meta = self._poll(rid)
+                if meta.get("status") == "HTTP_ERROR" or _report_done(meta):
+                    self._finish(rid)
+                    yield rid, meta
+                else:
+                    p["next_at"] = _time.time() + next(p["delays"])
+        for rid in list(self._pending):
+            self._finish(rid)
+            yield rid, {"status": "TIMEOUT", "report_id": rid}
+
+def _await_report(ads_base: str, headers: dict, report_id: str, max_wait_seconds: float,
+                  priority: str = "backfill") -> dict:
+    """Poll one report until it is downloadable; raises HTTPException(502/504) otherwise."""
+    poller = _ReportPoller(ads_base, headers, priority)
+    poller.add(report_id)
+    for _, meta in poller.as_completed(max_wait_seconds):
+        st = meta.get("status")
+        if st == "TIMEOUT":
+            raise HTTPException(status_code=504, detail={"stage": "check_report", "status": "TIMEOUT", "report_id": report_id})
+        if st == "HTTP_ERROR":
+            raise HTTPException(status_code=502, detail={"stage": "check_report", "status": meta["http_status"], "body": meta["body"]})
+        if st not in ("SUCCESS", "COMPLETED"):
+            raise HTTPException(status_code=502, detail={"stage": "check_report", "status": st, "meta": meta})
+        return meta
+    raise HTTPException(status_code=504, detail={"stage": "check_report", "status": "TIMEOUT", "report_id": report_id})
+
+def _wait_and_download(ads_base: str, headers: dict, report_id: str, max_wait_seconds: int = 600,
+                       priority: str = "backfill") -> bytes:
+    meta = _await_report(ads_base, headers, report_id, max_wait_seconds, priority=priority)
+    # download with ZERO headers
+    dr = httpx.get(meta["url"], headers={}, timeout=120)
+    if dr.status_code >= 400:
+        raise HTTPException(status_code=502, detail={"stage":"download","status":dr.status_code,"body":dr.text})
+    # gunzip if needed
+    return _gunzip_report(dr.content)
 
-        cur = chunk_end + _dt.timedelta(days=1)
+# ====== SEARCH TERMS BACKFILL ======
+@app.post("/api/tasks/backfill_search_terms")
+def backfill_search_terms(days: int = 65, chunk_days: int = 14, background_tasks: BackgroundTasks = None):
+    """
+    Backfill SP Search Terms for the last `days` days in chunks of `chunk_days`.
+    Returns immediately; ingestion runs in background.
+    """
+    start = _dt.date.today() - _dt.timedelta(days=max(1, days))
+    end   = _dt.date.today() - _dt.timedelta(days=1)  # up to yesterday
+    if background_tasks is not None:
+        background_tasks.add_task(_run_st_backfill, start, end, chunk_days)
+    return {"status":"QUEUED","type":"search_terms","start":_ymd(start),"end":_ymd(end),"chunk_days":chunk_days}
 
-    BACKFILL_STATUS["active"] = False
-    BACKFILL_STATUS["finished_at"] = _dt.datetime.now(tz=_dt.timezone.utc).isoformat()
+def _run_st_backfill(start: _dt.date, end: _dt.date, chunk_days: int, wait_seconds: int | None = None,
+                     priority: str = "backfill"):
+    """Backfill Sponsored Products SEARCH TERM data for [start, end] in chunks."""
+    _bf_set(last_event="ST backfill starting")
+    _run_ingest(("st",), start, end, chunk_days, wait_seconds, priority)
 
 # ====== KEYWORDS BACKFILL ======
 @app.post("/api/tasks/backfill_keywords")
@@ -2035,16 +3170,9 @@ def backfill_keywords(days: int = 65, chunk_days: int = 14, background_tasks: Ba
         background_tasks.add_task(_run_kw_backfill, start, end, chunk_days)
     return {"status":"QUEUED","type":"keywords","start":_ymd(start),"end":_ymd(end),"chunk_days":chunk_days}
 
-from datetime import datetime, timedelta, timezone
-import time, io, gzip, uuid, json as _json
-import httpx
-from sqlalchemy import text as _text
-
-def _run_kw_backfill(start: _dt.date, end: _dt.date, chunk_days: int, wait_seconds: int | None = None):
+def _run_kw_backfill(start: _dt.date, end: _dt.date, chunk_days: int, wait_seconds: int | None = None,
+                     priority: str = "backfill"):
     """Backfill Sponsored Products KEYWORD data for [start, end] in chunks."""
-    if wait_seconds is None:
-        wait_seconds = BACKFILL_WAIT_SECS
-
     # Mark job start
     BACKFILL_STATUS.update({
         "active": True,
@@ -2057,220 +3185,527 @@ def _run_kw_backfill(start: _dt.date, end: _dt.date, chunk_days: int, wait_secon
         "kw": {"processed": 0, "inserted": 0, "updated": 0, "errors": 0},
     })
     _bf_set(last_event="KW backfill starting")
+    _run_ingest(("kw",), start, end, chunk_days, wait_seconds, priority)
+
+# ====== INGEST PIPELINE ======
+# create + poll (caller thread) -> downloader pool -> parse pool -> one loader.
+# Stages are joined by small bounded queues, so a slow stage back-pressures the
+# ones before it and at most a few reports are held in memory. The loader keeps
+# its own connection for the whole run; while it upserts one chunk, the next
+# chunks (of every report type in the run) are downloading and parsing.
+
+INGEST_MAX_INFLIGHT_REPORTS = int(os.environ.get("INGEST_MAX_INFLIGHT_REPORTS", "4"))
+INGEST_DOWNLOAD_WORKERS = int(os.environ.get("INGEST_DOWNLOAD_WORKERS", "2"))
+INGEST_PARSE_WORKERS = int(os.environ.get("INGEST_PARSE_WORKERS", "2"))
+INGEST_QUEUE_DEPTH = int(os.environ.get("INGEST_QUEUE_DEPTH", "2"))
+
+_ST_BACKFILL_COLUMNS = [
+    "date",
+    "campaignId","campaignName",
+    "adGroupId","adGroupName",
+    "searchTerm","keywordId","keyword","matchType",
+    "impressions","clicks","spend",
+    "sales14d","purchases14d",
+    "clickThroughRate","costPerClick",
+    "acosClicks14d","roasClicks14d",
+]
+
+# columns allowed by SP reporting (v3)
+_KW_BACKFILL_COLUMNS = [
+    "date",
+    "campaignId","campaignName",
+    "adGroupId","adGroupName",
+    "keywordId","keyword","matchType",
+    "impressions","clicks","spend",
+    "sales14d","purchases14d",
+    "clickThroughRate","costPerClick",
+    "acosClicks14d","roasClicks14d",
+]
+
+class _IngestBatch:
+    """
+    Rows of one report (or report slice) held column-wise: counters in
+    array('q'), money in array('d'), repeated ids/names/dates interned, and
+    profile_id / run_id stored once per batch instead of once per row.
+    Derived ratios (cpc/ctr/acos/roas) are not stored; see _DERIVED_METRICS_SQL.
+    """
+    __slots__ = ("kind", "profile_id", "run_id", "seen",
+                 "date", "campaign_id", "campaign_name", "ad_group_id", "ad_group_name",
+                 "search_term", "keyword_id", "keyword_text", "match_type",
+                 "impressions", "clicks", "cost", "sales", "orders")
+
+    def __init__(self, kind: str, profile_id: str, run_id: str):
+        self.kind = kind
+        self.profile_id = profile_id
+        self.run_id = run_id
+        self.seen = 0
+        self.date, self.campaign_id, self.campaign_name = [], [], []
+        self.ad_group_id, self.ad_group_name = [], []
+        self.search_term = [] if kind == "st" else None
+        self.keyword_id, self.keyword_text, self.match_type = [], [], []
+        self.impressions, self.clicks, self.orders = array("q"), array("q"), array("q")
+        self.cost, self.sales = array("d"), array("d")
+
+    def __len__(self):
+        return len(self.date)
+
+    def add(self, obj: dict) -> bool:
+        self.seen += 1
+        ds = (obj.get("date") or obj.get("reportDate") or "")[:10]
+        if not ds:
+            return False
+        intern = sys.intern
+        self.date.append(intern(ds))
+        self.campaign_id.append(intern(str(obj.get("campaignId") or "")))
+        self.campaign_name.append(intern(obj.get("campaignName") or ""))
+        self.ad_group_id.append(intern(str(obj.get("adGroupId") or "")))
+        self.ad_group_name.append(intern(obj.get("adGroupName") or ""))
+        if self.search_term is not None:
+            self.search_term.append(obj.get("searchTerm") or "")
+        kid = str(obj.get("keywordId") or "")
+        self.keyword_id.append(intern(kid) if kid else None)
+        kt = obj.get("keyword")
+        self.keyword_text.append(intern(kt) if kt else None)
+        self.match_type.append(intern(obj.get("matchType") or ""))
+        self.impressions.append(int(obj.get("impressions") or 0))
+        self.clicks.append(int(obj.get("clicks") or 0))
+        self.cost.append(float(obj.get("spend") or obj.get("cost") or 0.0))
+        self.sales.append(float(obj.get("sales14d") or 0.0))
+        self.orders.append(int(obj.get("purchases14d") or 0))
+        return True
+
+    def stage_rows(self):
+        """Tuples in _INGEST_STAGE_COLUMNS order, for COPY."""
+        terms = self.search_term if self.search_term is not None else itertools.repeat(None)
+        return zip(itertools.count(), self.date, self.campaign_id, self.campaign_name,
+                   self.ad_group_id, self.ad_group_name, terms,
+                   self.keyword_id, self.keyword_text, self.match_type,
+                   self.impressions, self.clicks, self.cost, self.sales, self.orders)
+
+# Each load transaction COPYs a batch into an ON COMMIT DROP temp table and
+# merges it with one INSERT ... SELECT (works through PgBouncer transaction pooling).
+_INGEST_STAGE_COLUMNS = ("seq", "date", "campaign_id", "campaign_name", "ad_group_id", "ad_group_name",
+                         "search_term", "keyword_id", "keyword_text", "match_type",
+                         "impressions", "clicks", "cost", "sales", "orders")
+
+_INGEST_STAGE_DDL = _text("""
+    CREATE TEMP TABLE _ingest_stage (
+      seq integer, date date,
+      campaign_id text, campaign_name text, ad_group_id text, ad_group_name text,
+      search_term text, keyword_id text, keyword_text text, match_type text,
+      impressions bigint, clicks bigint, cost double precision, sales double precision, orders bigint
+    ) ON COMMIT DROP
+""")
 
-    access = _get_access_token_from_refresh()
-    headers = _ads_headers(access)
-    region  = os.environ.get("AMZN_REGION", "NA").upper()
-    ads_base = _ads_base(region)
-    pid = _env("AMZN_PROFILE_ID")
-
-    # columns allowed by SP reporting (v3)
-    columns = [
-        "date",
-        "campaignId","campaignName",
-        "adGroupId","adGroupName",
-        "keywordId","keyword","matchType",
-        "impressions","clicks","spend",
-        "sales14d","purchases14d",
-        "clickThroughRate","costPerClick",
-        "acosClicks14d","roasClicks14d",
-    ]
+_ST_MERGE_SQL = _text("""
+    INSERT INTO fact_sp_search_term_daily (
+        profile_id, date,
+        campaign_id, campaign_name,
+        ad_group_id, ad_group_name,
+        search_term, keyword_id, keyword_text, match_type,
+        impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+        run_id, pulled_at
+    )
+    SELECT
+        :pid, s.date,
+        s.campaign_id, s.campaign_name,
+        s.ad_group_id, s.ad_group_name,
+        s.search_term, s.keyword_id, s.keyword_text, s.match_type,
+        s.impressions, s.clicks, s.cost, s.sales, s.orders,
+        CAST(:run_id AS uuid), now()
+    FROM (
+        -- last occurrence wins when a report repeats a key (as the row-by-row upsert did)
+        SELECT DISTINCT ON (date, ad_group_id, search_term, match_type) *
+        FROM _ingest_stage
+        ORDER BY date, ad_group_id, search_term, match_type, seq DESC
+    ) s
+    ON CONFLICT (profile_id, date, ad_group_id, search_term, match_type) DO UPDATE SET
+        campaign_id = EXCLUDED.campaign_id,
+        campaign_name = EXCLUDED.campaign_name,
+        ad_group_id = EXCLUDED.ad_group_id,
+        ad_group_name = EXCLUDED.ad_group_name,
+        keyword_id = EXCLUDED.keyword_id,
+        keyword_text = EXCLUDED.keyword_text,
+        match_type = EXCLUDED.match_type,
+        impressions = EXCLUDED.impressions,
+        clicks = EXCLUDED.clicks,
+        cost = EXCLUDED.cost,
+        attributed_sales_14d = EXCLUDED.attributed_sales_14d,
+        attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
+        run_id = EXCLUDED.run_id,
+        pulled_at = now()
+""")
 
-    def _iter_records(text: str):
-        """Yield JSON records whether NDJSON or a JSON array/object."""
-        # try NDJSON
-        got = []
-        for line in text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                got.append(_json.loads(line))
-            except Exception:
-                got = []
-                break
-        if got:
-            for r in got:
-                yield r
-            return
-        # try whole JSON
-        try:
-            obj = _json.loads(text)
-        except Exception:
-            return
-        if isinstance(obj, list):
-            for item in obj:
-                yield item
-        elif isinstance(obj, dict):
-            yield obj
+_KW_MERGE_SQL = _text("""
+    INSERT INTO fact_sp_keyword_daily (
+        profile_id, date,
+        campaign_id, campaign_name,
+        ad_group_id, ad_group_name,
+        keyword_id, keyword_text, match_type,
+        impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+        run_id, pulled_at
+    )
+    SELECT
+        :pid, s.date,
+        s.campaign_id, s.campaign_name,
+        s.ad_group_id, s.ad_group_name,
+        s.keyword_id, s.keyword_text, s.match_type,
+        s.impressions, s.clicks, s.cost, s.sales, s.orders,
+        CAST(:run_id AS uuid), now()
+    FROM (
+        SELECT DISTINCT ON (date, keyword_id) *
+        FROM _ingest_stage
+        ORDER BY date, keyword_id, seq DESC
+    ) s
+    ON CONFLICT (profile_id, date, keyword_id) DO UPDATE SET
+        campaign_id = EXCLUDED.campaign_id,
+        campaign_name = EXCLUDED.campaign_name,
+        ad_group_id = EXCLUDED.ad_group_id,
+        ad_group_name = EXCLUDED.ad_group_name,
+        keyword_text = EXCLUDED.keyword_text,
+        match_type = EXCLUDED.match_type,
+        impressions = EXCLUDED.impressions,
+        clicks = EXCLUDED.clicks,
+        cost = EXCLUDED.cost,
+        attributed_sales_14d = EXCLUDED.attributed_sales_14d,
+        attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
+        run_id = EXCLUDED.run_id,
+        pulled_at = now()
+""")
 
-    cur = start
-    while cur <= end:
-        chunk_end = min(cur + _dt.timedelta(days=chunk_days - 1), end)
-        BACKFILL_STATUS["current_chunk"] = f"{cur.isoformat()} -> {chunk_end.isoformat()}"
-
-        # 1) create report
-        create_body = {
-            "name": f"KW {cur}..{chunk_end}",
-            "startDate": cur.isoformat(),
-            "endDate": chunk_end.isoformat(),
-            "configuration": {
-                "entity": "KEYWORD",
-                "groupBy": ["DAY"],
-                "columns": columns,
-                "timeUnit": "DAILY"
-            }
-        }
-        _bf_set(last_event="creating KW report")
-        r = _ads_request_with_refresh(
-            "POST",
-            f"{ads_base}/reporting/reports",
-            headers=headers,
-            json=create_body,
-        )
-        if r.status_code >= 400:
-            BACKFILL_STATUS["kw"]["errors"] += 1
-            _bf_set(last_error=f"KW create {r.status_code}: {r.text[:300]}")
-            raise HTTPException(status_code=502, detail={"stage":"kw_create","status":r.status_code,"body":r.text})
-        report_id = r.json().get("reportId")
-        _bf_set(last_event=f"KW report created: {report_id}")
-
-        # 2) poll for ready
-        status_url = f"{ads_base}/reporting/reports/{report_id}"
-        deadline = time.time() + wait_seconds
-        download_url = None
-        while time.time() < deadline:
-            sr = _ads_request_with_refresh("GET", status_url, headers=headers)
-            if sr.status_code >= 400:
-                BACKFILL_STATUS["kw"]["errors"] += 1
-                _bf_set(last_error=f"KW status {sr.status_code}: {sr.text[:300]}")
-                raise HTTPException(status_code=502, detail={"stage":"kw_status","status":sr.status_code,"body":sr.text})
-            meta = sr.json()
-            st = meta.get("status")
-            if st in ("SUCCESS", "COMPLETED") and meta.get("url"):
-                download_url = meta["url"]
-                break
-            time.sleep(5)
+_ST_MAP_HISTORY_FROM_STAGE_SQL = _text(_ST_MAP_HISTORY_SQL.format(source="""
+    SELECT DISTINCT ON (date, ad_group_id, search_term, match_type) *
+    FROM _ingest_stage
+    ORDER BY date, ad_group_id, search_term, match_type, seq DESC
+"""))
+
+_ST_DIM_FROM_STAGE_SQL = _text("""
+    INSERT INTO dim_sp_search_term (profile_id, search_term, first_seen, last_seen)
+    SELECT :pid, search_term, MIN(date), MAX(date)
+    FROM _ingest_stage
+    WHERE search_term <> ''
+    GROUP BY search_term
+    ON CONFLICT (profile_id, search_term) DO UPDATE SET
+      first_seen = LEAST(dim_sp_search_term.first_seen, EXCLUDED.first_seen),
+      last_seen  = GREATEST(dim_sp_search_term.last_seen, EXCLUDED.last_seen)
+""")
 
-        if not download_url:
-            BACKFILL_STATUS["kw"]["errors"] += 1
-            _bf_set(last_error="KW timeout waiting for report")
-            raise HTTPException(status_code=504, detail="KW timeout waiting for report")
+_INGEST_SPECS = {
+    "kw": {"label": "KW", "entity": "KEYWORD", "columns": _KW_BACKFILL_COLUMNS,
+           "before_merge": None, "merge": _KW_MERGE_SQL, "after_merge": None},
+    "st": {"label": "ST", "entity": "SEARCH_TERM", "columns": _ST_BACKFILL_COLUMNS,
+           "before_merge": _ST_MAP_HISTORY_FROM_STAGE_SQL, "merge": _ST_MERGE_SQL,
+           "after_merge": _ST_DIM_FROM_STAGE_SQL},
+}
 
-        _bf_set(last_event=f"KW report ready: {report_id}, downloading")
+def _copy_batch_to_stage(conn, batch: _IngestBatch) -> None:
+    """COPY a batch into _ingest_stage on the connection's current transaction."""
+    raw = conn.connection.driver_connection
+    cols = ", ".join(_INGEST_STAGE_COLUMNS)
+    with raw.cursor() as cur:
+        with cur.copy(f"COPY _ingest_stage ({cols}) FROM STDIN") as cp:
+            for row in batch.stage_rows():
+                cp.write_row(row)
+
+# ---- parsing: _IngestBatch per report, optionally fanned out to a process pool ----
+# Batches pickle back from pool processes far cheaper than lists of dicts
+# (arrays + shared interned strings). Large line-delimited reports are cut into
+# line-aligned byte ranges and parsed in INGEST_PARSE_PROCESSES processes
+# (0 = parse in the pipeline's threads).
+INGEST_PARSE_PROCESSES = int(os.environ.get("INGEST_PARSE_PROCESSES", "0"))
+INGEST_PROCESS_PARSE_MIN_BYTES = int(os.environ.get("INGEST_PROCESS_PARSE_MIN_BYTES", str(8 * 1024 * 1024)))
+INGEST_PARSE_RANGE_BYTES = int(os.environ.get("INGEST_PARSE_RANGE_BYTES", str(16 * 1024 * 1024)))
+_PARSE_POOL = None
+_PARSE_POOL_LOCK = threading.Lock()
+
+def _parse_pool():
+    """
+    ProcessPoolExecutor for big reports, or None; imported on first use (ingest-only).
+    Workers come from a forkserver (spawn where that is unavailable), never a plain fork:
+    the pipeline's downloader / loader / httpx threads may hold locks a forked child would
+    inherit. _IngestPipeline.run() creates the pool before it starts those threads.
+    """
+    global _PARSE_POOL
+    if INGEST_PARSE_PROCESSES <= 0:
+        return None
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _PARSE_POOL = ProcessPoolExecutor(max_workers=INGEST_PARSE_PROCESSES,
+                                              mp_context=multiprocessing.get_context(method))
+        return _PARSE_POOL
+
+def _records_to_batch(kind: str, records, pid: str, run_id: str) -> _IngestBatch:
+    batch = _IngestBatch(kind, pid, run_id)
+    for obj in records:
+        batch.add(obj)
+    return batch
+
+def _strip_record_line(line: bytes) -> bytes:
+    # NDJSON lines, or the lines of a one-record-per-line JSON array ("[{..},", "{..},", "{..}]")
+    return line.strip().lstrip(b"[").rstrip(b"]").rstrip().rstrip(b",")
+
+def _iter_line_records(chunk: bytes):
+    for line in chunk.splitlines():
+        line = _strip_record_line(line)
+        if not line:
+            continue
+        try:
+            obj = _json_loads(line)
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            yield obj
 
-        # 3) download (presigned S3 – no auth headers)
-        with httpx.Client(timeout=120) as client:
-            dr = client.get(download_url, headers={})
-            if dr.status_code >= 400:
-                BACKFILL_STATUS["kw"]["errors"] += 1
-                _bf_set(last_error=f"KW download {dr.status_code}: {dr.text[:300]}")
-                raise HTTPException(status_code=502, detail={"stage":"kw_download","status":dr.status_code,"body":dr.text})
+def _parse_report_range(kind: str, chunk: bytes, pid: str, run_id: str) -> _IngestBatch:
+    """Pool entry point: parse one line-aligned slice of a report into a batch."""
+    return _records_to_batch(kind, _iter_line_records(chunk), pid, run_id)
 
-        # 4) gunzip / parse
+def _line_delimited(raw: bytes) -> bool:
+    """
+    True when records are one per line, so the payload can be split on newlines.
+    A JSON array on a single line (what the Ads API usually returns) is not: it is
+    parsed serially, since cutting it on record boundaries would need a string-aware scan.
+    """
+    head = raw[:1 << 16]
+    if head.count(b"\n") < 2:
+        return False
+    for line in head.splitlines():
+        line = _strip_record_line(line)
+        if not line:
+            continue
+        try:
+            return isinstance(_json_loads(line), dict)
+        except ValueError:
+            return False
+    return False
+
+def _split_line_ranges(raw: bytes, range_bytes: int):
+    """Yield line-aligned slices of roughly range_bytes each."""
+    pos, n = 0, len(raw)
+    while pos < n:
+        cut = raw.find(b"\n", min(n, pos + range_bytes))
+        cut = n if cut == -1 else cut + 1
+        yield raw[pos:cut]
+        pos = cut
+
+def _q_put(q, item, stop: threading.Event) -> bool:
+    """Blocking put that gives up once the pipeline is stopping."""
+    while not stop.is_set():
         try:
-            buf = io.BytesIO(dr.content)
-            with gzip.GzipFile(fileobj=buf) as gz:
-                raw_text = gz.read().decode("utf-8")
-        except OSError:
-            raw_text = dr.content.decode("utf-8", errors="ignore")
+            q.put(item, timeout=1)
+            return True
+        except _queue.Full:
+            continue
+    return False
 
-        run_id = str(uuid.uuid4())
-        rows = []
-        parsed = 0
+def _q_get(q, stop: threading.Event):
+    """Blocking get; None means end of stream (sentinel or pipeline stopping)."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except _queue.Empty:
+            continue
+    return None
+
+class _IngestPipeline:
+    def __init__(self, kinds, wait_seconds: int, priority: str = "backfill"):
+        self.kinds = tuple(kinds)
+        self.wait_seconds = wait_seconds
+        self.priority = priority
+        self.pid = _env("AMZN_PROFILE_ID")
+        self.stop = threading.Event()
+        self.errors = []
+        self.download_q = _queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+        self.parse_q = _queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+        self.load_q = _queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+
+    def _fail(self, kind: str, stage: str, exc: Exception):
+        BACKFILL_STATUS[kind]["errors"] += 1
+        detail = exc.detail if isinstance(exc, HTTPException) else f"{type(exc).__name__}: {exc}"
+        _bf_set(last_error=f"{_INGEST_SPECS[kind]['label']} {stage}: {str(detail)[:300]}")
+        self.errors.append(HTTPException(status_code=getattr(exc, "status_code", 502),
+                                         detail={"stage": f"{kind}_{stage}", "error": detail}))
+        self.stop.set()
+
+    # ---- stage 1: create + poll (runs on the caller's thread) ----
+    def _produce(self, start: _dt.date, end: _dt.date, chunk_days: int):
+        access = _get_access_token_from_refresh()
+        headers = _ads_headers(access)
+        ads_base = _ads_base(os.environ.get("AMZN_REGION", "NA").upper())
+        poller = _ReportPoller(ads_base, headers, self.priority)
+        pending = ((k, cs, ce) for cs, ce in _chunk_ranges(start, end, chunk_days) for k in self.kinds)
+        inflight = {}
+
+        def _top_up():
+            while not self.stop.is_set() and len(inflight) < INGEST_MAX_INFLIGHT_REPORTS:
+                nxt = next(pending, None)
+                if nxt is None:
+                    return
+                kind, cs, ce = nxt
+                spec = _INGEST_SPECS[kind]
+                BACKFILL_STATUS["current_chunk"] = f"{cs.isoformat()} -> {ce.isoformat()}"
+                create_body = {
+                    "name": f"{spec['label']} {cs}..{ce}",
+                    "startDate": cs.isoformat(),
+                    "endDate": ce.isoformat(),
+                    "configuration": {
+                        "entity": spec["entity"],
+                        "groupBy": ["DAY"],
+                        "columns": spec["columns"],
+                        "timeUnit": "DAILY"
+                    }
+                }
+                try:
+                    rid, source = _request_report(ads_base, headers, create_body, self.priority)
+                except HTTPException as e:
+                    self._fail(kind, "create", e)
+                    return
+                _bf_set(last_event=f"{spec['label']} report {source}: {rid}")
+                inflight[rid] = {"kind": kind, "start": cs, "end": ce, "report_id": rid}
+                poller.add(rid, self.wait_seconds)
 
-        for rec in _iter_records(raw_text):
-            items = rec if isinstance(rec, list) else [rec]
-            for obj in items:
-                if not isinstance(obj, dict):
-                    continue
-                parsed += 1
-                ds = (obj.get("date") or obj.get("reportDate") or "")[:10]
-                if not ds:
+        _top_up()
+        for rid, meta in poller.as_completed():
+            job = inflight.pop(rid)
+            st = meta.get("status")
+            if st not in ("SUCCESS", "COMPLETED"):
+                code = 504 if st == "TIMEOUT" else 502
+                self._fail(job["kind"], "status", HTTPException(status_code=code, detail=meta))
+                return
+            _bf_set(last_event=f"{_INGEST_SPECS[job['kind']]['label']} report ready: {rid}, downloading")
+            job["url"] = meta["url"]
+            # blocks while downstream stages are saturated (backpressure)
+            if not _q_put(self.download_q, job, self.stop):
+                return
+            _top_up()
+
+    # ---- stage 2: download + gunzip ----
+    def _download_worker(self):
+        with httpx.Client(timeout=120) as client:
+            while True:
+                job = _q_get(self.download_q, self.stop)
+                if job is None:
+                    return
+                try:
+                    # presigned S3 – no auth headers
+                    dr = client.get(job["url"], headers={})
+                    if dr.status_code >= 400:
+                        raise HTTPException(status_code=502, detail={"status": dr.status_code, "body": dr.text})
+                    job["raw"] = _gunzip_report(dr.content)
+                except Exception as e:
+                    self._fail(job["kind"], "download", e)
+                    return
+                _q_put(self.parse_q, job, self.stop)
+
+    # ---- stage 3: parse + map ----
+    def _parse_worker(self):
+        while True:
+            job = _q_get(self.parse_q, self.stop)
+            if job is None:
+                return
+            raw = job.pop("raw")
+            run_id = str(uuid.uuid4())
+            try:
+                pool = _parse_pool() if len(raw) >= INGEST_PROCESS_PARSE_MIN_BYTES else None
+                if pool is not None and _line_delimited(raw):
+                    # one load job per range, so loading starts before the whole report is parsed
+                    futures = [pool.submit(_parse_report_range, job["kind"], part, self.pid, run_id)
+                               for part in _split_line_ranges(raw, INGEST_PARSE_RANGE_BYTES)]
+                    del raw
+                    for i, fut in enumerate(futures):
+                        part = {**job, "batch": fut.result(), "final": i == len(futures) - 1}
+                        if not _q_put(self.load_q, part, self.stop):
+                            return
                     continue
-
-                impressions = int(obj.get("impressions") or 0)
-                clicks = int(obj.get("clicks") or 0)
-                cost = float(obj.get("spend") or obj.get("cost") or 0.0)
-                sales = float(obj.get("sales14d") or 0.0)
-                orders = int(obj.get("purchases14d") or 0)
-
-                cpc  = round(cost / clicks, 6) if clicks else 0.0
-                ctr  = round(clicks / impressions, 6) if impressions else 0.0
-                acos = round(cost / sales, 6) if sales else 0.0
-                roas = round(sales / cost, 6) if cost else 0.0
-
-                rows.append({
-                    "profile_id": pid,
-                    "date": ds,
-                    "campaign_id": str(obj.get("campaignId") or "") or "",
-                    "campaign_name": obj.get("campaignName") or "",
-                    "ad_group_id": str(obj.get("adGroupId") or "") or "",
-                    "ad_group_name": obj.get("adGroupName") or "",
-                    "keyword_id": (str(obj.get("keywordId") or "") or None),
-                    "keyword_text": obj.get("keyword") or None,
-                    "match_type": obj.get("matchType") or "",
-                    "impressions": impressions,
-                    "clicks": clicks,
-                    "cost": cost,
-                    "attributed_sales_14d": sales,
-                    "attributed_conversions_14d": orders,
-                    "cpc": cpc, "ctr": ctr, "acos": acos, "roas": roas,
-                    "run_id": run_id,
-                })
-
-        BACKFILL_STATUS["kw"]["processed"] += parsed
-        if rows:
-            _bf_set(last_event=f"KW parsed {len(rows)} records")
-
-            upsert_sql = _text("""
-                INSERT INTO fact_sp_keywords_daily (
-                    profile_id, date,
-                    campaign_id, campaign_name,
-                    ad_group_id, ad_group_name,
-                    keyword_id, keyword_text, match_type,
-                    impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
-                    cpc, ctr, acos, roas, run_id, pulled_at
-                ) VALUES (
-                    :profile_id, :date,
-                    :campaign_id, :campaign_name,
-                    :ad_group_id, :ad_group_name,
-                    :keyword_id, :keyword_text, :match_type,
-                    :impressions, :clicks, :cost, :attributed_sales_14d, :attributed_conversions_14d,
-                    :cpc, :ctr, :acos, :roas, :run_id, now()
-                )
-                ON CONFLICT (profile_id, date, ad_group_id, keyword_text, match_type) DO UPDATE SET
-                    campaign_id = EXCLUDED.campaign_id,
-                    campaign_name = EXCLUDED.campaign_name,
-                    ad_group_id = EXCLUDED.ad_group_id,
-                    ad_group_name = EXCLUDED.ad_group_name,
-                    keyword_id = EXCLUDED.keyword_id,
-                    keyword_text = EXCLUDED.keyword_text,
-                    match_type = EXCLUDED.match_type,
-                    impressions = EXCLUDED.impressions,
-                    clicks = EXCLUDED.clicks,
-                    cost = EXCLUDED.cost,
-                    attributed_sales_14d = EXCLUDED.attributed_sales_14d,
-                    attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
-                    cpc = EXCLUDED.cpc,
-                    ctr = EXCLUDED.ctr,
-                    acos = EXCLUDED.acos,
-                    roas = EXCLUDED.roas,
-                    run_id = EXCLUDED.run_id,
-                    pulled_at = now()
-            """)
-
-            with engine.begin() as conn:
-                for i in range(0, len(rows), 1000):
-                    conn.execute(upsert_sql, rows[i:i+1000])
-
-            total_upserted = len(rows)
-            _bf_set(last_event=f"KW upserted {total_upserted} rows (insert/update split not tracked)")
-        else:
-            _bf_set(last_event="KW parsed 0 records (nothing to upsert)")
-
-        cur = chunk_end + _dt.timedelta(days=1)
-
+                batch = _records_to_batch(job["kind"], _iter_report_records(raw), self.pid, run_id)
+            except Exception as e:
+                self._fail(job["kind"], "parse", e)
+                return
+            job["batch"] = batch
+            _q_put(self.load_q, job, self.stop)
+
+    # ---- stage 4: load (single writer, own connection) ----
+    def _loader(self):
+        with engine.connect() as conn:
+            while True:
+                job = _q_get(self.load_q, self.stop)
+                if job is None:
+                    return
+                spec = _INGEST_SPECS[job["kind"]]
+                batch = job.pop("batch")
+                n = len(batch)
+                final = job.get("final", True)  # last (or only) batch of this report
+                try:
+                    if n or final:
+                        with conn.begin():
+                            if n:
+                                conn.execute(_INGEST_STAGE_DDL)
+                                _copy_batch_to_stage(conn, batch)
+                                params = {"pid": batch.profile_id, "run_id": batch.run_id}
+                                if spec["before_merge"] is not None:
+                                    conn.execute(spec["before_merge"], params)
+                                conn.execute(spec["merge"], params)
+                                if spec["after_merge"] is not None:
+                                    conn.execute(spec["after_merge"], params)
+                            if final:
+                                # every date of the report is now covered, including zero-row days
+                                _refresh_coverage(conn, batch.profile_id, job["kind"], job["start"], job["end"],
+                                                  batch.run_id)
+                except Exception as e:
+                    self._fail(job["kind"], "load", e)
+                    return
+                BACKFILL_STATUS[job["kind"]]["processed"] += batch.seen
+                if n:
+                    _bf_set(last_event=f"{spec['label']} upserted {n} rows for {job['start']}..{job['end']} "
+                                       f"(insert/update split not tracked)")
+                else:
+                    _bf_set(last_event=f"{spec['label']} parsed 0 records for {job['start']}..{job['end']} (nothing to upsert)")
+
+    def run(self, start: _dt.date, end: _dt.date, chunk_days: int):
+        _parse_pool()  # create the process pool before the pipeline threads start
+        downloaders = [threading.Thread(target=self._download_worker, name=f"ingest-dl-{i}", daemon=True)
+                       for i in range(max(1, INGEST_DOWNLOAD_WORKERS))]
+        parsers = [threading.Thread(target=self._parse_worker, name=f"ingest-parse-{i}", daemon=True)
+                   for i in range(max(1, INGEST_PARSE_WORKERS))]
+        loader = threading.Thread(target=self._loader, name="ingest-load", daemon=True)
+        for t in downloaders + parsers + [loader]:
+            t.start()
+        try:
+            self._produce(start, end, chunk_days)
+        except Exception as e:
+            self._fail(self.kinds[0], "produce", e)
+        finally:
+            # drain stage by stage: sentinels go in only after the upstream stage has exited
+            for workers, q in ((downloaders, self.download_q), (parsers, self.parse_q), ([loader], self.load_q)):
+                for _ in workers:
+                    _q_put(q, None, self.stop)
+                for t in workers:
+                    t.join()
+        if self.errors:
+            raise self.errors[0]
+
+def _run_ingest(kinds, start: _dt.date, end: _dt.date, chunk_days: int, wait_seconds: int | None = None,
+                priority: str = "backfill"):
+    """
+    Ingest one or more report types ("kw", "st") for [start, end] through one overlapped pipeline.
+    Search-term days already folded into the compact tier are skipped (re-loading them would
+    double count against the compacted sums).
+    """
+    if wait_seconds is None:
+        wait_seconds = BACKFILL_WAIT_SECS
+    floor = _retention_floor("st") if "st" in kinds else None
+    if floor and start < floor:
+        print(f"[ingest] search terms before {floor} are compacted; st starts at {floor}", flush=True)
+        older = tuple(k for k in kinds if k != "st")
+        if older:
+            _IngestPipeline(older, wait_seconds, priority).run(start, min(end, floor - _dt.timedelta(days=1)), chunk_days)
+        if end >= floor:
+            _IngestPipeline(kinds, wait_seconds, priority).run(floor, end, chunk_days)
+    else:
+        _IngestPipeline(kinds, wait_seconds, priority).run(start, end, chunk_days)
     BACKFILL_STATUS["active"] = False
     BACKFILL_STATUS["finished_at"] = _dt.datetime.now(tz=_dt.timezone.utc).isoformat()
 
@@ -2282,15 +3717,13 @@ def daily_ingest(background_tasks: BackgroundTasks):
     """
     y = _dt.date.today() - _dt.timedelta(days=1)
     # 1-day chunks, with daily (shorter) wait
-    background_tasks.add_task(_run_st_backfill, y, y, 1, DAILY_WAIT_SECS)
-    background_tasks.add_task(_run_kw_backfill, y, y, 1, DAILY_WAIT_SECS)
+    background_tasks.add_task(_run_st_backfill, y, y, 1, DAILY_WAIT_SECS, "daily")
+    background_tasks.add_task(_run_kw_backfill, y, y, 1, DAILY_WAIT_SECS, "daily")
     return {"status":"QUEUED","date":_ymd(y), "wait_seconds": DAILY_WAIT_SECS}
 
 # ================================
 # Daily ingest endpoint (cron-friendly)
 # ================================
-import datetime as _dt
-from fastapi import BackgroundTasks
 
 # Optional simple auth: set DAILY_INGEST_KEY in Render (e.g., supersecret123)
 DAILY_INGEST_KEY = os.environ.get("DAILY_INGEST_KEY", "").strip()
@@ -2323,8 +3756,13 @@ def daily_ingest(background_tasks: BackgroundTasks, key: str = "", date: str | N
         print(f"[daily_ingest] Starting for {target} (wait={DAILY_WAIT_SECS}s)")
         try:
             # One-day chunks + daily wait
-            _run_kw_backfill(target, target, chunk_days=1, wait_seconds=DAILY_WAIT_SECS)
-            _run_st_backfill(target, target, chunk_days=1, wait_seconds=DAILY_WAIT_SECS)
+            _bf_set(active=True, mode="daily", started_at=_dt.datetime.utcnow().isoformat(), finished_at=None,
+                    kw={"processed":0,"inserted":0,"updated":0,"errors":0},
+                    st={"processed":0,"inserted":0,"updated":0,"errors":0},
+                    last_error=None)
+            # both report types share one pipeline so their generation/download/load overlap
+            _run_ingest(("kw", "st"), target, target, chunk_days=1, wait_seconds=DAILY_WAIT_SECS, priority="daily")
+            _run_anomaly_detection_safe(target)
             print(f"[daily_ingest] ✅ Completed for {target}")
         except Exception as e:
             import traceback
@@ -2339,35 +3777,239 @@ def daily_ingest(background_tasks: BackgroundTasks, key: str = "", date: str | N
         "jobs": ["keywords", "search_terms"]
     }
 
+# ====== COVERAGE LEDGER ======
+# ingest_coverage holds one row per (profile, report type, day) with row count,
+# metric sums and the last run_id. Every loader refreshes the days it just
+# loaded (zero-row days included), so coverage and gap checks never scan facts.
+_COVERAGE_FACTS = {"kw": "fact_sp_keyword_daily", "st": "fact_sp_search_term_daily"}
+_COVERAGE_LABELS = {"kw": "keywords", "st": "search_terms"}
+COVERAGE_MIN_RATIO = float(os.environ.get("COVERAGE_MIN_RATIO", "0.5"))
+
+_COVERAGE_REFRESH_SQL = """
+    INSERT INTO ingest_coverage (
+        profile_id, report_type, date, row_count,
+        impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+        last_run_id, updated_at
+    )
+    SELECT
+        :pid, :kind, d.date, COALESCE(f.n, 0),
+        COALESCE(f.impressions, 0), COALESCE(f.clicks, 0), COALESCE(f.cost, 0),
+        COALESCE(f.sales, 0), COALESCE(f.orders, 0),
+        CAST(:run_id AS uuid), now()
+    FROM (
+        SELECT CAST(g AS date) AS date
+        FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') g
+    ) d
+    LEFT JOIN (
+        SELECT date, COUNT(*) AS n,
+               SUM(impressions) AS impressions, SUM(clicks) AS clicks, SUM(cost) AS cost,
+               SUM(attributed_sales_14d) AS sales, SUM(attributed_conversions_14d) AS orders
+        FROM {fact}
+        WHERE profile_id = :pid AND date BETWEEN CAST(:start AS date) AND CAST(:end AS date)
+        GROUP BY date
+    ) f ON f.date = d.date
+    ON CONFLICT (profile_id, report_type, date) DO UPDATE SET
+        row_count = EXCLUDED.row_count,
+        impressions = EXCLUDED.impressions,
+        clicks = EXCLUDED.clicks,
+        cost = EXCLUDED.cost,
+        attributed_sales_14d = EXCLUDED.attributed_sales_14d,
+        attributed_conversions_14d = EXCLUDED.attributed_conversions_14d,
+        last_run_id = COALESCE(EXCLUDED.last_run_id, ingest_coverage.last_run_id),
+        updated_at = now()
+"""
+
+def _refresh_coverage(conn, pid: str, kind: str, start, end, run_id: str | None = None) -> None:
+    """Recompute the ledger rows for [start, end] from the fact table (same transaction as the load)."""
+    conn.execute(text(_COVERAGE_REFRESH_SQL.format(fact=_COVERAGE_FACTS[kind])), {
+        "pid": pid, "kind": kind, "start": str(start), "end": str(end), "run_id": run_id,
+    })
+
+def _refresh_coverage_for_rows(conn, pid: str, kind: str, rows, run_id: str | None = None) -> None:
+    dates = [r["date"] for r in rows if r.get("date")]
+    if dates:
+        _refresh_coverage(conn, pid, kind, min(dates), max(dates), run_id)
+
+_COVERAGE_GAPS_SQL = text("""
+    WITH days AS (
+        SELECT CAST(g AS date) AS date
+        FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') g
+    ),
+    cov AS (
+        SELECT date, row_count
+        FROM ingest_coverage
+        WHERE profile_id = :pid AND report_type = :kind
+          AND date BETWEEN CAST(:start AS date) AND CAST(:end AS date)
+    ),
+    typical AS (
+        SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY row_count) AS med
+        FROM cov WHERE row_count > 0
+    )
+    SELECT d.date, c.row_count, t.med
+    FROM days d
+    LEFT JOIN cov c ON c.date = d.date
+    CROSS JOIN typical t
+    WHERE c.row_count IS NULL OR c.row_count < :min_ratio * COALESCE(t.med, 0)
+    ORDER BY d.date
+""")
+
+def _gap_kinds(kind: str) -> tuple:
+    if kind == "all":
+        return tuple(_COVERAGE_FACTS)
+    if kind not in _COVERAGE_FACTS:
+        raise HTTPException(status_code=400, detail="kind must be one of: all, kw, st")
+    return (kind,)
+
+def _gap_window(start: str | None, end: str | None) -> tuple[_dt.date, _dt.date]:
+    try:
+        e = _dt.date.fromisoformat(end) if end else _dt.date.today() - _dt.timedelta(days=1)
+        s = _dt.date.fromisoformat(start) if start else e - _dt.timedelta(days=59)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+    if s > e:
+        raise HTTPException(status_code=400, detail="start must be <= end")
+    return s, e
+
+def _shape_gaps(rows) -> dict:
+    missing, under = [], []
+    for r in rows:
+        if r["row_count"] is None:
+            missing.append(r["date"].isoformat())
+        else:
+            under.append({"date": r["date"].isoformat(), "rows": int(r["row_count"]),
+                          "typical": round(float(r["med"]), 1) if r["med"] is not None else None})
+    return {"missing": missing, "under_populated": under}
+
+def _date_ranges(dates) -> list[tuple[_dt.date, _dt.date]]:
+    """Collapse sorted dates into contiguous (start, end) ranges."""
+    out = []
+    for d in dates:
+        if out and d == out[-1][1] + _dt.timedelta(days=1):
+            out[-1] = (out[-1][0], d)
+        else:
+            out.append((d, d))
+    return out
+
+def _coverage_heal_plan(start: _dt.date, end: _dt.date, kinds, min_ratio: float = COVERAGE_MIN_RATIO) -> dict:
+    """{kind: [(range_start, range_end), ...]} of the days that need (re)ingesting."""
+    pid = _env("AMZN_PROFILE_ID")
+    plan = {}
+    floors = {k: _retention_floor(k) for k in kinds}
+    with engine.begin() as conn:
+        for k in kinds:
+            s = max(start, floors[k]) if floors[k] else start
+            if s > end:
+                continue
+            rows = conn.execute(_COVERAGE_GAPS_SQL, {
+                "pid": pid, "kind": k, "start": s, "end": end, "min_ratio": min_ratio,
+            }).mappings().all()
+            ranges = _date_ranges([r["date"] for r in rows])
+            if ranges:
+                plan[k] = ranges
+    return plan
+
 @app.get("/api/debug/coverage")
-def debug_coverage():
-    if not engine:
+async def debug_coverage():
+    if not async_engine:
         raise HTTPException(status_code=500, detail="Database not configured")
     pid = _env("AMZN_PROFILE_ID")
-    with engine.begin() as conn:
-        kw = conn.execute(text("""
-            SELECT MIN(date) AS min_date, MAX(date) AS max_date, COUNT(*) AS total
-            FROM fact_sp_keyword_daily
-            WHERE profile_id = :pid
-        """), {"pid": pid}).mappings().first()
-        st = conn.execute(text("""
-            SELECT MIN(date) AS min_date, MAX(date) AS max_date, COUNT(*) AS total
-            FROM fact_sp_search_term_daily
+    async with (await _read_engine()).connect() as conn:
+        res = (await conn.execute(text("""
+            SELECT report_type, MIN(date) AS min_date, MAX(date) AS max_date,
+                   SUM(row_count) AS total, COUNT(*) AS days, MAX(updated_at) AS updated_at
+            FROM ingest_coverage
             WHERE profile_id = :pid
-        """), {"pid": pid}).mappings().first()
-    return {
-        "keywords": {
-            "min_date": kw["min_date"].isoformat() if kw["min_date"] else None,
-            "max_date": kw["max_date"].isoformat() if kw["max_date"] else None,
-            "rows": int(kw["total"] or 0),
-        },
-        "search_terms": {
-            "min_date": st["min_date"].isoformat() if st["min_date"] else None,
-            "max_date": st["max_date"].isoformat() if st["max_date"] else None,
-            "rows": int(st["total"] or 0),
+            GROUP BY report_type
+        """), {"pid": pid})).mappings().all()
+    by_kind = {r["report_type"]: r for r in res}
+    out = {}
+    for kind, label in _COVERAGE_LABELS.items():
+        r = by_kind.get(kind)
+        out[label] = {
+            "min_date": r["min_date"].isoformat() if r else None,
+            "max_date": r["max_date"].isoformat() if r else None,
+            "rows": int(r["total"] or 0) if r else 0,
+            "days": int(r["days"]) if r else 0,
+            "updated_at": r["updated_at"].isoformat() if r else None,
         }
+    return out
+
+@app.get("/api/sp/coverage_gaps")
+async def sp_coverage_gaps(start: str | None = None, end: str | None = None, kind: str = "all",
+                           min_ratio: float = COVERAGE_MIN_RATIO):
+    """
+    Missing days (never ingested) and under-populated days (row count below
+    min_ratio x the window's median) per report type, from the coverage ledger.
+    """
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    s, e = _gap_window(start, end)
+    pid = _env("AMZN_PROFILE_ID")
+    out = {"start": s.isoformat(), "end": e.isoformat(), "min_ratio": min_ratio}
+    async with (await _read_engine()).connect() as conn:
+        for k in _gap_kinds(kind):
+            rows = (await conn.execute(_COVERAGE_GAPS_SQL, {
+                "pid": pid, "kind": k, "start": s, "end": e, "min_ratio": min_ratio,
+            })).mappings().all()
+            out[_COVERAGE_LABELS[k]] = _shape_gaps(rows)
+    return out
+
+@app.api_route("/api/tasks/heal_coverage", methods=["GET", "POST"])
+def heal_coverage(background_tasks: BackgroundTasks, start: str | None = None, end: str | None = None,
+                  kind: str = "all", min_ratio: float = COVERAGE_MIN_RATIO, chunk: int = 7,
+                  dry_run: bool = False, key: str = ""):
+    """Backfill exactly the missing / under-populated days found by coverage_gaps."""
+    if DAILY_INGEST_KEY and key != DAILY_INGEST_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    if chunk < 1 or chunk > 30:
+        raise HTTPException(status_code=400, detail="chunk must be between 1 and 30 days")
+    s, e = _gap_window(start, end)
+    plan = _coverage_heal_plan(s, e, _gap_kinds(kind), min_ratio)
+
+    def _job():
+        _bf_set(active=True, mode="heal", started_at=_dt.datetime.utcnow().isoformat(), finished_at=None,
+                kw={"processed":0,"inserted":0,"updated":0,"errors":0},
+                st={"processed":0,"inserted":0,"updated":0,"errors":0},
+                last_error=None)
+        try:
+            for k, ranges in plan.items():
+                for rs, re_ in ranges:
+                    _run_ingest((k,), rs, re_, chunk_days=chunk, wait_seconds=BACKFILL_WAIT_SECS)
+        except Exception as ex:
+            _bf_set(last_error=f"{type(ex).__name__}: {ex}")
+            raise
+        finally:
+            _bf_set(active=False, finished_at=_dt.datetime.utcnow().isoformat())
+
+    if plan and not dry_run:
+        background_tasks.add_task(_job)
+    return {
+        "status": "QUEUED" if plan and not dry_run else ("DRY_RUN" if plan else "NOTHING_TO_HEAL"),
+        "ranges": {_COVERAGE_LABELS[k]: [[a.isoformat(), b.isoformat()] for a, b in r] for k, r in plan.items()},
     }
 
+@app.post("/api/tasks/rebuild_coverage")
+def rebuild_coverage(kind: str = "all", key: str = ""):
+    """Seed / repair the coverage ledger from the fact tables (one full scan per type)."""
+    if DAILY_INGEST_KEY and key != DAILY_INGEST_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    out = {}
+    with engine.begin() as conn:
+        for k in _gap_kinds(kind):
+            lo, hi = conn.execute(text(f"SELECT MIN(date), MAX(date) FROM {_COVERAGE_FACTS[k]} WHERE profile_id = :pid"),
+                                  {"pid": pid}).one()
+            if lo is None:
+                out[_COVERAGE_LABELS[k]] = {"days": 0}
+                continue
+            _refresh_coverage(conn, pid, k, lo, hi)
+            out[_COVERAGE_LABELS[k]] = {"start": lo.isoformat(), "end": hi.isoformat(), "days": (hi - lo).days + 1}
+    return out
+
 # Backfill any date range (runs both KW + ST) in background
 @app.api_route("/api/tasks/backfill_range", methods=["GET", "POST"])
 def backfill_range(background_tasks: BackgroundTasks, start: str, end: str, chunk: int = 7, key: str = ""):
@@ -2393,8 +4035,7 @@ def backfill_range(background_tasks: BackgroundTasks, start: str, end: str, chun
                 st={"processed":0,"inserted":0,"updated":0,"errors":0},
                 last_error=None)
         try:
-            _run_kw_backfill(s, e, chunk_days=chunk, wait_seconds=BACKFILL_WAIT_SECS)
-            _run_st_backfill(s, e, chunk_days=chunk, wait_seconds=BACKFILL_WAIT_SECS)
+            _run_ingest(("kw", "st"), s, e, chunk_days=chunk, wait_seconds=BACKFILL_WAIT_SECS)
         except Exception as ex:
             _bf_set(last_error=f"{type(ex).__name__}: {ex}")
             raise
@@ -2449,24 +4090,1363 @@ def run_day_sync(date: str, key: str = ""):
             last_error=None)
     try:
         wait = int(os.environ.get("DAILY_WAIT_SECS", "900"))  # 15m default
-        _run_kw_backfill(d, d, chunk_days=1, wait_seconds=wait)
-        _run_st_backfill(d, d, chunk_days=1, wait_seconds=wait)
+        _run_ingest(("kw", "st"), d, d, chunk_days=1, wait_seconds=wait, priority="daily")
         return {"ok": True, "date": date, "status": BACKFILL_STATUS}
     finally:
         import datetime as _dt
         _bf_set(active=False, finished_at=_dt.datetime.utcnow().isoformat())
 
-def _ads_request_with_refresh(method: str, url: str, headers: dict, json: dict | None = None, timeout: int = 60):
+# ====== ADS API SCHEDULER ======
+# Every Ads API call goes through ADS_SCHEDULER: one token bucket per endpoint
+# class, strict priority among waiting callers (daily > backfill > debug), and a
+# bucket-wide pause whenever Amazon answers 429 (honouring Retry-After).
+
+ADS_PRIORITIES = {"daily": 0, "backfill": 1, "debug": 2}
+ADS_MAX_RETRIES = int(os.environ.get("ADS_MAX_RETRIES", "6"))
+ADS_BACKOFF_BASE_SECS = float(os.environ.get("ADS_BACKOFF_BASE_SECS", "1.0"))
+ADS_BACKOFF_MAX_SECS = float(os.environ.get("ADS_BACKOFF_MAX_SECS", "60"))
+
+def _rate_env(name: str, default: str) -> tuple[float, float]:
+    """ADS_RATE_<BUCKET>="<requests per second>,<burst>"."""
+    rate, burst = os.environ.get(f"ADS_RATE_{name.upper()}", default).split(",")
+    return float(rate), float(burst)
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = _time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class _AdsScheduler:
+    def __init__(self, rates: dict):
+        self._cv = threading.Condition()
+        self._buckets = {name: _TokenBucket(*rb) for name, rb in rates.items()}
+        self._paused_until = {name: 0.0 for name in rates}
+        self._waiting = {name: [] for name in rates}   # heaps of (priority, seq)
+        self._seq = itertools.count()
+        self.stats = {name: {"granted": 0, "throttled": 0, "retries": 0} for name in rates}
+
+    def acquire(self, bucket: str, priority: str = "backfill"):
+        ticket = (ADS_PRIORITIES.get(priority, len(ADS_PRIORITIES)), next(self._seq))
+        with self._cv:
+            queue = self._waiting[bucket]
+            heapq.heappush(queue, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if queue[0] == ticket:
+                        now = _time.monotonic()
+                        timeout = max(self._paused_until[bucket] - now, self._buckets[bucket].wait_time(now))
+                        if timeout <= 0:
+                            self._buckets[bucket].take()
+                            self.stats[bucket]["granted"] += 1
+                            return
+                    self._cv.wait(timeout)
+            finally:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._cv.notify_all()
+
+    def throttle(self, bucket: str, seconds: float):
+        with self._cv:
+            self._paused_until[bucket] = max(self._paused_until[bucket], _time.monotonic() + seconds)
+            self.stats[bucket]["throttled"] += 1
+
+    def snapshot(self) -> dict:
+        now = _time.monotonic()
+        with self._cv:
+            return {
+                name: {
+                    "rate_per_sec": b.rate,
+                    "burst": b.capacity,
+                    "paused_for_secs": round(max(0.0, self._paused_until[name] - now), 1),
+                    "waiting": len(self._waiting[name]),
+                    **self.stats[name],
+                }
+                for name, b in self._buckets.items()
+            }
+
+ADS_SCHEDULER = _AdsScheduler({
+    "report_create": _rate_env("report_create", "0.5,2"),
+    "report_status": _rate_env("report_status", "2,5"),
+    "default": _rate_env("default", "2,5"),
+})
+
+def _ads_bucket(method: str, url: str) -> str:
+    path = urllib.parse.urlparse(url).path.rstrip("/")
+    if path == "/reporting/reports":
+        return "report_create" if method.upper() == "POST" else "default"
+    if path.startswith("/reporting/reports/"):
+        return "report_status"
+    return "default"
+
+def _retry_after_secs(r) -> float | None:
+    v = r.headers.get("Retry-After")
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(v) - _dt.datetime.now(_dt.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_secs(attempt: int) -> float:
+    # "full jitter" exponential backoff
+    return random.uniform(0, min(ADS_BACKOFF_MAX_SECS, ADS_BACKOFF_BASE_SECS * (2 ** attempt)))
+
+def _ads_request_with_refresh(method: str, url: str, headers: dict, json: dict | None = None,
+                              timeout: int = 60, priority: str = "backfill"):
     """
-    Make an Amazon Ads API request. If the access token is expired,
-    refresh it once and retry automatically.
+    Make an Amazon Ads API request through ADS_SCHEDULER. If the access token is
+    expired, refresh it once (updating `headers` in place for later calls) and
+    retry. 429/5xx and transport errors are retried with Retry-After or jittered
+    exponential backoff. The final response is returned as-is; callers check
+    status_code themselves.
     """
+    bucket = _ads_bucket(method, url)
+    refreshed = False
     with httpx.Client(timeout=timeout) as client:
-        r = client.request(method, url, headers=headers, json=json)
-        if r.status_code == 401:
-            # Refresh once
-            access = _get_access_token_from_refresh()
-            new_headers = _ads_headers(access)
-            r = client.request(method, url, headers=new_headers, json=json)
-        r.raise_for_status()
-        return r
+        attempt = 0
+        while True:
+            ADS_SCHEDULER.acquire(bucket, priority)
+            try:
+                r = client.request(method, url, headers=headers, json=json)
+            except httpx.TransportError as e:
+                if attempt >= ADS_MAX_RETRIES:
+                    raise
+                delay = _backoff_secs(attempt)
+                print(f"[ads] {method} {bucket} transport error {type(e).__name__}; retry in {delay:.1f}s", flush=True)
+            else:
+                if r.status_code == 401 and not refreshed:
+                    # Refresh once
+                    headers.update(_ads_headers(_get_access_token_from_refresh(force=True)))
+                    refreshed = True
+                    continue
+                if r.status_code != 429 and r.status_code < 500:
+                    return r
+                if attempt >= ADS_MAX_RETRIES:
+                    return r
+                delay = _retry_after_secs(r)
+                if delay is None:
+                    delay = _backoff_secs(attempt)
+                if r.status_code == 429:
+                    ADS_SCHEDULER.throttle(bucket, delay)
+                print(f"[ads] {method} {bucket} HTTP {r.status_code} ({priority}); retry {attempt + 1}/{ADS_MAX_RETRIES} in {delay:.1f}s", flush=True)
+            ADS_SCHEDULER.stats[bucket]["retries"] += 1
+            attempt += 1
+            _time.sleep(delay)
+
+@app.get("/api/debug/ads_scheduler")
+def ads_scheduler_status():
+    snap = ADS_SCHEDULER.snapshot()
+    snap["report_polling"] = {
+        rtype: {**st, "polls_per_report": round(st["polls"] / st["reports"], 2) if st["reports"] else None}
+        for rtype, st in REPORT_POLL_STATS.items()
+    }
+    snap["expected_generation_secs"] = {f"{t}:{b}": round(v, 1) for (t, b), v in _REPORT_HISTORY["by_bucket"].items()}
+    return snap
+
+# ====== SEARCH-TERM HARVESTING ======
+# Set-based: one INSERT ... SELECT aggregates every (ad group, search term) in the
+# window and classifies it, so millions of term-days are handled in one pass.
+HARVEST_PROMOTE_MIN_ORDERS = int(os.environ.get("HARVEST_PROMOTE_MIN_ORDERS", "2"))
+HARVEST_PROMOTE_MAX_ACOS = os.environ.get("HARVEST_PROMOTE_MAX_ACOS")  # e.g. "0.35"; unset = no ACoS cap
+HARVEST_NEGATE_MIN_SPEND = float(os.environ.get("HARVEST_NEGATE_MIN_SPEND", "500"))
+HARVEST_NEGATE_MIN_CLICKS = int(os.environ.get("HARVEST_NEGATE_MIN_CLICKS", "10"))
+
+_HARVEST_SQL = text("""
+    WITH agg AS (
+        SELECT campaign_id, ad_group_id, search_term,
+               MAX(campaign_name) AS campaign_name,
+               MAX(ad_group_name) AS ad_group_name,
+               SUM(impressions) AS impressions,
+               SUM(clicks) AS clicks,
+               SUM(cost) AS cost,
+               SUM(attributed_sales_14d) AS sales,
+               SUM(attributed_conversions_14d) AS orders
+        FROM v_sp_search_term_all
+        WHERE profile_id = :pid
+          AND date BETWEEN :start_d AND :end_d
+          AND search_term <> '(other)'
+        GROUP BY campaign_id, ad_group_id, search_term
+    ),
+    exact_kw AS (
+        SELECT DISTINCT lower(keyword_text) AS kw
+        FROM fact_sp_keyword_daily
+        WHERE profile_id = :pid
+          AND upper(match_type) = 'EXACT'
+    ),
+    classified AS (
+        SELECT a.*,
+               a.cost / NULLIF(a.sales, 0) AS acos,
+               CASE
+                 WHEN a.orders >= :promote_min_orders
+                      AND (CAST(:promote_max_acos AS numeric) IS NULL
+                           OR a.cost / NULLIF(a.sales, 0) <= CAST(:promote_max_acos AS numeric))
+                      AND e.kw IS NULL
+                   THEN 'promote'
+                 WHEN a.orders = 0
+                      AND a.cost >= :negate_min_spend
+                      AND a.clicks >= :negate_min_clicks
+                   THEN 'negate'
+               END AS kind
+        FROM agg a
+        LEFT JOIN exact_kw e ON e.kw = lower(a.search_term)
+    )
+    INSERT INTO sp_search_term_candidates (
+        profile_id, window_start, window_end, kind,
+        campaign_id, campaign_name, ad_group_id, ad_group_name, search_term,
+        impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d, acos,
+        run_id
+    )
+    SELECT :pid, :start_d, :end_d, kind,
+           campaign_id, campaign_name, ad_group_id, ad_group_name, search_term,
+           impressions, clicks, cost, sales, orders, acos,
+           :run_id
+    FROM classified
+    WHERE kind IS NOT NULL
+""")
+
+def _run_harvest(start: _dt.date, end: _dt.date,
+                 promote_min_orders: int | None = None,
+                 promote_max_acos: float | None = None,
+                 negate_min_spend: float | None = None,
+                 negate_min_clicks: int | None = None) -> dict:
+    """
+    Recompute promote/negate candidates for [start, end], replacing any previous
+    result for the same window. Promote: converting terms that are not yet an
+    EXACT keyword anywhere in the profile. Negate: spend/clicks above threshold
+    with zero orders.
+    """
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    if promote_max_acos is None and HARVEST_PROMOTE_MAX_ACOS:
+        promote_max_acos = float(HARVEST_PROMOTE_MAX_ACOS)
+    params = {
+        "pid": pid,
+        "start_d": start,
+        "end_d": end,
+        "promote_min_orders": HARVEST_PROMOTE_MIN_ORDERS if promote_min_orders is None else promote_min_orders,
+        "promote_max_acos": promote_max_acos,
+        "negate_min_spend": HARVEST_NEGATE_MIN_SPEND if negate_min_spend is None else negate_min_spend,
+        "negate_min_clicks": HARVEST_NEGATE_MIN_CLICKS if negate_min_clicks is None else negate_min_clicks,
+        "run_id": str(uuid.uuid4()),
+    }
+    t0 = _time.time()
+    with engine.begin() as conn:
+        conn.execute(text("""
+            DELETE FROM sp_search_term_candidates
+            WHERE profile_id = :pid AND window_start = :start_d AND window_end = :end_d
+        """), {"pid": pid, "start_d": start, "end_d": end})
+        conn.execute(_HARVEST_SQL, params)
+        counts = conn.execute(text("""
+            SELECT kind, COUNT(*) AS n
+            FROM sp_search_term_candidates
+            WHERE profile_id = :pid AND window_start = :start_d AND window_end = :end_d
+            GROUP BY kind
+        """), {"pid": pid, "start_d": start, "end_d": end}).mappings().all()
+    out = {
+        "window_start": start.isoformat(),
+        "window_end": end.isoformat(),
+        "run_id": params["run_id"],
+        "promote": 0,
+        "negate": 0,
+        "seconds": round(_time.time() - t0, 3),
+    }
+    for r in counts:
+        out[r["kind"]] = int(r["n"])
+    print(f"[harvest] {out}", flush=True)
+    return out
+
+@app.api_route("/api/tasks/harvest", methods=["GET", "POST"])
+def harvest(
+    start: str,
+    end: str,
+    key: str = "",
+    promote_min_orders: int | None = None,
+    promote_max_acos: float | None = None,
+    negate_min_spend: float | None = None,
+    negate_min_clicks: int | None = None,
+):
+    if DAILY_INGEST_KEY and key != DAILY_INGEST_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        s = _dt.date.fromisoformat(start)
+        e = _dt.date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+    if s > e:
+        raise HTTPException(status_code=400, detail="start must be <= end")
+    return _run_harvest(s, e, promote_min_orders, promote_max_acos, negate_min_spend, negate_min_clicks)
+
+@app.get("/api/sp/harvest_candidates")
+async def harvest_candidates(
+    kind: str = Query("promote", pattern="^(promote|negate)$"),
+    start: str | None = None,
+    end: str | None = None,
+    limit: int = Query(200, ge=1, le=5000),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Candidates for one window (defaults to the most recently computed window),
+    sorted by orders for `promote` and by spend for `negate`.
+    """
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    async with (await _read_engine()).connect() as conn:
+        if start and end:
+            try:
+                ws, we = _dt.date.fromisoformat(start), _dt.date.fromisoformat(end)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+        else:
+            latest = (await conn.execute(text("""
+                SELECT window_start, window_end
+                FROM sp_search_term_candidates
+                WHERE profile_id = :pid
+                ORDER BY window_end DESC, computed_at DESC
+                LIMIT 1
+            """), {"pid": pid})).mappings().first()
+            if not latest:
+                return {"window_start": None, "window_end": None, "kind": kind, "rows": []}
+            ws, we = latest["window_start"], latest["window_end"]
+
+        order = "attributed_conversions_14d DESC, cost ASC" if kind == "promote" else "cost DESC"
+        rows = (await conn.execute(text(f"""
+            SELECT campaign_id, campaign_name, ad_group_id, ad_group_name, search_term,
+                   impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d, acos,
+                   run_id, computed_at
+            FROM sp_search_term_candidates
+            WHERE profile_id = :pid AND window_start = :ws AND window_end = :we AND kind = :kind
+            ORDER BY {order}
+            LIMIT :lim OFFSET :off
+        """), {"pid": pid, "ws": ws, "we": we, "kind": kind, "lim": limit, "off": offset})).mappings().all()
+
+    return {
+        "window_start": ws.isoformat(),
+        "window_end": we.isoformat(),
+        "kind": kind,
+        "rows": [{
+            "campaign_id": r["campaign_id"],
+            "campaign_name": r["campaign_name"],
+            "ad_group_id": r["ad_group_id"],
+            "ad_group_name": r["ad_group_name"],
+            "search_term": r["search_term"],
+            "impressions": int(r["impressions"]),
+            "clicks": int(r["clicks"]),
+            "cost": float(r["cost"]),
+            "sales_14d": float(r["attributed_sales_14d"]),
+            "orders_14d": int(r["attributed_conversions_14d"]),
+            "acos": float(r["acos"]) if r["acos"] is not None else None,
+            "run_id": str(r["run_id"]),
+            "computed_at": r["computed_at"].isoformat(),
+        } for r in rows],
+    }
+
+# ====== ANOMALY DETECTION ======
+# Runs after ingest: loads the trailing window for every entity active on the
+# target day into (entities x days) NumPy matrices and scores the target day
+# against a robust median/MAD baseline for all entities at once.
+ANOMALY_WINDOW_DAYS = int(os.environ.get("ANOMALY_WINDOW_DAYS", "28"))
+ANOMALY_MIN_HISTORY_DAYS = int(os.environ.get("ANOMALY_MIN_HISTORY_DAYS", "7"))
+ANOMALY_Z = float(os.environ.get("ANOMALY_Z", "4.0"))
+ANOMALY_MIN_SPEND = float(os.environ.get("ANOMALY_MIN_SPEND", "100"))
+ANOMALY_MIN_IMPRESSIONS = int(os.environ.get("ANOMALY_MIN_IMPRESSIONS", "200"))
+ANOMALY_AFTER_INGEST = os.environ.get("ANOMALY_AFTER_INGEST", "1") == "1"
+
+_ANOMALY_SOURCES = {
+    "kw": {
+        "table": "fact_sp_keyword_daily",
+        "key": "keyword_id",
+        "label": "keyword_text || ' [' || match_type || ']'",
+    },
+    "st": {
+        "table": "fact_sp_search_term_daily",
+        "key": "ad_group_id || '|' || search_term || '|' || match_type",
+        "label": "search_term || ' / ' || ad_group_name",
+    },
+}
+
+def _score_anomalies(codes, day_idx, impressions, clicks, cost, n_ent: int, n_days: int) -> list[tuple]:
+    """
+    Vectorized scoring. Inputs are flat per-row arrays (entity code, day index,
+    metrics); the last day index is the target day, earlier ones the baseline.
+    Returns (entity_code, metric, value, baseline, mad, score) tuples.
+    """
+    import numpy as np
+
+    imp = np.zeros((n_ent, n_days))
+    clk = np.zeros((n_ent, n_days))
+    spend = np.zeros((n_ent, n_days))
+    np.add.at(imp, (codes, day_idx), impressions)
+    np.add.at(clk, (codes, day_idx), clicks)
+    np.add.at(spend, (codes, day_idx), cost)
+
+    cur_spend = spend[:, -1]
+    served = imp[:, :-1] > 0
+    active_days = served.sum(axis=1)
+    has_history = active_days >= ANOMALY_MIN_HISTORY_DAYS
+
+    # spend spikes: baseline over the days the entity was served. Counting idle
+    # days as zero would give anything live on under half the window a zero
+    # median / MAD, and every ordinary day of it would score as a spike.
+    base_spend = np.where(served, spend[:, :-1], np.nan)
+    med = np.zeros(n_ent)
+    mad = np.zeros(n_ent)
+    if has_history.any():
+        med[has_history] = np.nanmedian(base_spend[has_history], axis=1)
+        mad[has_history] = np.nanmedian(np.abs(base_spend[has_history] - med[has_history][:, None]), axis=1)
+    scale = np.maximum(1.4826 * mad, np.maximum(0.1 * med, 1.0))
+    spend_z = (cur_spend - med) / scale
+    spend_hit = has_history & (cur_spend >= ANOMALY_MIN_SPEND) & (spend_z >= ANOMALY_Z)
+
+    # CTR collapses: only days with enough impressions count towards the baseline
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ctr = np.where(imp >= ANOMALY_MIN_IMPRESSIONS / 4, clk / imp, np.nan)
+    base_ctr, cur_ctr = ctr[:, :-1], ctr[:, -1]
+    ctr_days = np.sum(~np.isnan(base_ctr), axis=1)
+    ok = (ctr_days >= ANOMALY_MIN_HISTORY_DAYS) & (imp[:, -1] >= ANOMALY_MIN_IMPRESSIONS)
+    ctr_med = np.full(n_ent, np.nan)
+    ctr_mad = np.full(n_ent, np.nan)
+    if ok.any():
+        ctr_med[ok] = np.nanmedian(base_ctr[ok], axis=1)
+        ctr_mad[ok] = np.nanmedian(np.abs(base_ctr[ok] - ctr_med[ok][:, None]), axis=1)
+    ctr_scale = np.maximum(1.4826 * np.nan_to_num(ctr_mad), 0.1 * np.nan_to_num(ctr_med) + 1e-9)
+    with np.errstate(invalid="ignore"):
+        ctr_z = (cur_ctr - ctr_med) / ctr_scale
+        ctr_hit = ok & (ctr_med > 0) & (ctr_z <= -ANOMALY_Z)
+
+    out = []
+    for i in np.flatnonzero(spend_hit):
+        out.append((int(i), "spend", float(cur_spend[i]), float(med[i]), float(mad[i]), float(spend_z[i])))
+    for i in np.flatnonzero(ctr_hit):
+        out.append((int(i), "ctr", float(cur_ctr[i]), float(ctr_med[i]), float(ctr_mad[i]), float(ctr_z[i])))
+    return out
+
+def _run_anomaly_detection(target: _dt.date, sources=("kw", "st")) -> dict:
+    """Score `target` for every entity active that day and replace its rows in sp_metric_anomalies."""
+    import numpy as np
+
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    start = target - _dt.timedelta(days=ANOMALY_WINDOW_DAYS)
+    n_days = ANOMALY_WINDOW_DAYS + 1
+    run_id = str(uuid.uuid4())
+    summary = {"date": target.isoformat(), "run_id": run_id}
+
+    for source in sources:
+        cfg = _ANOMALY_SOURCES[source]
+        t0 = _time.time()
+        q = text(f"""
+            WITH active AS (
+                SELECT DISTINCT {cfg['key']} AS k
+                FROM {cfg['table']}
+                WHERE profile_id = :pid AND date = :target
+            )
+            SELECT {cfg['key']} AS k, date - CAST(:start_d AS date) AS d,
+                   impressions, clicks, cost
+            FROM {cfg['table']}
+            WHERE profile_id = :pid
+              AND date BETWEEN :start_d AND :target
+              AND {cfg['key']} IN (SELECT k FROM active)
+        """)
+        with engine.connect() as conn:
+            rows = conn.execute(q, {"pid": pid, "start_d": start, "target": target}).fetchall()
+            labels = dict(conn.execute(text(f"""
+                SELECT {cfg['key']} AS k, MAX({cfg['label']}) AS label
+                FROM {cfg['table']}
+                WHERE profile_id = :pid AND date = :target
+                GROUP BY 1
+            """), {"pid": pid, "target": target}).fetchall())
+
+        hits = []
+        keys = []
+        if rows:
+            cols = list(zip(*rows))
+            keys, codes = np.unique(np.array(cols[0], dtype=object), return_inverse=True)
+            hits = _score_anomalies(
+                codes,
+                np.asarray(cols[1], dtype=np.int64),
+                np.asarray(cols[2], dtype=np.float64),
+                np.asarray(cols[3], dtype=np.float64),
+                np.asarray(cols[4], dtype=np.float64),
+                len(keys),
+                n_days,
+            )
+
+        with engine.begin() as conn:
+            conn.execute(text("""
+                DELETE FROM sp_metric_anomalies
+                WHERE profile_id = :pid AND source = :source AND date = :target
+            """), {"pid": pid, "source": source, "target": target})
+            if hits:
+                conn.execute(text("""
+                    INSERT INTO sp_metric_anomalies (
+                        profile_id, source, entity_key, entity_label, date, metric,
+                        value, baseline, mad, score, run_id
+                    ) VALUES (
+                        :pid, :source, :entity_key, :entity_label, :date, :metric,
+                        :value, :baseline, :mad, :score, :run_id
+                    )
+                """), [{
+                    "pid": pid, "source": source,
+                    "entity_key": keys[i], "entity_label": labels.get(keys[i]) or keys[i],
+                    "date": target, "metric": metric,
+                    "value": value, "baseline": baseline, "mad": mad, "score": score,
+                    "run_id": run_id,
+                } for i, metric, value, baseline, mad, score in hits])
+
+        summary[source] = {
+            "rows": len(rows),
+            "entities": len(keys),
+            "anomalies": len(hits),
+            "seconds": round(_time.time() - t0, 3),
+        }
+    print(f"[anomalies] {summary}", flush=True)
+    return summary
+
+def _run_anomaly_detection_safe(target: _dt.date):
+    """Post-ingest hook: never let detection failures fail the ingest itself."""
+    if not ANOMALY_AFTER_INGEST:
+        return
+    try:
+        _run_anomaly_detection(target)
+    except Exception as e:
+        import traceback
+        print(f"[anomalies] ❌ {type(e).__name__}: {e}", flush=True)
+        traceback.print_exc()
+
+@app.api_route("/api/tasks/detect_anomalies", methods=["GET", "POST"])
+def detect_anomalies(date: str | None = None, key: str = ""):
+    if DAILY_INGEST_KEY and key != DAILY_INGEST_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        target = _dt.date.fromisoformat(date) if date else _dt.date.today() - _dt.timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    return _run_anomaly_detection(target)
+
+@app.get("/api/sp/anomalies")
+async def sp_anomalies(
+    date: str | None = None,
+    source: str | None = Query(None, pattern="^(kw|st)$"),
+    metric: str | None = Query(None, pattern="^(spend|ctr)$"),
+    limit: int = Query(200, ge=1, le=5000),
+):
+    """Flagged anomalies for one day (defaults to the latest scored day), strongest first."""
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    async with (await _read_engine()).connect() as conn:
+        if date:
+            try:
+                day = _dt.date.fromisoformat(date)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+        else:
+            day = (await conn.execute(text(
+                "SELECT MAX(date) FROM sp_metric_anomalies WHERE profile_id = :pid"
+            ), {"pid": pid})).scalar()
+            if day is None:
+                return {"date": None, "rows": []}
+        rows = (await conn.execute(text("""
+            SELECT source, entity_key, entity_label, metric, value, baseline, mad, score, detected_at
+            FROM sp_metric_anomalies
+            WHERE profile_id = :pid AND date = :day
+              AND (CAST(:source AS text) IS NULL OR source = :source)
+              AND (CAST(:metric AS text) IS NULL OR metric = :metric)
+            ORDER BY abs(score) DESC
+            LIMIT :lim
+        """), {"pid": pid, "day": day, "source": source, "metric": metric, "lim": limit})).mappings().all()
+    return {
+        "date": day.isoformat(),
+        "rows": [{**dict(r), "detected_at": r["detected_at"].isoformat()} for r in rows],
+    }
+
+# ====== TIME SERIES ======
+# Daily / weekly / monthly metric series for the whole profile or one campaign,
+# ad group, keyword or search term. Aggregation happens in SQL; long series are
+# then thinned with LTTB (largest-triangle-three-buckets) so a multi-year chart
+# ships a few hundred points. Ratios are recomputed from the summed bases.
+_TS_FACTS = {"kw": "fact_sp_keyword_daily", "st": "v_sp_search_term_all"}  # st includes the compact tier
+_TS_FILTERS = {
+    "kw": ("campaign_id", "ad_group_id", "keyword_id"),
+    "st": ("campaign_id", "ad_group_id", "keyword_id", "search_term"),
+}
+_TS_METRICS = ("impressions", "clicks", "spend", "sales", "orders", "cpc", "ctr", "acos", "roas")
+
+def _lttb_indices(ys: list[float], n_out: int) -> list[int]:
+    """Indices of the points LTTB keeps (x is the point index; always keeps first and last)."""
+    n = len(ys)
+    if n_out >= n or n_out < 3:
+        return list(range(n))
+    keep = [0]
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        # average of the next bucket is the third triangle vertex
+        nb_start = int((i + 1) * every) + 1
+        nb_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (nb_start + nb_end - 1) / 2.0
+        avg_y = sum(ys[nb_start:nb_end]) / max(1, nb_end - nb_start)
+        b_start = int(i * every) + 1
+        b_end = int((i + 1) * every) + 1
+        best, best_area = b_start, -1.0
+        ax, ay = a, ys[a]
+        for j in range(b_start, b_end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - j) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return keep
+
+@app.get("/api/sp/timeseries")
+async def sp_timeseries(
+    start: str,
+    end: str,
+    source: str | None = Query(None, pattern="^(kw|st)$"),
+    grain: str = Query("day", pattern="^(day|week|month)$"),
+    metrics: str = Query("spend,sales,clicks,acos"),
+    campaign_id: str | None = None,
+    ad_group_id: str | None = None,
+    keyword_id: str | None = None,
+    search_term: str | None = None,
+    max_points: int = Query(400, ge=3, le=5000),
+    shape_by: str | None = None,
+):
+    """
+    Columnar series: {"t": [...], "series": {metric: [...]}}. `source` defaults to
+    st when a search_term is given, else kw. When there are more than max_points
+    buckets, LTTB picks the points by the `shape_by` metric (default: first
+    requested) and every series keeps the same timestamps. For st, a range reaching
+    into the compacted tier is widened to whole periods (start / end in the response).
+    """
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    try:
+        start_d = _dt.date.fromisoformat(start)
+        end_d = _dt.date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+    wanted = [m.strip() for m in metrics.split(",") if m.strip()]
+    bad = [m for m in wanted if m not in _TS_METRICS]
+    if bad or not wanted:
+        raise HTTPException(status_code=400, detail=f"metrics must be a subset of {list(_TS_METRICS)}")
+    shape_by = shape_by or wanted[0]
+    if shape_by not in wanted:
+        raise HTTPException(status_code=400, detail="shape_by must be one of the requested metrics")
+
+    src = source or ("st" if search_term else "kw")
+    given = {"campaign_id": campaign_id, "ad_group_id": ad_group_id,
+             "keyword_id": keyword_id, "search_term": search_term}
+    unsupported = [k for k, v in given.items() if v and k not in _TS_FILTERS[src]]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"{unsupported} cannot filter source={src}")
+    filters = {k: v for k, v in given.items() if v}
+    where = "".join(f" AND {k} = :{k}" for k in filters)
+
+    sql = text(f"""
+        SELECT CAST(date_trunc(:grain, date) AS date) AS t,
+               SUM(impressions) AS impressions,
+               SUM(clicks) AS clicks,
+               SUM(cost) AS spend,
+               SUM(attributed_sales_14d) AS sales,
+               SUM(attributed_conversions_14d) AS orders
+        FROM {_TS_FACTS[src]}
+        WHERE profile_id = :pid
+          AND date BETWEEN :start_d AND :end_d{where}
+        GROUP BY 1
+        ORDER BY 1
+    """)
+    pid = _env("AMZN_PROFILE_ID")
+    snapped, compact_grain = False, None
+    async with (await _read_engine()).connect() as conn:
+        if src == "st":
+            floor, compact_grain = await _retention_window(conn)
+            start_d, end_d, snapped = _snap_to_compact_periods(start_d, end_d, floor, compact_grain)
+        rows = (await conn.execute(sql, {"pid": pid, "grain": grain, "start_d": start_d, "end_d": end_d,
+                                         **filters})).mappings().all()
+
+    def _ratio(a, b):
+        return round(float(a) / float(b), 6) if b else None
+
+    base = {
+        "impressions": [int(r["impressions"] or 0) for r in rows],
+        "clicks": [int(r["clicks"] or 0) for r in rows],
+        "spend": [round(float(r["spend"] or 0), 4) for r in rows],
+        "sales": [round(float(r["sales"] or 0), 4) for r in rows],
+        "orders": [int(r["orders"] or 0) for r in rows],
+    }
+    derived = {
+        "cpc": lambda i: _ratio(base["spend"][i], base["clicks"][i]),
+        "ctr": lambda i: _ratio(base["clicks"][i], base["impressions"][i]),
+        "acos": lambda i: _ratio(base["spend"][i], base["sales"][i]),
+        "roas": lambda i: _ratio(base["sales"][i], base["spend"][i]),
+    }
+    series = {m: (base[m] if m in base else [derived[m](i) for i in range(len(rows))]) for m in wanted}
+
+    keep = _lttb_indices([v or 0 for v in series[shape_by]], max_points)
+    return {
+        "source": src,
+        "grain": grain,
+        "filters": filters,
+        "start": start_d.isoformat(),
+        "end": end_d.isoformat(),
+        # compacted days are one point per week / month at the period start, whatever `grain` asks for
+        "compacted_grain": compact_grain if snapped else None,
+        "raw_points": len(rows),
+        "points": len(keep),
+        "t": [rows[i]["t"].isoformat() for i in keep],
+        "series": {m: [vals[i] for i in keep] for m, vals in series.items()},
+    }
+
+# ====== PERIOD COMPARISON ======
+# Current vs previous period for any grouping, in one pass over the fact table:
+# FILTER aggregates split the two windows, so only the grouped result (never the
+# raw rows of either period) leaves Postgres. Ranked by impact: |delta| for the
+# additive metrics; for ratios the delta is weighted by the current volume it
+# applies to (acos × sales = extra spend, roas × spend = extra sales, ...).
+_CMP_GROUPS = {
+    "campaign": {"key": ("campaign_id",), "label": ("campaign_name",)},
+    "ad_group": {"key": ("campaign_id", "ad_group_id"), "label": ("campaign_name", "ad_group_name")},
+    "keyword": {"key": ("keyword_id",), "label": ("keyword_text", "match_type", "campaign_name", "ad_group_name")},
+    "match_type": {"key": ("match_type",), "label": ()},
+    "search_term": {"key": ("search_term",), "label": ()},
+    "total": {"key": (), "label": ()},
+}
+_CMP_SOURCE_GROUPS = {
+    "kw": ("campaign", "ad_group", "keyword", "match_type", "total"),
+    "st": ("campaign", "ad_group", "keyword", "match_type", "search_term", "total"),
+}
+_CMP_BASE = {
+    "impressions": "impressions", "clicks": "clicks", "spend": "cost",
+    "sales": "attributed_sales_14d", "orders": "attributed_conversions_14d",
+}
+# ratio metric -> (numerator, denominator, impact weight) over the summed bases
+_CMP_RATIOS = {
+    "cpc": ("spend", "clicks", "clicks"),
+    "ctr": ("clicks", "impressions", "impressions"),
+    "acos": ("spend", "sales", "sales"),
+    "roas": ("sales", "spend", "spend"),
+}
+
+@app.get("/api/sp/compare")
+async def sp_compare(
+    response: Response,
+    cur_start: str,
+    cur_end: str,
+    prev_start: str | None = None,
+    prev_end: str | None = None,
+    source: str = Query("st", pattern="^(kw|st)$"),
+    group_by: str = "search_term",
+    metric: str = "acos",
+    direction: str = Query("both", pattern="^(both|up|down)$"),
+    min_clicks: int = Query(0, ge=0),
+    campaign_id: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Period-over-period deltas. The previous period defaults to the equally long
+    window right before the current one. `direction` keeps only groups whose
+    `metric` rose (up) or fell (down); `min_clicks` drops groups with fewer
+    clicks than that in both periods. The total group count is returned as
+    X-Total-Count. For st, periods reaching into the compacted tier are widened to
+    whole weeks / months (the served ranges are in current / previous, with
+    compacted_periods: true); two such periods can then share a compacted period.
+    """
+    if not async_engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    try:
+        cs, ce = _dt.date.fromisoformat(cur_start), _dt.date.fromisoformat(cur_end)
+        if prev_start or prev_end:
+            if not (prev_start and prev_end):
+                raise HTTPException(status_code=400, detail="give both prev_start and prev_end, or neither")
+            ps, pe = _dt.date.fromisoformat(prev_start), _dt.date.fromisoformat(prev_end)
+        else:
+            pe = cs - _dt.timedelta(days=1)
+            ps = pe - (ce - cs)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="dates must be YYYY-MM-DD")
+    if ce < cs or pe < ps:
+        raise HTTPException(status_code=400, detail="period end is before its start")
+    if group_by not in _CMP_SOURCE_GROUPS[source]:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {list(_CMP_SOURCE_GROUPS[source])} for source={source}")
+    if metric not in _CMP_BASE and metric not in _CMP_RATIOS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {list(_CMP_BASE) + list(_CMP_RATIOS)}")
+
+    grp = _CMP_GROUPS[group_by]
+    keys, labels = grp["key"], grp["label"]
+    sums = ",\n               ".join(
+        f"SUM({col}) FILTER (WHERE date BETWEEN :{p}s AND :{p}e) AS {p}_{m}"
+        for m, col in _CMP_BASE.items() for p in ("cur", "prev")
+    )
+    select_dims = "".join(f"{k}, " for k in keys) + "".join(f"max({c}) AS {c}, " for c in labels)
+    group_sql = f"GROUP BY {', '.join(keys)}" if keys else ""
+
+    def _val(p: str, m: str) -> str:
+        if m in _CMP_BASE:
+            return f"COALESCE({p}_{m}, 0)"
+        num, den, _ = _CMP_RATIOS[m]
+        return f"COALESCE({p}_{num}, 0)::numeric / NULLIF({p}_{den}, 0)"
+
+    delta = f"({_val('cur', metric)} - {_val('prev', metric)})"
+    impact = f"abs({delta})" if metric in _CMP_BASE else f"abs({delta}) * COALESCE(cur_{_CMP_RATIOS[metric][2]}, 0)"
+    having = []
+    if min_clicks:
+        having.append("GREATEST(COALESCE(cur_clicks, 0), COALESCE(prev_clicks, 0)) >= :min_clicks")
+    if direction != "both":
+        having.append(f"{delta} {'>' if direction == 'up' else '<'} 0")
+    where_extra = " AND campaign_id = :campaign_id" if campaign_id else ""
+
+    sql = text(f"""
+        WITH g AS (
+          SELECT {select_dims}{sums}
+          FROM {_TS_FACTS[source]}
+          WHERE profile_id = :pid
+            AND (date BETWEEN :curs AND :cure OR date BETWEEN :prevs AND :preve){where_extra}
+          {group_sql}
+        )
+        SELECT g.*, count(*) OVER () AS total_groups
+        FROM g
+        {"WHERE " + " AND ".join(having) if having else ""}
+        ORDER BY {impact} DESC NULLS LAST{"".join(f", {k}" for k in keys)}
+        LIMIT :limit OFFSET :offset
+    """)
+    snapped = False
+    async with (await _read_engine()).connect() as conn:
+        if source == "st":
+            window = await _retention_window(conn)
+            cs, ce, cur_snapped = _snap_to_compact_periods(cs, ce, *window)
+            ps, pe, prev_snapped = _snap_to_compact_periods(ps, pe, *window)
+            snapped = cur_snapped or prev_snapped
+        params = {"pid": _env("AMZN_PROFILE_ID"), "curs": cs, "cure": ce, "prevs": ps, "preve": pe,
+                  "min_clicks": min_clicks, "campaign_id": campaign_id, "limit": limit, "offset": offset}
+        rows = (await conn.execute(sql, params)).mappings().all()
+
+    def _metrics(r, p: str) -> dict:
+        out = {m: float(r[f"{p}_{m}"] or 0) for m in _CMP_BASE}
+        for m, (num, den, _) in _CMP_RATIOS.items():
+            out[m] = round(out[num] / out[den], 6) if out[den] else None
+        for m in ("impressions", "clicks", "orders"):
+            out[m] = int(out[m])
+        return out
+
+    items = []
+    for r in rows:
+        cur, prev = _metrics(r, "cur"), _metrics(r, "prev")
+        d, pct = {}, {}
+        for m in cur:
+            if cur[m] is None or prev[m] is None:
+                d[m] = pct[m] = None
+                continue
+            d[m] = round(cur[m] - prev[m], 6)
+            pct[m] = round(d[m] / prev[m], 6) if prev[m] else None
+        items.append({
+            "group": {c: r[c] for c in keys + labels},
+            "current": cur,
+            "previous": prev,
+            "delta": d,
+            "pct_change": pct,
+        })
+    response.headers["X-Total-Count"] = str(rows[0]["total_groups"] if rows else 0)
+    return {
+        "source": source,
+        "group_by": group_by,
+        "metric": metric,
+        "current": {"start": cs.isoformat(), "end": ce.isoformat()},
+        "previous": {"start": ps.isoformat(), "end": pe.isoformat()},
+        "compacted_periods": snapped,
+        "items": items,
+    }
+
+# ====== PARQUET EXPORT / ANALYTICS TIER ======
+# Settled months (last day older than the attribution window) are written once to
+# hive-partitioned Parquet: {PARQUET_EXPORT_URI}/{fact}/profile_id=.../month=YYYY-MM/
+# with dictionary-encoded strings. A month is re-exported only when its coverage
+# ledger rows changed after the last export. /api/analytics/aggregate answers
+# historical aggregates from those files with an embedded DuckDB, off Postgres.
+# The export job and the web service are separate processes (separate Render
+# services, no shared disk), so PARQUET_EXPORT_URI is normally object storage:
+# s3://bucket/prefix (AWS_* credentials; ?endpoint_override=host for R2 / MinIO).
+# A local absolute path only works when both run on the same machine. Unset
+# disables the tier. pyarrow (files) and duckdb (queries) are imported on first use.
+PARQUET_EXPORT_URI = os.environ.get("PARQUET_EXPORT_URI", "")
+EXPORT_SETTLE_DAYS = int(os.environ.get("EXPORT_SETTLE_DAYS", "14"))
+EXPORT_BATCH_ROWS = int(os.environ.get("EXPORT_BATCH_ROWS", "100000"))
+
+_EXPORT_COLUMNS = {
+    "kw": ("date", "keyword_id", "campaign_id", "campaign_name", "ad_group_id", "ad_group_name",
+           "keyword_text", "match_type", "impressions", "clicks", "cost",
+           "attributed_sales_14d", "attributed_conversions_14d"),
+    "st": ("date", "campaign_id", "campaign_name", "ad_group_id", "ad_group_name", "search_term",
+           "keyword_id", "keyword_text", "match_type", "impressions", "clicks", "cost",
+           "attributed_sales_14d", "attributed_conversions_14d"),
+}
+
+_EXPORT_STALE_MONTHS_SQL = text("""
+    WITH m AS (
+        SELECT CAST(date_trunc('month', date) AS date) AS month,
+               SUM(row_count) AS row_count,
+               MAX(updated_at) AS changed_at
+        FROM ingest_coverage
+        WHERE profile_id = :pid AND report_type = :kind AND date < :before
+        GROUP BY 1
+    )
+    SELECT m.month
+    FROM m
+    LEFT JOIN analytics_exports e
+      ON e.profile_id = :pid AND e.report_type = :kind AND e.month = m.month
+    WHERE m.row_count > 0
+      AND (:force OR e.exported_at IS NULL OR e.exported_at < m.changed_at)
+    ORDER BY m.month
+""")
+
+def _export_arrow_schema(kind: str):
+    import pyarrow as pa
+    types = {
+        "date": pa.date32(),
+        "impressions": pa.int64(), "clicks": pa.int64(), "attributed_conversions_14d": pa.int64(),
+        "cost": pa.decimal128(18, 4), "attributed_sales_14d": pa.decimal128(18, 4),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in _EXPORT_COLUMNS[kind]])
+
+_EXPORT_FS = None
+
+def _export_fs():
+    """(pyarrow FileSystem, root path) for PARQUET_EXPORT_URI, resolved once."""
+    global _EXPORT_FS
+    if _EXPORT_FS is None:
+        if not PARQUET_EXPORT_URI:
+            raise HTTPException(status_code=503, detail="analytics tier not configured (set PARQUET_EXPORT_URI)")
+        from pyarrow import fs as pafs
+        uri = PARQUET_EXPORT_URI if "://" in PARQUET_EXPORT_URI else os.path.abspath(PARQUET_EXPORT_URI)
+        _EXPORT_FS = pafs.FileSystem.from_uri(uri)
+    return _EXPORT_FS
+
+def _month_dir(kind: str, pid: str, month: _dt.date) -> str:
+    root = _export_fs()[1].rstrip("/")
+    return f"{root}/{_COVERAGE_FACTS[kind]}/profile_id={pid}/month={month:%Y-%m}"
+
+def _export_month_parquet(kind: str, pid: str, month: _dt.date) -> dict:
+    """Stream one month of a fact table into Parquet (tmp file + rename) and record it in the manifest."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    cols = _EXPORT_COLUMNS[kind]
+    schema = _export_arrow_schema(kind)
+    next_month = (month.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+    fs = _export_fs()[0]
+    out_dir = _month_dir(kind, pid, month)
+    fs.create_dir(out_dir, recursive=True)
+    path = f"{out_dir}/data.parquet"
+    tmp = path + ".tmp"
+    started = _dt.datetime.now(_dt.timezone.utc)
+    n = 0
+    sql = text(f"""
+        SELECT {", ".join(cols)}
+        FROM {_COVERAGE_FACTS[kind]}
+        WHERE profile_id = :pid AND date >= :start_d AND date < :end_d
+        ORDER BY date
+    """)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(
+            sql, {"pid": pid, "start_d": month, "end_d": next_month})
+        with pq.ParquetWriter(tmp, schema, filesystem=fs, compression="zstd",
+                              use_dictionary=[c for c in cols if schema.field(c).type == pa.string()]) as writer:
+            for part in result.partitions():
+                writer.write_batch(pa.record_batch(
+                    [pa.array([r[i] for r in part], type=schema.field(i).type) for i in range(len(cols))],
+                    schema=schema,
+                ))
+                n += len(part)
+    fs.move(tmp, path)  # readers never see a half-written file
+    size = fs.get_file_info(path).size
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO analytics_exports (profile_id, report_type, month, row_count, bytes, path, exported_at)
+            VALUES (:pid, :kind, :month, :n, :bytes, :path, :started)
+            ON CONFLICT (profile_id, report_type, month) DO UPDATE SET
+              row_count = EXCLUDED.row_count, bytes = EXCLUDED.bytes,
+              path = EXCLUDED.path, exported_at = EXCLUDED.exported_at
+        """), {"pid": pid, "kind": kind, "month": month, "n": n, "bytes": size, "path": path, "started": started})
+    return {"month": f"{month:%Y-%m}", "rows": n, "bytes": size}
+
+def _run_parquet_export(kinds=("kw", "st"), force: bool = False) -> dict:
+    """
+    Export every settled month whose ledger changed since its last export.
+    Months loaded before the coverage ledger existed need /api/tasks/rebuild_coverage first.
+    """
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise HTTPException(status_code=500, detail="Parquet export needs the pyarrow package")
+    _export_fs()
+    pid = _env("AMZN_PROFILE_ID")
+    settled_through = _dt.date.today() - _dt.timedelta(days=EXPORT_SETTLE_DAYS)
+    before = (settled_through + _dt.timedelta(days=1)).replace(day=1)
+    out = {}
+    for kind in kinds:
+        with engine.connect() as conn:
+            months = [r[0] for r in conn.execute(_EXPORT_STALE_MONTHS_SQL,
+                                                 {"pid": pid, "kind": kind, "before": before, "force": force})]
+        floor = _retention_floor(kind)
+        if floor:
+            # compacted months no longer have daily rows; keep the files exported before compaction
+            months = [m for m in months if m >= floor]
+        out[kind] = []
+        for m in months:
+            t0 = _time.time()
+            info = _export_month_parquet(kind, pid, m)
+            info["secs"] = round(_time.time() - t0, 2)
+            print(f"[export] {kind} {info}", flush=True)
+            out[kind].append(info)
+    return {"settled_before": before.isoformat(), "exported": out}
+
+def _months_between(start: _dt.date, end: _dt.date) -> list[_dt.date]:
+    m, out = start.replace(day=1), []
+    while m <= end:
+        out.append(m)
+        m = (m.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+    return out
+
+@app.get("/api/analytics/aggregate")
+def analytics_aggregate(
+    start: str,
+    end: str,
+    source: str = Query("st", pattern="^(kw|st)$"),
+    group_by: str = "campaign",
+    sort: str = "spend",
+    limit: int = Query(100, ge=1, le=10000),
+):
+    """
+    Grouped totals for [start, end] computed by DuckDB over the exported Parquet
+    months (group_by as in /api/sp/compare). Months of the range that have not
+    been exported yet are listed in missing_months and contribute nothing; 503
+    when the tier is not configured or none of the range has been exported.
+    """
+    try:
+        import duckdb
+        import pyarrow.dataset as pads
+    except ImportError:
+        raise HTTPException(status_code=503, detail="analytics tier needs the duckdb and pyarrow packages")
+    try:
+        start_d = _dt.date.fromisoformat(start)
+        end_d = _dt.date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start/end must be YYYY-MM-DD")
+    if group_by not in _CMP_SOURCE_GROUPS[source]:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {list(_CMP_SOURCE_GROUPS[source])} for source={source}")
+    if sort not in _TS_METRICS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {list(_TS_METRICS)}")
+
+    pid = _env("AMZN_PROFILE_ID")
+    months = _months_between(start_d, end_d)
+    fs = _export_fs()[0]
+    paths = {m: f"{_month_dir(source, pid, m)}/data.parquet" for m in months}
+    try:
+        infos = fs.get_file_info(list(paths.values()))
+    except OSError as e:
+        raise HTTPException(status_code=503, detail=f"analytics storage unreachable: {e}")
+    present = [m for m, info in zip(months, infos) if info.is_file]
+    missing = [f"{m:%Y-%m}" for m in months if m not in present]
+    if not present:
+        raise HTTPException(status_code=503, detail={
+            "error": "no exported Parquet data for this range (run the export job, JOB_MODE=export)",
+            "source": source, "missing_months": missing,
+        })
+
+    grp = _CMP_GROUPS[group_by]
+    keys, labels = grp["key"], grp["label"]
+    dims = "".join(f"{k}, " for k in keys) + "".join(f"max({c}) AS {c}, " for c in labels)
+    sql = f"""
+        SELECT {dims}
+               SUM(impressions) AS impressions,
+               SUM(clicks) AS clicks,
+               SUM(cost) AS spend,
+               SUM(attributed_sales_14d) AS sales,
+               SUM(attributed_conversions_14d) AS orders,
+               SUM(cost) / NULLIF(SUM(clicks), 0) AS cpc,
+               SUM(clicks) / NULLIF(SUM(impressions), 0) AS ctr,
+               SUM(cost) / NULLIF(SUM(attributed_sales_14d), 0) AS acos,
+               SUM(attributed_sales_14d) / NULLIF(SUM(cost), 0) AS roas
+        FROM facts
+        WHERE date BETWEEN ? AND ?
+        {f"GROUP BY {', '.join(keys)}" if keys else ""}
+        ORDER BY {sort} DESC NULLS LAST
+        LIMIT ?
+    """
+    t0 = _time.time()
+    con = duckdb.connect()
+    try:
+        # files are read through pyarrow's filesystem (local or s3), filters pushed down by duckdb
+        con.register("facts", pads.dataset([paths[m] for m in present], format="parquet", filesystem=fs))
+        cur = con.execute(sql, [start_d, end_d, limit])
+        columns = [d[0] for d in cur.description]
+        rows = cur.fetchall()
+    finally:
+        con.close()
+    return {
+        "source": source,
+        "group_by": group_by,
+        "engine": "duckdb",
+        "months": [f"{m:%Y-%m}" for m in present],
+        "missing_months": missing,
+        "query_ms": round((_time.time() - t0) * 1000, 1),
+        "columns": columns,
+        "rows": [{c: _plain(v) for c, v in zip(columns, r)} for r in rows],
+    }
+
+# ====== RETENTION / COMPACTION TIER ======
+# Daily search-term rows older than RETENTION_ST_MONTHS are folded into
+# fact_sp_search_term_compact at RETENTION_GRAIN (week | month): one row per
+# (period, ad group, term, match type) with summed base metrics. With
+# RETENTION_BUCKET_MAX_IMPRESSIONS set, terms of a period at or below that many
+# impressions and without orders collapse into one '(other)' row per ad group
+# and match type, which is where most of the long tail goes. Each chunk moves
+# its rows with a single DELETE ... RETURNING / INSERT statement, so a period is
+# never in both tiers. The fact tables are not partitioned, so nothing is
+# dropped: the freed space is reclaimed by VACUUM and reused by new days, which
+# keeps the daily table at roughly retention-window size. retention_state holds
+# the boundary; ingest, heal, export and the on-demand st_fetch / st_run loaders
+# skip search-term days before it.
+RETENTION_ST_MONTHS = int(os.environ.get("RETENTION_ST_MONTHS", "0"))  # 0 = keep daily rows forever
+RETENTION_GRAIN = os.environ.get("RETENTION_GRAIN", "week")  # week | month
+RETENTION_BUCKET_MAX_IMPRESSIONS = os.environ.get("RETENTION_BUCKET_MAX_IMPRESSIONS")  # e.g. "5"; unset = no bucketing
+RETENTION_OTHER_TERM = "(other)"
+
+_COMPACT_CHUNK_SQL = text("""
+    WITH moved AS (
+        DELETE FROM fact_sp_search_term_daily
+        WHERE profile_id = :pid AND date >= :lo AND date < :hi
+        RETURNING *
+    ),
+    terms AS (
+        SELECT CAST(date_trunc(:grain, date) AS date) AS period_start,
+               ad_group_id, search_term, match_type,
+               MAX(campaign_id) AS campaign_id, MAX(campaign_name) AS campaign_name,
+               MAX(ad_group_name) AS ad_group_name,
+               MAX(keyword_id) AS keyword_id, MAX(keyword_text) AS keyword_text,
+               SUM(impressions) AS impressions, SUM(clicks) AS clicks, SUM(cost) AS cost,
+               SUM(attributed_sales_14d) AS sales, SUM(attributed_conversions_14d) AS orders,
+               COUNT(*) AS source_rows
+        FROM moved
+        GROUP BY 1, ad_group_id, search_term, match_type
+    ),
+    flagged AS (
+        SELECT t.*,
+               CAST(:bucket_max AS integer) IS NOT NULL
+                 AND t.impressions <= CAST(:bucket_max AS integer)
+                 AND t.orders = 0 AS is_other
+        FROM terms t
+    ),
+    bucketed AS (
+        SELECT f.*, CASE WHEN f.is_other THEN CAST(:other AS text) ELSE f.search_term END AS term
+        FROM flagged f
+    )
+    INSERT INTO fact_sp_search_term_compact (
+        profile_id, grain, period_start, period_end,
+        campaign_id, campaign_name, ad_group_id, ad_group_name,
+        search_term, keyword_id, keyword_text, match_type,
+        impressions, clicks, cost, attributed_sales_14d, attributed_conversions_14d,
+        source_rows, bucketed_terms
+    )
+    SELECT :pid, :grain, period_start,
+           CAST(period_start + CAST('1 ' || :grain AS interval) - interval '1 day' AS date),
+           MAX(campaign_id), MAX(campaign_name), ad_group_id, MAX(ad_group_name),
+           term,
+           CASE WHEN is_other THEN NULL ELSE MAX(keyword_id) END,
+           CASE WHEN is_other THEN NULL ELSE MAX(keyword_text) END,
+           match_type,
+           SUM(impressions), SUM(clicks), SUM(cost), SUM(sales), SUM(orders),
+           SUM(source_rows), COUNT(*) FILTER (WHERE is_other)
+    FROM bucketed
+    GROUP BY period_start, ad_group_id, match_type, term, is_other
+    ON CONFLICT (profile_id, grain, period_start, ad_group_id, search_term, match_type) DO UPDATE SET
+        impressions = fact_sp_search_term_compact.impressions + EXCLUDED.impressions,
+        clicks = fact_sp_search_term_compact.clicks + EXCLUDED.clicks,
+        cost = fact_sp_search_term_compact.cost + EXCLUDED.cost,
+        attributed_sales_14d = fact_sp_search_term_compact.attributed_sales_14d + EXCLUDED.attributed_sales_14d,
+        attributed_conversions_14d = fact_sp_search_term_compact.attributed_conversions_14d + EXCLUDED.attributed_conversions_14d,
+        source_rows = fact_sp_search_term_compact.source_rows + EXCLUDED.source_rows,
+        bucketed_terms = fact_sp_search_term_compact.bucketed_terms + EXCLUDED.bucketed_terms,
+        compacted_at = now()
+""")
+
+def _retention_floor(kind: str) -> _dt.date | None:
+    """First date still held as daily rows for `kind` (None: nothing compacted, or no migration 10 yet)."""
+    if not engine or kind != "st":
+        return None
+    with engine.connect() as conn:
+        if not conn.execute(text("SELECT to_regclass('public.retention_state') IS NOT NULL")).scalar():
+            return None
+        return conn.execute(text("""
+            SELECT compacted_before FROM retention_state WHERE profile_id = :pid AND report_type = :kind
+        """), {"pid": _env("AMZN_PROFILE_ID"), "kind": kind}).scalar()
+
+def _drop_compacted_rows(rows: list[dict], kind: str = "st") -> tuple[list[dict], int]:
+    """(rows, n_dropped): report rows dated before the retention floor would double count against the compact tier."""
+    floor = _retention_floor(kind)
+    if not floor:
+        return rows, 0
+    cut = floor.isoformat()
+    kept = [r for r in rows if str(r["date"]) >= cut]
+    return kept, len(rows) - len(kept)
+
+async def _retention_window(conn, kind: str = "st") -> tuple[_dt.date | None, str | None]:
+    """(compacted_before, grain) for `kind` on an async read connection; (None, None) if nothing is compacted."""
+    row = (await conn.execute(text("""
+        SELECT compacted_before, grain FROM retention_state WHERE profile_id = :pid AND report_type = :kind
+    """), {"pid": _env("AMZN_PROFILE_ID"), "kind": kind})).first()
+    return (row[0], row[1]) if row else (None, None)
+
+def _snap_to_compact_periods(start_d: _dt.date, end_d: _dt.date, floor: _dt.date | None,
+                             grain: str | None) -> tuple[_dt.date, _dt.date, bool]:
+    """
+    Widen [start_d, end_d] to whole compacted periods where it lies before `floor`.
+    A compact row is dated at its period start and carries the whole period, so a
+    range starting mid-period would otherwise drop it and one ending mid-period
+    would silently include days past end_d. Returns (start, end, touched_compact_tier).
+    """
+    if floor is None or start_d >= floor:
+        return start_d, end_d, False
+
+    def period_start(d: _dt.date) -> _dt.date:
+        return d.replace(day=1) if grain == "month" else d - _dt.timedelta(days=d.weekday())
+
+    s, e = period_start(start_d), end_d
+    if end_d < floor:
+        ps = period_start(end_d)
+        if grain == "month":
+            pe = (ps.replace(day=28) + _dt.timedelta(days=4)).replace(day=1) - _dt.timedelta(days=1)
+        else:
+            pe = ps + _dt.timedelta(days=6)
+        e = min(pe, floor - _dt.timedelta(days=1))
+    return s, e, True
+
+_RETENTION_STATE_UPSERT = text("""
+    INSERT INTO retention_state (profile_id, report_type, grain, compacted_before)
+    VALUES (:pid, 'st', :grain, :hi)
+    ON CONFLICT (profile_id, report_type) DO UPDATE SET
+      grain = EXCLUDED.grain,
+      compacted_before = GREATEST(retention_state.compacted_before, EXCLUDED.compacted_before),
+      updated_at = now()
+""")
+
+def _retention_cutoff(today: _dt.date, months: int, grain: str) -> _dt.date:
+    """First day kept as daily rows: the start of the month `months` back, aligned down to `grain`."""
+    m = today.replace(day=1)
+    for _ in range(months):
+        m = (m - _dt.timedelta(days=1)).replace(day=1)
+    return m if grain == "month" else m - _dt.timedelta(days=m.weekday())
+
+def _retention_chunks(lo: _dt.date, cutoff: _dt.date, grain: str) -> list[tuple[_dt.date, _dt.date]]:
+    """[lo, hi) batches covering whole periods up to cutoff: one month, or four weeks."""
+    out = []
+    start = lo.replace(day=1) if grain == "month" else lo - _dt.timedelta(days=lo.weekday())
+    while start < cutoff:
+        if grain == "month":
+            nxt = (start.replace(day=28) + _dt.timedelta(days=4)).replace(day=1)
+        else:
+            nxt = start + _dt.timedelta(weeks=4)
+        out.append((start, min(nxt, cutoff)))
+        start = nxt
+    return out
+
+def _run_compaction(months: int | None = None, grain: str | None = None, dry_run: bool = False) -> dict:
+    """Move search-term days before the retention cutoff into the compact tier, then VACUUM the daily table."""
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    months = RETENTION_ST_MONTHS if months is None else months
+    grain = grain or RETENTION_GRAIN
+    if grain not in ("week", "month"):
+        raise HTTPException(status_code=400, detail="grain must be week or month")
+    if months <= 0:
+        return {"ok": True, "skipped": "retention disabled (RETENTION_ST_MONTHS=0)"}
+    pid = _env("AMZN_PROFILE_ID")
+    cutoff = _retention_cutoff(_dt.date.today(), months, grain)
+    with engine.connect() as conn:
+        lo = conn.execute(text("""
+            SELECT MIN(date) FROM fact_sp_search_term_daily WHERE profile_id = :pid AND date < :cutoff
+        """), {"pid": pid, "cutoff": cutoff}).scalar()
+    chunks = _retention_chunks(lo, cutoff, grain) if lo else []
+    out = {"ok": True, "grain": grain, "cutoff": cutoff.isoformat(), "dry_run": dry_run,
+           "chunks": [], "daily_rows": 0, "compact_rows": 0}
+    if dry_run:
+        out["chunks"] = [[a.isoformat(), b.isoformat()] for a, b in chunks]
+        return out
+
+    for a, b in chunks:
+        t0 = _time.time()
+        with engine.begin() as conn:
+            moved = conn.execute(text("""
+                SELECT COUNT(*) FROM fact_sp_search_term_daily WHERE profile_id = :pid AND date >= :lo AND date < :hi
+            """), {"pid": pid, "lo": a, "hi": b}).scalar()
+            res = conn.execute(_COMPACT_CHUNK_SQL, {
+                "pid": pid, "lo": a, "hi": b, "grain": grain,
+                "bucket_max": RETENTION_BUCKET_MAX_IMPRESSIONS, "other": RETENTION_OTHER_TERM,
+            })
+            # same transaction as the move, so readers never see days gone from the
+            # daily table while the boundary still routes them there
+            conn.execute(_RETENTION_STATE_UPSERT, {"pid": pid, "grain": grain, "hi": b})
+        info = {"lo": a.isoformat(), "hi": b.isoformat(), "daily_rows": int(moved or 0),
+                "compact_rows": max(0, res.rowcount or 0), "secs": round(_time.time() - t0, 2)}
+        print(f"[compact] st {info}", flush=True)
+        out["chunks"].append(info)
+        out["daily_rows"] += info["daily_rows"]
+        out["compact_rows"] += info["compact_rows"]
+
+    if not chunks:
+        # nothing daily left below the cutoff: still move the boundary up to it
+        with engine.begin() as conn:
+            conn.execute(_RETENTION_STATE_UPSERT, {"pid": pid, "grain": grain, "hi": cutoff})
+    else:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as auto:
+            for table in ("fact_sp_search_term_daily", "fact_sp_search_term_compact"):
+                auto.exec_driver_sql(f"VACUUM (ANALYZE) {table}")
+    return out
+
+@app.get("/api/debug/retention")
+def debug_retention():
+    """Retention boundary plus size / dead-tuple / vacuum stats of the daily and compact search-term tables."""
+    if not engine:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    pid = _env("AMZN_PROFILE_ID")
+    with engine.connect() as conn:
+        state = conn.execute(text("""
+            SELECT report_type, grain, compacted_before, updated_at FROM retention_state WHERE profile_id = :pid
+        """), {"pid": pid}).mappings().all()
+        tables = conn.execute(text("""
+            SELECT relname AS table, n_live_tup AS live_rows, n_dead_tup AS dead_rows,
+                   pg_total_relation_size(relid) AS total_bytes,
+                   last_vacuum, last_autovacuum
+            FROM pg_stat_user_tables
+            WHERE relname IN ('fact_sp_search_term_daily', 'fact_sp_search_term_compact')
+        """)).mappings().all()
+    return {
+        "policy": {"st_months": RETENTION_ST_MONTHS, "grain": RETENTION_GRAIN,
+                   "bucket_max_impressions": RETENTION_BUCKET_MAX_IMPRESSIONS},
+        "state": [{k: _plain(v) for k, v in r.items()} for r in state],
+        "tables": [{k: _plain(v) for k, v in r.items()} for r in tables],
+    }
@@ -0,0 +1,46 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+
+from main import _score_anomalies  # noqa: E402
+
+N_DAYS = 29  # 28 baseline days + the target day
+
+
+def _score(entities):
+    """entities: list of {day_index: spend}; every listed day gets 1000 impressions / 20 clicks."""
+    codes, days, spend = [], [], []
+    for code, by_day in enumerate(entities):
+        for d, cost in by_day.items():
+            codes.append(code)
+            days.append(d)
+            spend.append(cost)
+    n = len(codes)
+    return _score_anomalies(np.array(codes), np.array(days), np.full(n, 1000.0), np.full(n, 20.0),
+                            np.array(spend, dtype=float), len(entities), N_DAYS)
+
+
+def test_sparse_entity_ordinary_day_is_not_a_spike():
+    # live on 8 of 28 baseline days at ~150, today 160: zero-filled baseline would flag it
+    sparse = {d: 150.0 for d in range(0, 28, 4)} | {27: 150.0, 28: 160.0}
+    assert _score([sparse]) == []
+
+
+def test_sparse_entity_real_spike_is_flagged():
+    sparse = {d: 150.0 for d in range(0, 28, 4)} | {27: 150.0, 28: 2000.0}
+    assert [(e, m) for e, m, *_ in _score([sparse])] == [(0, "spend")]
+
+
+def test_steady_entity():
+    steady = {d: 120.0 + (d % 3) for d in range(28)}
+    assert _score([steady | {28: 121.0}]) == []
+    hits = _score([steady | {28: 1200.0}])
+    assert [(e, m) for e, m, *_ in hits] == [(0, "spend")]
+    _, _, value, baseline, _, score = hits[0]
+    assert value == 1200.0 and baseline == 121.0 and score >= 4.0
+
+
+def test_entity_without_enough_history_is_skipped():
+    assert _score([{27: 10.0, 28: 5000.0}]) == []
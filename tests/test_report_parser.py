@@ -0,0 +1,34 @@
+import gzip
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+
+from main import _gunzip_report, _iter_report_records  # noqa: E402
+
+
+def test_json_array():
+    raw = b' [{"keywordId": 1, "clicks": 2}, {"keywordId": 2, "clicks": 0}, 3]'
+    assert list(_iter_report_records(raw)) == [{"keywordId": 1, "clicks": 2}, {"keywordId": 2, "clicks": 0}]
+
+
+def test_ndjson_skips_malformed_lines():
+    raw = b'{"a": 1}\n\n{"a": 2}\n{"a": \n{"a": 3}\n'
+    assert [r["a"] for r in _iter_report_records(raw)] == [1, 2, 3]
+
+
+def test_pretty_printed_wrapper_document():
+    raw = b'{\n  "data": {\n    "rows": [{"a": 1}, {"a": 2}]\n  }\n}\n'
+    assert [r["a"] for r in _iter_report_records(raw)] == [1, 2]
+
+
+def test_str_input_and_empty_payload():
+    assert list(_iter_report_records('{"a": 1}')) == [{"a": 1}]
+    assert list(_iter_report_records(b"  \n ")) == []
+
+
+def test_gunzip_passthrough():
+    body = b'[{"a": 1}]'
+    assert _gunzip_report(gzip.compress(body)) == body
+    assert _gunzip_report(body) == body
@@ -0,0 +1,65 @@
+import datetime as dt
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+
+from main import _retention_chunks, _retention_cutoff, _snap_to_compact_periods  # noqa: E402
+
+D = dt.date
+FLOOR = D(2025, 1, 6)  # Monday; weeks before it are compacted
+
+
+def test_range_starting_mid_compacted_week_covers_whole_week():
+    # Wed 2024-12-18 .. Fri 2025-01-10: the compact row for the week of Mon 2024-12-16 is included
+    start, end, snapped = _snap_to_compact_periods(D(2024, 12, 18), D(2025, 1, 10), FLOOR, "week")
+    assert (start, end, snapped) == (D(2024, 12, 16), D(2025, 1, 10), True)
+
+
+def test_range_inside_compacted_tier_ends_at_period_end():
+    start, end, snapped = _snap_to_compact_periods(D(2024, 12, 18), D(2024, 12, 24), FLOOR, "week")
+    assert (start, end, snapped) == (D(2024, 12, 16), D(2024, 12, 29), True)
+
+
+def test_month_grain():
+    start, end, snapped = _snap_to_compact_periods(D(2024, 10, 15), D(2024, 11, 3), D(2025, 1, 1), "month")
+    assert (start, end, snapped) == (D(2024, 10, 1), D(2024, 11, 30), True)
+
+
+def test_daily_tier_range_unchanged():
+    assert _snap_to_compact_periods(D(2025, 1, 8), D(2025, 1, 9), FLOOR, "week") == (D(2025, 1, 8), D(2025, 1, 9), False)
+    assert _snap_to_compact_periods(D(2024, 12, 18), D(2024, 12, 24), None, None) == (D(2024, 12, 18), D(2024, 12, 24), False)
+
+
+def test_cutoff_month_grain_is_first_of_month_n_back():
+    assert _retention_cutoff(D(2025, 3, 17), 2, "month") == D(2025, 1, 1)
+    assert _retention_cutoff(D(2025, 1, 31), 1, "month") == D(2024, 12, 1)
+
+
+def test_cutoff_week_grain_aligns_down_to_monday():
+    # 2025-01-01 is a Wednesday
+    assert _retention_cutoff(D(2025, 3, 17), 2, "week") == D(2024, 12, 30)
+    # 2024-12-01 is a Sunday
+    assert _retention_cutoff(D(2025, 1, 15), 1, "week") == D(2024, 11, 25)
+
+
+def test_month_chunks_are_whole_months_ending_at_cutoff():
+    assert _retention_chunks(D(2024, 10, 20), D(2025, 1, 1), "month") == [
+        (D(2024, 10, 1), D(2024, 11, 1)),
+        (D(2024, 11, 1), D(2024, 12, 1)),
+        (D(2024, 12, 1), D(2025, 1, 1)),
+    ]
+
+
+def test_week_chunks_start_on_monday_and_are_clipped_at_cutoff():
+    chunks = _retention_chunks(D(2024, 11, 6), D(2024, 12, 30), "week")
+    assert chunks == [(D(2024, 11, 4), D(2024, 12, 2)), (D(2024, 12, 2), D(2024, 12, 30))]
+    chunks = _retention_chunks(D(2024, 11, 6), D(2024, 12, 16), "week")
+    assert chunks[-1] == (D(2024, 12, 2), D(2024, 12, 16))
+    assert all(a.weekday() == 0 for a, _ in chunks)
+
+
+def test_no_chunks_when_lo_is_at_or_past_cutoff():
+    assert _retention_chunks(D(2025, 1, 1), D(2025, 1, 1), "month") == []
+    assert _retention_chunks(D(2025, 1, 8), D(2025, 1, 6), "week") == []
@@ -0,0 +1,28 @@
+import math
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+
+from main import _lttb_indices  # noqa: E402
+
+
+@pytest.mark.parametrize("n, n_out", [(1000, 400), (500, 3), (101, 100), (10_000, 37)])
+def test_keeps_ends_exact_count_strictly_increasing(n, n_out):
+    ys = [math.sin(i / 17.0) * (i % 11) for i in range(n)]
+    idx = _lttb_indices(ys, n_out)
+    assert len(idx) == n_out
+    assert idx[0] == 0 and idx[-1] == n - 1
+    assert all(a < b for a, b in zip(idx, idx[1:]))
+
+
+def test_short_series_returned_whole():
+    assert _lttb_indices([1.0, 2.0, 3.0], 10) == [0, 1, 2]
+    assert _lttb_indices([1.0] * 50, 2) == list(range(50))
+
+
+def test_keeps_the_spike():
+    ys = [0.0] * 1000
+    ys[613] = 100.0
+    assert 613 in _lttb_indices(ys, 50)
@@ -2,8 +2,11 @@
 import os
 import datetime as dt
 
+# batch jobs own the box: parse big reports on every core (must be set before importing main)
+os.environ.setdefault("INGEST_PARSE_PROCESSES", str(os.cpu_count() or 1))
+
 # import the functions & constants from your app
-from main import _run_kw_backfill, _run_st_backfill, BACKFILL_WAIT_SECS, DAILY_WAIT_SECS
+from main import _run_ingest, _coverage_heal_plan, _run_migrations, _run_parquet_export, _run_compaction, _run_harvest, _run_anomaly_detection_safe, BACKFILL_WAIT_SECS, DAILY_WAIT_SECS
 
 def _d(s: str) -> dt.date:
     return dt.date.fromisoformat(s)
@@ -17,8 +20,12 @@ if __name__ == "__main__":
         wait = int(os.environ.get("DAILY_WAIT_SECS", DAILY_WAIT_SECS))
         chunk = 1
         print(f"[worker] DAILY: {start} → {end}, wait={wait}s, chunk={chunk}", flush=True)
-        _run_kw_backfill(start, end, chunk_days=chunk, wait_seconds=wait)
-        _run_st_backfill(start, end, chunk_days=chunk, wait_seconds=wait)
+        _run_ingest(("kw", "st"), start, end, chunk_days=chunk, wait_seconds=wait, priority="daily")
+        _run_anomaly_detection_safe(end)
+        # optional: refresh harvest candidates over a trailing window
+        harvest_days = int(os.environ.get("HARVEST_WINDOW_DAYS", "0"))
+        if harvest_days > 0:
+            _run_harvest(end - dt.timedelta(days=harvest_days - 1), end)
         print("[worker] DAILY ✅ done", flush=True)
 
     elif mode == "backfill":
@@ -28,9 +35,44 @@ if __name__ == "__main__":
         chunk = int(os.environ.get("CHUNK_DAYS", "7"))
         wait  = int(os.environ.get("BACKFILL_WAIT_SECS", BACKFILL_WAIT_SECS))
         print(f"[worker] BACKFILL: {start} → {end}, chunk={chunk}, wait={wait}s", flush=True)
-        _run_kw_backfill(start, end, chunk_days=chunk, wait_seconds=wait)
-        _run_st_backfill(start, end, chunk_days=chunk, wait_seconds=wait)
+        _run_ingest(("kw", "st"), start, end, chunk_days=chunk, wait_seconds=wait)
         print("[worker] BACKFILL ✅ done", flush=True)
 
+    elif mode == "heal":
+        # re-ingest only the missing / under-populated days of the trailing window
+        end = dt.date.today() - dt.timedelta(days=1)
+        start = end - dt.timedelta(days=int(os.environ.get("HEAL_WINDOW_DAYS", "60")) - 1)
+        chunk = int(os.environ.get("CHUNK_DAYS", "7"))
+        wait  = int(os.environ.get("BACKFILL_WAIT_SECS", BACKFILL_WAIT_SECS))
+        plan = _coverage_heal_plan(start, end, ("kw", "st"))
+        print(f"[worker] HEAL: {start} → {end}, plan={plan}", flush=True)
+        for kind, ranges in plan.items():
+            for s, e in ranges:
+                _run_ingest((kind,), s, e, chunk_days=chunk, wait_seconds=wait)
+        print("[worker] HEAL ✅ done", flush=True)
+
+    elif mode == "migrate":
+        # apply pending schema migrations (optional MIGRATE_TARGET=<version>)
+        target = os.environ.get("MIGRATE_TARGET")
+        print(f"[worker] MIGRATE: target={target or 'latest'}", flush=True)
+        result = _run_migrations(int(target) if target else None)
+        if result["locked"]:
+            raise SystemExit("[worker] MIGRATE: another runner holds the migration lock")
+        print(f"[worker] MIGRATE ✅ done {result}", flush=True)
+
+    elif mode == "export":
+        # write settled months to Parquet for the DuckDB analytics tier (needs pyarrow)
+        force = os.environ.get("EXPORT_FORCE", "0") == "1"
+        print(f"[worker] EXPORT: force={force}", flush=True)
+        result = _run_parquet_export(("kw", "st"), force=force)
+        print(f"[worker] EXPORT ✅ done {result}", flush=True)
+
+    elif mode == "compact":
+        # fold search-term days older than RETENTION_ST_MONTHS into the weekly / monthly tier
+        dry = os.environ.get("COMPACT_DRY_RUN", "0") == "1"
+        print(f"[worker] COMPACT: dry_run={dry}", flush=True)
+        result = _run_compaction(dry_run=dry)
+        print(f"[worker] COMPACT ✅ done {result}", flush=True)
+
     else:
         raise SystemExit(f"Unknown JOB_MODE={mode}")